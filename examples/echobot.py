@@ -4,21 +4,20 @@
 
 import pymumble_py3
 import time
-from pymumble_py3.callbacks import PYMUMBLE_CLBK_SOUNDRECEIVED as PCS
+from pymumble_py3.callbacks import PYMUMBLE_CLBK_ENCODEDSOUNDRECEIVED as PCES
 
 pwd = ""  # password
 server = "localhost"
 nick = "Bob"
 
 
-def sound_received_handler(user, soundchunk):
-    # sending the received sound back to server
-    mumble.sound_output.add_sound(soundchunk.pcm)
+def sound_received_handler(user, frame):
+    # sending the received sound back to server, as it was received: nothing to decode and encode again
+    mumble.sound_output.send_encoded_frame(frame)
 
 
 mumble = pymumble_py3.Mumble(server, nick, password=pwd)
-mumble.callbacks.set_callback(PCS, sound_received_handler)
-mumble.set_receive_sound(1)  # we want to receive sound
+mumble.callbacks.set_callback(PCES, sound_received_handler)  # no need for set_receive_sound, the sound is not decoded
 mumble.start()
 
 while 1:
@@ -1,9 +1,10 @@
 #!/usr/bin/python3
 # This bot reads standard input and converts them to speech via espeak and
-# sends them to server(of course after converting the wave format to s32le)
+# sends them to server (the library converts the wave format, numpy is needed)
 # A blank line to exit.
 import pymumble_py3
 import subprocess as sp
+import wave
 try:
     import readline # optional
 except ImportError:
@@ -20,10 +21,7 @@ while s:
     s = input(") ") 
     # converting text to speech
     command = ["espeak","--stdout", s]
-    wave_file = sp.Popen(command, stdout=sp.PIPE).stdout
-    # converting the wave speech to pcm
-    command = ["ffmpeg", "-i", "-", "-ac", "1", "-f", "s32le","-"] 
-    sound = sp.Popen(command, stdout=sp.PIPE, stderr=sp.DEVNULL,
-    stdin=wave_file).stdout.read()
-    # sending speech to server
-    mumble.sound_output.add_sound(sound)
+    wave_file = wave.open(sp.Popen(command, stdout=sp.PIPE).stdout)
+    sound = wave_file.readframes(wave_file.getnframes())  # 16 bits samples
+    # sending speech to server, in the format and at the sample rate of espeak
+    mumble.sound_output.add_sound(sound, sample_rate=wave_file.getframerate(), channels=wave_file.getnchannels())
@@ -1,3 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from .mumble import Mumble
+from .metrics import Metrics, prometheus_text
+from .asyncmumble import AsyncMumble
+from .reactor import Reactor
+from .connector import Connector
+from .oggopus import OggOpusReader
+from .voicetargets import WhisperTarget, make_target
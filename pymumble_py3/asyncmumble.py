@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import struct
+import sys
+import threading
+import time
+
+from .errors import *
+from .constants import *
+from .mumble import MumbleProtocol
+
+
+class AsyncMumble(MumbleProtocol):
+    """
+    Mumble client library object running on an asyncio event loop instead of its own thread.
+    The protocol handling and the users, channels and sound objects are the ones of Mumble (from MumbleProtocol),
+    only the transport and the scheduling differ.  Many connections can share the same event loop.
+    Must be used from the event loop thread.
+    """
+
+    def __init__(self, host, user, port=64738, password='', certfile=None, keyfile=None, reconnect=False, tokens=[], debug=False):
+        """Same parameters as Mumble"""
+        MumbleProtocol.__init__(self, host, user, port=port, password=password, certfile=certfile, keyfile=keyfile,
+                                reconnect=reconnect, tokens=tokens, debug=debug)
+
+        self.event_loop = None  # asyncio loop running the connection
+        self.task = None  # task running the connection
+        self.ready = None  # future resolved when the connection is fully established with the server
+        self.wakeup_event = None  # set to interrupt the wait of the scheduler
+
+        self.reader = None
+        self.writer = None
+
+        self.streams = list()  # event iterators to close when the connection ends
+
+    def init_connection(self):
+        """Initialize variables that are local to a connection, (needed if the client automatically reconnect)"""
+        MumbleProtocol.init_connection(self)
+
+        if self.ready is None or self.ready.done():
+            self.ready = self.event_loop.create_future()
+        self.wakeup_event = asyncio.Event()
+
+        self.reader = None
+        self.writer = None
+
+    async def start(self):
+        """Connect to the server and run the connection in a background task.  Return when the connection is established"""
+        self.event_loop = asyncio.get_running_loop()
+        self.mumble_thread = threading.current_thread()
+        self.ready = self.event_loop.create_future()
+
+        self.task = self.event_loop.create_task(self.run())
+        await self.is_ready()
+
+    async def stop(self):
+        """Close the connection and wait for the background task to finish"""
+        self.reconnect = False
+        self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+        self.wakeup()
+        if self.task is not None:
+            await self.task
+
+    async def run(self):
+        """Connect to the server and treat the connection.  Retry if requested"""
+        try:
+            while True:
+                self.init_connection()  # reset the connection-specific object members
+
+                if await self.connect() >= PYMUMBLE_CONN_STATE_FAILED:  # some error occurred
+                    if not self.is_retrying():  # exit here
+                        self.set_ready_exception(ConnectionRejectedError("Connection error with the Mumble (murmur) Server"))
+                        break
+                else:
+                    try:
+                        await self.loop()
+                    except ConnectionRejectedError as e:
+                        self.set_ready_exception(e)
+                        break
+                    except (OSError, asyncio.IncompleteReadError):
+                        self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+
+                    if not self.reconnect:
+                        break
+
+                await asyncio.sleep(self.get_reconnect_delay())
+        except asyncio.CancelledError:  # before Exception, it is one of them in python 3.7
+            if not self.ready.done():
+                self.ready.cancel()
+            raise
+        except Exception as e:  # a callback or an invalid message, the ones waiting for the connection must not hang
+            self.set_ready_exception(e)
+            raise
+        finally:
+            self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+            for stream in list(self.streams):
+                stream.close()
+
+    def set_ready_exception(self, exception):
+        """Signal the connection failure to the ones waiting for it"""
+        if not self.ready.done():
+            self.ready.set_exception(exception)
+            self.ready.exception()  # mark as retrieved, the application may not wait for it
+
+    async def connect(self):
+        """Connect to the server"""
+        self.Log.debug("connecting to %s on port %i.", self.host, self.port)
+
+        try:
+            connector = self.connector
+            options = dict()
+            if sys.version_info >= (3, 8):  # race the server addresses, not available before
+                options.update(happy_eyeballs_delay=connector.attempt_delay, interleave=1)
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.get_ssl_context(),
+                                        ssl_handshake_timeout=connector.handshake_timeout, **options),
+                connector.connect_timeout + connector.handshake_timeout)
+            self.writer.transport.set_write_buffer_limits(high=self.send_queue_high_water)
+            self.control_socket = self.writer.get_extra_info('socket')  # used to open the UDP channel
+
+            self.authenticate()
+        except (OSError, asyncio.TimeoutError):
+            self.connected = PYMUMBLE_CONN_STATE_FAILED
+            return self.connected
+
+        self.connected = PYMUMBLE_CONN_STATE_AUTHENTICATING
+        return self.connected
+
+    def get_ssl_context(self):
+        """
+        Return the SSL context for the control connection, shared with the other connections using the same certificate
+        asyncio can not resume a TLS session, so the handshake is always a full one,
+        and it races the server addresses itself (from python 3.8, they are tried one by one before),
+        without starting with the last one that worked
+        """
+        return self.connector.get_ssl_context(self.certfile, self.keyfile)
+
+    async def loop(self):
+        """
+        Main loop of the connection
+        read and dispatch the control messages, the scheduled tasks run in a parallel task
+        """
+        self.Log.debug("entering loop")
+
+        self.last_ping = time.time()  # keep track of the last ping time
+        scheduler = self.event_loop.create_task(self.run_scheduler())
+
+        try:
+            while self.connected not in (PYMUMBLE_CONN_STATE_NOT_CONNECTED, PYMUMBLE_CONN_STATE_FAILED):
+                header = await self.reader.readexactly(6)
+                (type, size) = struct.unpack("!HL", header)  # decode header
+                message = await self.reader.readexactly(size)
+
+                self.dispatch_control_message(type, message)
+
+                if self.connected == PYMUMBLE_CONN_STATE_CONNECTED and not self.ready.done():
+                    self.ready.set_result(True)
+        finally:
+            scheduler.cancel()
+            self.close_media_socket()
+            self.save_server_cache()
+            self.writer.close()
+
+    async def run_scheduler(self):
+        """Run the scheduled tasks of the connection: pings, commands and outgoing audio"""
+        while self.connected not in (PYMUMBLE_CONN_STATE_NOT_CONNECTED, PYMUMBLE_CONN_STATE_FAILED):
+            self.wakeup_event.clear()
+
+            start = time.perf_counter()
+            self.run_scheduled_tasks()
+            self.metrics.observe(PYMUMBLE_METRIC_LOOP_TIME, time.perf_counter() - start)
+
+            if self.is_audio_congested():  # the audio waits for the tcp tunnel to drain
+                waiter = self.drain()
+            else:
+                waiter = self.wakeup_event.wait()
+
+            try:
+                await asyncio.wait_for(waiter, self.get_loop_timeout())
+            except asyncio.TimeoutError:
+                pass
+
+        self.writer.close()  # stop the reading of the control messages
+
+    def call_in_loop(self, func, *args):
+        """Call a function in the event loop thread, directly if already in it"""
+        if self.mumble_thread is threading.current_thread():
+            func(*args)
+        else:
+            self.event_loop.call_soon_threadsafe(func, *args)
+
+    def wakeup(self):
+        """Interrupt the wait of the scheduler, when something must be treated"""
+        if self.wakeup_event is not None:
+            self.call_in_loop(self.wakeup_event.set)
+
+    def send_data(self, packet):
+        """
+        Write raw data on the control connection.  Can be called from any thread
+        Return False if the transport buffer is above the high-water mark
+        """
+        self.call_in_loop(self.writer.write, packet)
+        return not self.is_send_queue_full()
+
+    def get_send_queue_size(self):
+        """Return the size in bytes of the data waiting to be written on the control connection"""
+        if self.writer is None:
+            return 0
+        return self.writer.transport.get_write_buffer_size()
+
+    def set_send_queue_high_water(self, size):
+        """Set the size in bytes of the outgoing buffer above which the callers are asked to slow down"""
+        MumbleProtocol.set_send_queue_high_water(self, size)
+        if self.writer is not None:
+            self.writer.transport.set_write_buffer_limits(high=size)
+
+    async def drain(self):
+        """Wait until the outgoing data goes below the transport high-water mark"""
+        if self.writer is not None:
+            await self.writer.drain()
+
+    def open_media_socket(self):
+        """Create the UDP socket for the audio and watch it in the event loop"""
+        MumbleProtocol.open_media_socket(self)
+        if self.media_socket is not None:
+            self.event_loop.add_reader(self.media_socket, self.read_media_messages)
+
+    def close_media_socket(self):
+        """Close the UDP socket and go back to the tcp tunnel"""
+        if self.media_socket is not None:
+            self.event_loop.remove_reader(self.media_socket)
+        MumbleProtocol.close_media_socket(self)
+
+    async def is_ready(self):
+        """Wait for the connection to be fully completed"""
+        await asyncio.shield(self.ready)
+
+    def execute_command(self, cmd, blocking=True):
+        """
+        Send a command to the server, once the connection is established
+        Return a task that can be awaited, which completes when the command is written on the connection
+        """
+        return self.event_loop.create_task(self.send_command(cmd))
+
+    async def send_command(self, cmd):
+        """Send a command to the server and wait for the connection to accept more data"""
+        await self.is_ready()
+
+        self.commands.new_cmd(cmd)
+        while self.commands.is_cmd():
+            self.treat_command(self.commands.pop_cmd())
+
+        await self.drain()
+        return cmd.response
+
+    def events(self, *callbacks, maxsize=0):
+        """
+        Return an async iterator over the library events, as (callback name, parameters tuple)
+        By default, all the callbacks are followed, except the encoded audio frames (one per packet received).
+        If maxsize is set, the oldest events are dropped when full
+        """
+        if not callbacks:
+            callbacks = [callback for callback in self.callbacks.get_callbacks_list()
+                         if callback != PYMUMBLE_CLBK_ENCODEDSOUNDRECEIVED]
+        return EventStream(self, callbacks, maxsize)
+
+    def sound(self, maxsize=PYMUMBLE_ASYNC_SOUND_QUEUE_SIZE):
+        """
+        Return an async iterator over the received audio, as (user, SoundChunk)
+        Enable the reception of audio.  The chunks are removed from the users SoundQueue
+        """
+        self.set_receive_sound(True)
+        return SoundStream(self, maxsize)
+
+
+class EventStream:
+    """
+    Async iterator over callbacks of an AsyncMumble connection.
+    Stops when the connection ends for good, or when closed
+    """
+
+    def __init__(self, mumble_object, callbacks, maxsize=0):
+        self.mumble_object = mumble_object
+        self.queue = asyncio.Queue(maxsize)
+        self.closed = False
+
+        self.handlers = dict()
+        for callback in callbacks:
+            handler = functools.partial(self.push, callback)
+            self.handlers[callback] = handler
+            self.mumble_object.callbacks.add_callback(callback, handler)
+
+        self.mumble_object.streams.append(self)
+
+    def push(self, callback, *parameters):
+        """Called by the callbacks, possibly from another thread (text messages)"""
+        self.mumble_object.call_in_loop(self.put, (callback, parameters))
+
+    def put(self, event):
+        if self.queue.full():  # drop the oldest event
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    def close(self):
+        """Stop following the callbacks and end the iteration"""
+        if self.closed:
+            return
+        self.closed = True
+
+        for (callback, handler) in self.handlers.items():
+            self.mumble_object.callbacks.remove_callback(callback, handler)
+        self.handlers = dict()
+        self.mumble_object.streams.remove(self)
+
+        self.mumble_object.call_in_loop(self.put, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+class SoundStream(EventStream):
+    """Async iterator over the received audio of an AsyncMumble connection, as (user, SoundChunk)"""
+
+    def __init__(self, mumble_object, maxsize=0):
+        EventStream.__init__(self, mumble_object, [PYMUMBLE_CLBK_SOUNDRECEIVED], maxsize)
+
+    def push(self, callback, user, soundchunk):
+        if soundchunk is None:  # not decoded
+            return
+        user.sound.discard_sound(soundchunk)  # consumed through this iterator
+        EventStream.push(self, callback, user, soundchunk)
+
+    async def __anext__(self):
+        (callback, parameters) = await EventStream.__anext__(self)
+        return parameters
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from .constants import *
+
+
+class AudioPacer(threading.Thread):
+    """
+    Thread sending the outgoing audio of a SoundOutput on time, whatever the library thread is doing.
+    The deadlines come from the sequence numbering, absolute on the monotonic clock, so the delays never accumulate.
+    The next packet is encoded in advance, and the thread sleeps until shortly before its deadline,
+    then polls the clock to send it at the exact time
+    """
+
+    def __init__(self, sound_output, spin=PYMUMBLE_AUDIO_PACER_SPIN):
+        """spin=time before a deadline spent polling the clock instead of sleeping, in sec"""
+        threading.Thread.__init__(self, name="PyMumble audio pacer")
+        self.daemon = True
+
+        self.sound_output = sound_output
+        self.mumble_object = sound_output.mumble_object
+        self.spin = int(spin * 1000000000)  # in ns
+
+        self.wakeup_event = threading.Event()  # set when audio is added or the connection is ready
+        self.running = True
+
+    def run(self):
+        packet = None  # next packet, encoded in advance
+
+        while self.running and self.mumble_object.parent_thread.is_alive():
+            self.wakeup_event.clear()
+
+            if self.mumble_object.connected != PYMUMBLE_CONN_STATE_CONNECTED:
+                self.wakeup_event.wait(PYMUMBLE_LOOP_RATE)
+                continue
+
+            if packet is None:
+                packet = self.sound_output.encode_payload()
+                if packet is None:  # nothing to send
+                    self.wakeup_event.wait(PYMUMBLE_LOOP_RATE)
+                    continue
+
+            self.sleep_until(int(self.sound_output.get_next_packet_time() * 1000000000))
+
+            if self.mumble_object.is_audio_congested():  # keep the packet until the tcp tunnel drains
+                time.sleep(self.sound_output.audio_per_packet)
+                continue
+
+            self.sound_output.send_packet(packet, time.monotonic())
+            packet = None
+
+        if packet is not None:  # stopped while keeping it, the library thread or the next pacer sends it
+            self.sound_output.put_back_payload(packet)
+
+    def sleep_until(self, deadline):
+        """Wait until a time on the monotonic clock, in ns"""
+        remaining = deadline - time.monotonic_ns()
+        if remaining > self.spin:
+            time.sleep((remaining - self.spin) / 1000000000)  # the sleep may last a bit longer than asked
+
+        while time.monotonic_ns() < deadline:  # the other threads still take the GIL in turn (sys.getswitchinterval())
+            pass
+
+    def wakeup(self):
+        """Signal that there may be audio to send.  Can be called from any thread"""
+        self.wakeup_event.set()
+
+    def stop(self):
+        """Stop the thread, after sending the packet it may be waiting for, or putting it back in the sound output"""
+        self.running = False
+        self.wakeup_event.set()
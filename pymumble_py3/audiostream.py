@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+
+from .constants import *
+from .resampler import SAMPLE_FORMATS, get_input_format
+
+
+class AudioStream:
+    """
+    Feed an audio buffer of a SoundOutput from a stream: file object, pipe, iterator or generator of chunks,
+    async iterator or asyncio StreamReader.  The stream is read only as the audio is sent, to keep a lookahead buffered:
+    the memory stays bounded whatever the length of the stream, and the first chunk is sent as soon as it is read.
+    The blocking streams are read by a dedicated thread, the async ones by a task of the running event loop
+    """
+
+    def __init__(self, sound_output, stream, buffer, lookahead=PYMUMBLE_STREAM_LOOKAHEAD, chunk=PYMUMBLE_STREAM_CHUNK,
+                 sample_rate=PYMUMBLE_SAMPLERATE, channels=1, sample_format=PYMUMBLE_SAMPLE_FORMAT_S16LE):
+        """
+        buffer=PCMBuffer to fill (the one of add_sound, or of a mixer source)
+        lookahead=audio kept buffered ahead of the sending, in sec
+        chunk=audio read at once from a file object, in sec
+        sample_rate, channels, sample_format=format of the audio, like SoundOutput.add_sound
+        """
+        self.sound_output = sound_output
+        self.stream = stream
+        self.buffer = buffer
+        self.lookahead = lookahead
+
+        (self.sample_rate, self.channels, self.sample_format) = get_input_format(stream, sample_rate, channels, sample_format)
+        self.chunk_size = int(chunk * self.sample_rate) * self.channels * SAMPLE_FORMATS[self.sample_format][1]  # in bytes
+
+        self.running = True
+        self.error = None  # exception that stopped the reading, if any
+        self.thread = None  # reading a blocking stream
+        self.task = None  # reading an async stream
+
+    def start(self):
+        read = getattr(self.stream, "read", None)
+        if hasattr(self.stream, "__aiter__") or asyncio.iscoroutinefunction(read):
+            self.task = asyncio.ensure_future(self.run_async())  # must be called from the event loop
+        else:
+            self.thread = threading.Thread(target=self.run, name="PyMumble audio stream", daemon=True)
+            self.thread.start()
+
+    def read_chunks(self):
+        if hasattr(self.stream, "read"):
+            while True:
+                data = self.stream.read(self.chunk_size)
+                if not data:  # end of file
+                    return
+                yield data
+        else:
+            yield from self.stream
+
+    async def read_chunks_async(self):
+        if hasattr(self.stream, "__aiter__") and not isinstance(self.stream, asyncio.StreamReader):  # a StreamReader iterates over lines
+            async for data in self.stream:
+                yield data
+        else:
+            while True:
+                data = await self.stream.read(self.chunk_size)
+                if not data:
+                    return
+                yield data
+
+    def add(self, data):
+        self.sound_output.add_to_buffer(self.buffer, data, self.sample_rate, self.channels, self.sample_format)
+
+    def get_excess(self):
+        """return the audio buffered beyond the lookahead, in sec (negative if more audio is needed)"""
+        return len(self.buffer) / 2. / PYMUMBLE_SAMPLERATE - self.lookahead
+
+    def run(self):
+        limit = int(self.lookahead * PYMUMBLE_SAMPLERATE) * 2
+        try:
+            for data in self.read_chunks():
+                if not self.running:
+                    break
+                self.add(data)
+                while self.running and not self.buffer.wait_below(limit, PYMUMBLE_LOOP_RATE):  # woken up by the encoder
+                    pass
+        except Exception as e:
+            self.error = e
+            self.sound_output.Log.error("error while reading an audio stream: %s", e)
+        finally:
+            self.running = False
+
+    async def run_async(self):
+        try:
+            async for data in self.read_chunks_async():
+                if not self.running:
+                    break
+                self.add(data)
+                while self.running and self.get_excess() >= 0:  # sleep until the audio beyond the lookahead is sent
+                    await asyncio.sleep(self.get_excess() + PYMUMBLE_STREAM_CHUNK / 2)
+        except Exception as e:
+            self.error = e
+            self.sound_output.Log.error("error while reading an audio stream: %s", e)
+        finally:
+            self.running = False
+
+    def is_playing(self):
+        """return True while the stream is being read (its last audio may still be buffered afterward)"""
+        return self.running
+
+    def stop(self):
+        """stop reading the stream, the audio already buffered is still sent"""
+        self.running = False
+        self.buffer.notify()
+
+    def join(self, timeout=None):
+        """wait for the end of the reading of a blocking stream"""
+        if self.thread is not None:
+            self.thread.join(timeout)
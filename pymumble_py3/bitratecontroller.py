@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import struct
+import time
+
+from .constants import *
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # missing on Windows, the kernel send buffer is then not measured
+    fcntl = None
+
+
+class BitrateController:
+    """
+    Adapt the outgoing audio bitrate to the congestion of the link, so the voice latency stays bounded.
+    The congestion is measured from the data waiting to be sent on the control connection (the audio goes through it
+    when UDP is not available), in the library queue and in the kernel send buffer, and from the growth of the round-trip
+    time of the pings above the lowest one measured on the connection.
+    The bitrate decreases quickly on congestion, and increases slowly after a while without congestion (AIMD),
+    with distinct thresholds to enter and leave the congested state, always within the bandwidth allowed by the server.
+    The adapted bandwidth is the total of the sound outputs, each one limited to its share of it
+    """
+
+    def __init__(self, mumble_object):
+        self.mumble_object = mumble_object
+        self.limit = None  # total audio bandwidth of the sound outputs allowed on the congested link, None for the full one
+
+        self.enabled = False
+        self.adapt_packet_size = False  # also choose the packet size from the adapted bandwidth
+        self.reset()
+
+    def reset(self):
+        """Forget the state of the previous connection"""
+        self.last_update = 0  # time of the last decision
+        self.last_decrease = 0  # time of the last decrease, the increases wait for PYMUMBLE_BITRATE_INCREASE_DELAY after it
+        self.base_rtt = None  # lowest round-trip time of the connection, without queuing, in ms
+        self.rtt_samples = 0  # number of round-trips measured at the last decision
+        self.rtt_inflation = 0  # last round-trip time above the base one, in ms
+        self.congested = False
+        self.set_limit(None)
+
+    def set_enabled(self, enabled, adapt_packet_size=False):
+        """
+        enable or disable the adaptation of the bitrate.  When disabled, the full bandwidth is used again
+        adapt_packet_size=True to choose the packet size from the adapted bandwidth too (longer packets when it is low)
+        """
+        self.enabled = enabled
+        self.adapt_packet_size = adapt_packet_size
+        if enabled and adapt_packet_size:
+            for sound_output in self.mumble_object.get_sound_outputs().values():
+                sound_output.set_audio_per_packet(None)
+        if not enabled:
+            self.set_limit(None)
+        self.mumble_object.wakeup()
+
+    def get_next_update(self):
+        """return the time of the next decision, or None if disabled"""
+        if not self.enabled:
+            return None
+        return self.last_update + PYMUMBLE_BITRATE_CONTROL_INTERVAL
+
+    def get_bandwidth(self):
+        """return the total bandwidth configured for the sound outputs"""
+        return sum(sound_output.get_bandwidth() for sound_output in self.mumble_object.get_sound_outputs().values())
+
+    def get_effective_bandwidth(self):
+        """return the total bandwidth actually used by the sound outputs"""
+        return sum(sound_output.get_effective_bandwidth() for sound_output in self.mumble_object.get_sound_outputs().values())
+
+    def get_bitrate(self):
+        """return the total bitrate of the encoders of the sound outputs"""
+        return sum(sound_output.get_bitrate() or 0 for sound_output in self.mumble_object.get_sound_outputs().values())
+
+    def set_limit(self, limit):
+        """limit the total audio bandwidth (None for the full one), and apply it to the sound outputs"""
+        self.limit = limit
+        self.apply_limit()
+
+    def apply_limit(self):
+        """limit each sound output to its share of the total audio bandwidth.  Called again when the outputs change"""
+        sound_outputs = self.mumble_object.get_sound_outputs().values()
+        bandwidth = sum(sound_output.get_bandwidth() for sound_output in sound_outputs)
+        for sound_output in sound_outputs:
+            if self.limit is None or not bandwidth:
+                sound_output.set_bandwidth_limit(None)
+            else:
+                sound_output.set_bandwidth_limit(sound_output.get_bandwidth() * self.limit // bandwidth)
+
+    def get_socket_queue(self):
+        """return the bytes not yet sent or acknowledged in the kernel buffer of the control connection, 0 if unknown"""
+        control_socket = self.mumble_object.control_socket
+        if control_socket is None or fcntl is None:
+            return 0
+        try:
+            return struct.unpack("i", fcntl.ioctl(control_socket.fileno(), termios.TIOCOUTQ, b"\0" * 4))[0]
+        except (OSError, ValueError, AttributeError):  # not supported on this platform, or closed
+            return 0
+
+    def get_queue_delay(self, bandwidth):
+        """return the time the audio waits behind the data queued on the control connection, in sec (0 when sent by UDP)"""
+        if self.mumble_object.udp_active:
+            return 0
+        queued = self.mumble_object.get_send_queue_size() + self.get_socket_queue()
+        return queued * 8. / bandwidth
+
+    def update_rtt(self):
+        """take the new round-trip measure of the channel carrying the audio into account, return True if there is one"""
+        stats = self.mumble_object.udp_ping_stats if self.mumble_object.udp_active else self.mumble_object.ping_stats
+        if stats.nb == self.rtt_samples or stats.last is None:  # no new measure
+            return False
+        self.rtt_samples = stats.nb
+
+        if self.base_rtt is None or stats.last < self.base_rtt:
+            self.base_rtt = stats.last
+        self.rtt_inflation = stats.last - self.base_rtt
+        return True
+
+    def update(self):
+        """measure the congestion and adapt the bitrate.  Called regularly by the library loop"""
+        now = time.time()
+        self.last_update = now
+
+        bandwidth = self.get_bandwidth()
+        current = self.get_effective_bandwidth()
+
+        new_rtt = self.update_rtt()  # a high round-trip time triggers one decrease, but prevents the increases until it drops
+        queue_delay = self.get_queue_delay(current)
+
+        if queue_delay > PYMUMBLE_BITRATE_QUEUE_DELAY_HIGH or (new_rtt and self.rtt_inflation > PYMUMBLE_BITRATE_RTT_INFLATION_HIGH) \
+                or self.mumble_object.is_audio_congested():
+            self.congested = True
+        elif queue_delay < PYMUMBLE_BITRATE_QUEUE_DELAY_LOW and self.rtt_inflation < PYMUMBLE_BITRATE_RTT_INFLATION_LOW:
+            self.congested = False
+        # in between, the state does not change
+
+        if self.congested and (new_rtt or queue_delay > PYMUMBLE_BITRATE_QUEUE_DELAY_HIGH or self.mumble_object.is_audio_congested()) \
+                and now >= self.last_decrease + PYMUMBLE_BITRATE_CONTROL_INTERVAL * 2:  # let the last decrease take effect
+            target = max(PYMUMBLE_BITRATE_MIN, int(current * PYMUMBLE_BITRATE_DECREASE))
+            self.last_decrease = now
+            reason = "congestion"
+        elif not self.congested and current < bandwidth and now >= self.last_decrease + PYMUMBLE_BITRATE_INCREASE_DELAY:
+            target = min(bandwidth, current + int(bandwidth * PYMUMBLE_BITRATE_INCREASE))
+            reason = "recovery"
+        else:
+            return
+
+        target = min(target, bandwidth)
+        if target == current:
+            return
+
+        self.set_limit(target if target < bandwidth else None)
+        self.mumble_object.Log.debug("audio bandwidth adapted to %i (%s, queue delay %.3fs, rtt inflation %.1fms)",
+                                     target, reason, queue_delay, self.rtt_inflation)
+        self.mumble_object.callbacks(PYMUMBLE_CLBK_BITRATECHANGED, {
+            "bandwidth": target,
+            "bitrate": self.get_bitrate(),
+            "audio_per_packet": self.mumble_object.sound_output.get_audio_per_packet(),
+            "reason": reason,
+            "queue_delay": queue_delay,
+            "rtt_inflation": self.rtt_inflation,
+        })
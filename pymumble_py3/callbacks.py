@@ -3,6 +3,7 @@
 from .errors import UnknownCallbackError
 from .constants import *
 import threading
+import time
 
 
 class CallBacks(dict):
@@ -13,7 +14,8 @@ class CallBacks(dict):
     The call is done from within the pymumble loop thread, it's important to
     keep processing short to avoid delays on audio transmission
     """
-    def __init__(self):
+    def __init__(self, metrics=None):
+        self.metrics = metrics  # Metrics object measuring the time spent in the callbacks
         self.update({
             PYMUMBLE_CLBK_CONNECTED: None,  # Connection succeeded
             PYMUMBLE_CLBK_CHANNELCREATED: None,  # send the created channel object as parameter
@@ -23,8 +25,10 @@ class CallBacks(dict):
             PYMUMBLE_CLBK_USERUPDATED: None,  # send the updated user object and a dict with all the modified fields as parameter
             PYMUMBLE_CLBK_USERREMOVED: None,  # send the removed user object and the mumble message as parameter
             PYMUMBLE_CLBK_SOUNDRECEIVED: None,  # send the user object that received the sound and the SoundChunk object itself
+            PYMUMBLE_CLBK_ENCODEDSOUNDRECEIVED: None,  # send the user object and the EncodedFrame object, before any decoding
             PYMUMBLE_CLBK_TEXTMESSAGERECEIVED: None,  # Send the received message
             PYMUMBLE_CLBK_CONTEXTACTIONRECEIVED: None,  # Send the contextaction message
+            PYMUMBLE_CLBK_BITRATECHANGED: None,  # send a dict with the decision of the bitrate controller
         })
             
     def set_callback(self, callback, dest):
@@ -79,6 +83,10 @@ class CallBacks(dict):
                 if callback is PYMUMBLE_CLBK_TEXTMESSAGERECEIVED:
                     thr = threading.Thread(target=func, args=pos_parameters)
                     thr.start()
+                elif self.metrics is not None:
+                    start = time.perf_counter()
+                    func(*pos_parameters)
+                    self.metrics.observe(PYMUMBLE_METRIC_CALLBACK_TIME, time.perf_counter() - start, label=callback)
                 else:
                     func(*pos_parameters)
     
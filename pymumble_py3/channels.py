@@ -14,31 +14,48 @@ class Channels(dict):
         self.mumble_object = mumble_object
         self.callbacks = callbacks
 
+        self.previous = dict()  # channels of the previous connection not seen again yet
+
         self.lock = Lock()
 
+    def start_resync(self):
+        """
+        Put aside the known channels when connecting again.  The channels sent by the server are matched with them,
+        so that only the real changes are signaled to the callbacks
+        """
+        with self.lock:
+            self.previous.update(self)  # added to the ones of a previous attempt that did not complete, if any
+            self.clear()
+
+    def end_resync(self):
+        """Remove the channels of the previous connection that the server did not send again"""
+        with self.lock:
+            previous, self.previous = self.previous, dict()
+            for channel in previous.values():
+                self.callbacks(PYMUMBLE_CLBK_CHANNELREMOVED, channel)
+
     def update(self, message):
         """Update the channel information based on an incoming message"""
-        self.lock.acquire()
-
-        if message.channel_id not in self:  # create the channel
-            self[message.channel_id] = Channel(self.mumble_object, message)
-            self.callbacks(PYMUMBLE_CLBK_CHANNELCREATED, self[message.channel_id])
-        else:  # update the channel
-            actions = self[message.channel_id].update(message)
-            self.callbacks(PYMUMBLE_CLBK_CHANNELUPDATED, self[message.channel_id], actions)
-
-        self.lock.release()
+        with self.lock:
+            if message.channel_id in self.previous:  # known before the reconnection
+                channel = self[message.channel_id] = self.previous.pop(message.channel_id)
+                actions = channel.resync(message)
+                if actions:
+                    self.callbacks(PYMUMBLE_CLBK_CHANNELUPDATED, channel, actions)
+            elif message.channel_id not in self:  # create the channel
+                self[message.channel_id] = Channel(self.mumble_object, message)
+                self.callbacks(PYMUMBLE_CLBK_CHANNELCREATED, self[message.channel_id])
+            else:  # update the channel
+                actions = self[message.channel_id].update(message)
+                self.callbacks(PYMUMBLE_CLBK_CHANNELUPDATED, self[message.channel_id], actions)
 
     def remove(self, id):
         """Delete a channel when server signal the channel is removed"""
-        self.lock.acquire()
-
-        if id in self:
-            channel = self[id]
-            del self[id]
-            self.callbacks(PYMUMBLE_CLBK_CHANNELREMOVED, channel)
-
-        self.lock.release()
+        with self.lock:
+            if id in self:
+                channel = self[id]
+                del self[id]
+                self.callbacks(PYMUMBLE_CLBK_CHANNELREMOVED, channel)
 
     def find_by_tree(self, tree):
         """Find a channel by its full path (a list with an element for each leaf)"""
@@ -108,11 +125,11 @@ class Channels(dict):
 
     def new_channel(self, parent, name, temporary=True):
         cmd = messages.CreateChannel(parent, name, temporary)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def remove_channel(self, channel_id):
         cmd = messages.RemoveChannel(channel_id)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
 
 class Channel(dict):
@@ -150,6 +167,19 @@ class Channel(dict):
 
         return actions  # return a dict with updates performed, useful for the callback functions
 
+    def resync(self, message):
+        """Replace the whole state with the one sent on a new connection.  Return the changed fields, None for the removed ones"""
+        previous = dict(self)
+
+        self.clear()
+        self["channel_id"] = message.channel_id
+        self.update(message)
+
+        actions = {name: value for (name, value) in self.items() if name not in previous or previous[name] != value}
+        actions.update({name: None for name in previous if name not in self})
+
+        return actions
+
     def get_id(self):
         return self["channel_id"]
 
@@ -174,11 +204,11 @@ class Channel(dict):
             session = self.mumble_object.users.myself_session
 
         cmd = messages.MoveCmd(session, self["channel_id"])
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def remove(self):
         cmd = messages.RemoveChannel(self["channel_id"])
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def send_text_message(self, message):
         """Send a text message to the channel."""
@@ -196,4 +226,4 @@ class Channel(dict):
         session = self.mumble_object.users.myself_session
 
         cmd = messages.TextMessage(session, self["channel_id"], message)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
@@ -9,12 +9,14 @@ class Commands:
     from whatever tread.
     Each command has it's own lock semaphore to signal is received an answer
     """
-    def __init__(self):
+    def __init__(self, wakeup=None):
         self.id = 0
         
         self.queue = deque() 
         
         self.lock = Lock()
+
+        self.wakeup = wakeup  # function to call to signal the mumble thread a new command is waiting
     
     def new_cmd(self, cmd):
         """Add a command to the queue"""
@@ -26,6 +28,10 @@ class Commands:
         cmd.lock.acquire()
 
         self.lock.release()
+
+        if self.wakeup is not None:
+            self.wakeup()
+
         return cmd.lock
     
     def is_cmd(self):
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import errno
+import itertools
+import os
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+from .constants import *
+
+
+class Connector:
+    """
+    Open the TLS control connections to the servers.
+    The SSL contexts and the TLS sessions are kept per server, so that the handshake of a reconnection is resumed
+    instead of being done in full.  The addresses of a server are tried in parallel (happy eyeballs),
+    starting with the last one that worked.  By default, one instance is shared by all the connections of the process
+    """
+
+    def __init__(self, connect_timeout=PYMUMBLE_CONNECT_TIMEOUT, handshake_timeout=PYMUMBLE_HANDSHAKE_TIMEOUT,
+                 attempt_delay=PYMUMBLE_CONNECT_ATTEMPT_DELAY):
+        """
+        connect_timeout=maximum time to open the TCP connection, the name resolution and all the addresses included, in sec
+        handshake_timeout=maximum time for the TLS handshake, in sec
+        attempt_delay=delay before trying the next address while the previous ones do not answer, in sec
+        """
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.attempt_delay = attempt_delay
+
+        self.lock = threading.Lock()
+
+        self.contexts = dict()  # (certfile, keyfile) -> SSLContext, a session can only be resumed with its context
+        self.sessions = dict()  # (host, port, certfile, keyfile) -> last TLS session with this server
+        self.addresses = dict()  # (host, port) -> (family, address) of the last connection that worked
+
+    def get_ssl_context(self, certfile=None, keyfile=None):
+        """Return the SSL context for a client certificate (the server certificate is not verified, like Mumble does)"""
+        with self.lock:
+            context = self.contexts.get((certfile, keyfile))
+            if context is None:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                if certfile:
+                    context.load_cert_chain(certfile, keyfile)
+                self.contexts[(certfile, keyfile)] = context
+            return context
+
+    def connect(self, host, port, certfile=None, keyfile=None):
+        """
+        Open a TLS connection to a server, resuming the last TLS session with it if possible
+        Return the connected SSL socket, in blocking mode.  Raise socket.error on failure or timeout
+        """
+        context = self.get_ssl_context(certfile, keyfile)
+        key = (host, port, certfile, keyfile)
+
+        std_sock = self.open_socket(host, port)
+
+        std_sock.settimeout(self.handshake_timeout)
+        try:
+            control_socket = context.wrap_socket(std_sock, server_hostname=host, session=self.sessions.get(key))
+        except socket.error:  # the handshake failed, the socket is closed
+            std_sock.close()
+            with self.lock:
+                self.sessions.pop(key, None)  # may be the reason, start over with a full handshake
+            raise
+        control_socket.settimeout(None)
+
+        self.save_session(host, port, certfile, keyfile, control_socket)
+        return control_socket
+
+    def get_addresses(self, host, port):
+        """
+        Resolve a server, and return its (family, address) in the order to try them:
+        the last one that worked first, then alternating the address families (IPv6 and IPv4) in the resolver order
+        """
+        families = dict()  # family -> addresses, in the order of the first address of each family
+        for (family, type, proto, canonname, address) in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+            candidate = (family, address)
+            if candidate not in families.setdefault(family, list()):
+                families[family].append(candidate)
+
+        candidates = [candidate for group in itertools.zip_longest(*families.values())
+                      for candidate in group if candidate is not None]
+
+        with self.lock:
+            last = self.addresses.get((host, port))
+        if last in candidates:
+            candidates.remove(last)
+            candidates.insert(0, last)
+
+        return candidates
+
+    def open_socket(self, host, port):
+        """
+        Connect a TCP socket to the server, and return it.  Raise socket.error on failure or timeout
+        An attempt is started on the next address each time the previous ones fail or do not answer in time,
+        and the first connection established is kept (RFC 8305), so a dead address costs only the attempt delay
+        The name resolution counts in the timeout, but a blocked resolver is not interrupted (socket.getaddrinfo)
+        """
+        deadline = time.monotonic() + self.connect_timeout
+        candidates = self.get_addresses(host, port)
+        next_attempt = 0  # time to start an attempt on the next address
+        error = None
+
+        selector = selectors.DefaultSelector()
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise socket.timeout("connection to %s timed out" % host)
+
+                if candidates and (now >= next_attempt or not selector.get_map()):
+                    (family, address) = candidates.pop(0)
+                    std_sock = socket.socket(family, socket.SOCK_STREAM)
+                    std_sock.setblocking(False)
+                    result = std_sock.connect_ex(address)
+                    if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        selector.register(std_sock, selectors.EVENT_WRITE, (family, address))
+                        next_attempt = now + self.attempt_delay
+                    else:
+                        std_sock.close()
+                        error = socket.error(result, os.strerror(result))
+                    continue
+
+                if not selector.get_map():  # every address failed
+                    raise error if error is not None else socket.error("no address for %s" % host)
+
+                timeout = deadline - now
+                if candidates:
+                    timeout = min(timeout, next_attempt - now)
+
+                for (key, mask) in selector.select(timeout):
+                    std_sock = key.fileobj
+                    selector.unregister(std_sock)
+
+                    result = std_sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if result == 0:
+                        with self.lock:
+                            self.addresses[(host, port)] = key.data
+                        std_sock.setblocking(True)
+                        return std_sock
+
+                    std_sock.close()
+                    error = socket.error(result, os.strerror(result))
+                    next_attempt = now  # no need to wait for this one, try the next address
+        finally:
+            for key in list(selector.get_map().values()):  # the attempts still running
+                key.fileobj.close()
+            selector.close()
+
+    def save_session(self, host, port, certfile, keyfile, control_socket):
+        """
+        Keep the TLS session of a connection, to resume it at the next connection
+        To be called again before closing: with TLS 1.3, the session ticket comes after the handshake
+        """
+        try:
+            session = control_socket.session
+        except (AttributeError, ValueError):  # not an SSL socket, or already closed
+            return
+
+        if session is not None:
+            with self.lock:
+                self.sessions[(host, port, certfile, keyfile)] = session
+
+
+default_connector = Connector()  # shared by the connections of the process, unless replaced
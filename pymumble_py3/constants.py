@@ -8,11 +8,37 @@ PYMUMBLE_VERSION = "0.2.1"
 # ============================================================================
 # Tunable parameters
 # ============================================================================
-PYMUMBLE_CONNECTION_RETRY_INTERVAL = 10  # in sec
+PYMUMBLE_CONNECTION_RETRY_INTERVAL = 10  # maximum delay between 2 connection attempts, in sec
+PYMUMBLE_CONNECTION_RETRY_MIN_INTERVAL = 0.5  # delay before the first reconnection attempt, doubled after each failure, in sec
+PYMUMBLE_CONNECT_TIMEOUT = 10  # maximum time to open the TCP connection, all the server addresses included, in sec
+PYMUMBLE_HANDSHAKE_TIMEOUT = 10  # maximum time for the TLS handshake, in sec
+PYMUMBLE_CONNECT_ATTEMPT_DELAY = 0.25  # delay before trying the next server address while the previous one does not answer, in sec
 PYMUMBLE_AUDIO_PER_PACKET = float(20)/1000  # size of one audio packet in sec
+PYMUMBLE_OPUS_FRAME_SIZE = float(20)/1000  # default size of the encoded frames in sec, several of them can make a packet
+PYMUMBLE_AUTO_AUDIO_PER_PACKET = (0.01, 0.02, 0.04, 0.06)  # packet sizes chosen from the bandwidth, the shortest first, in sec
+PYMUMBLE_AUTO_MAX_OVERHEAD = 0.25  # part of the bandwidth the protocol headers may use, for the automatic packet size
+PYMUMBLE_BITRATE_CONTROL_INTERVAL = 0.5  # interval between 2 decisions of the bitrate controller, in sec
+PYMUMBLE_BITRATE_QUEUE_DELAY_HIGH = 0.1  # time to send the data queued on the control connection making it congested, in sec
+PYMUMBLE_BITRATE_QUEUE_DELAY_LOW = 0.02  # time to send the data queued on the control connection making it uncongested, in sec
+PYMUMBLE_BITRATE_RTT_INFLATION_HIGH = 100  # round-trip time above the lowest one making the link congested, in ms
+PYMUMBLE_BITRATE_RTT_INFLATION_LOW = 30  # round-trip time above the lowest one making the link uncongested, in ms
+PYMUMBLE_BITRATE_DECREASE = 0.75  # factor applied to the audio bandwidth on congestion
+PYMUMBLE_BITRATE_INCREASE = 0.05  # part of the allowed bandwidth added at each decision without congestion
+PYMUMBLE_BITRATE_INCREASE_DELAY = 5  # time without congestion after a decrease before increasing again, in sec
+PYMUMBLE_BITRATE_MIN = 12000  # lowest audio bandwidth set by the bitrate controller, in bit/s
 PYMUMBLE_BANDWIDTH = 50 * 1000  # total outgoing bitrate in bit/seconds
-PYMUMBLE_LOOP_RATE = 0.01  # pause done between two iteration of the main loop of the mumble thread, in sec
-                           # should be small enough to manage the audio output, so smaller than PYMUMBLE_AUDIO_PER_PACKET
+PYMUMBLE_SOUND_OUTPUT_CAPACITY = 10  # size of the outgoing audio buffer, in sec (it grows if needed, by default)
+PYMUMBLE_AUDIO_PACER_SPIN = 0.001  # time before an audio deadline the pacer thread polls the clock instead of sleeping, in sec
+PYMUMBLE_OVERFLOW_BLOCK_CHECK = 0.1  # interval at which add_sound, blocked on a full buffer, checks the audio is still sent, in sec
+PYMUMBLE_STREAM_LOOKAHEAD = 0.2  # audio read ahead from a stream played by SoundOutput.play, in sec
+PYMUMBLE_STREAM_CHUNK = 0.02  # audio read at once from a file object played by SoundOutput.play, in sec
+PYMUMBLE_RESAMPLER_TAPS = 64  # length of the resampling filter, in input samples (more is sharper but slower)
+PYMUMBLE_RESAMPLER_CUTOFF = 0.9  # cutoff of the resampling filter, relative to the lowest of the Nyquist frequencies
+PYMUMBLE_NOISE_GATE_THRESHOLD = -50  # level of the outgoing audio opening the noise gate, in dBFS
+PYMUMBLE_NOISE_GATE_ATTACK = 0.005  # fade in of the audio when the noise gate opens, in sec
+PYMUMBLE_NOISE_GATE_HANGOVER = 0.3  # quiet audio still sent before the noise gate closes, in sec
+PYMUMBLE_LOOP_RATE = 1  # maximum pause between two iterations of the main loop of the mumble thread, in sec
+                        # the loop is woken up by the sockets, the commands, the outgoing audio and the scheduled tasks
 
 # ============================================================================
 # Constants
@@ -23,12 +49,21 @@ PYMUMBLE_OS_STRING = "PyMumble %s" % PYMUMBLE_VERSION
 PYMUMBLE_OS_VERSION_STRING = "Python %s - %s %s" % (sys.version, platform.system(), platform.release())
 
 PYMUMBLE_PING_DELAY = 10  # interval between 2 pings in sec
+PYMUMBLE_PING_TIMEOUT = 60  # time without ping response before considering the connection lost, in sec
+PYMUMBLE_PING_PENDING_MAX = 16  # pings waiting for their response that are remembered, to match the responses
+PYMUMBLE_PING_JITTER_GAIN = 1.0 / 16  # weight of a new sample in the smoothed jitter
 
 PYMUMBLE_SAMPLERATE = 48000  # in hz
 
 PYMUMBLE_SEQUENCE_DURATION = float(10)/1000  # in sec
 PYMUMBLE_SEQUENCE_RESET_INTERVAL = 5  # in sec
 PYMUMBLE_READ_BUFFER_SIZE = 4096  # how much bytes to read at a time from the control socket, in bytes
+PYMUMBLE_ASYNC_SOUND_QUEUE_SIZE = 500  # received audio frames kept for an async sound iterator before dropping the oldest
+PYMUMBLE_SEND_QUEUE_HIGH_WATER = 64 * 1024  # outgoing control queue size above which the senders must slow down, in bytes
+PYMUMBLE_UDP_BUFFER_SIZE = 2048  # maximum size of an UDP packet, in bytes
+PYMUMBLE_UDP_PING_DELAY = 5  # interval between 2 UDP pings in sec
+PYMUMBLE_UDP_TIMEOUT = 12  # time without any UDP packet before falling back to the tcp tunnel, in sec
+PYMUMBLE_CRYPT_RESYNC_DELAY = 5  # minimum time without a valid UDP packet before asking the server for a crypt resync, in sec
 
 # client connection state
 PYMUMBLE_CONN_STATE_NOT_CONNECTED = 0
@@ -72,8 +107,10 @@ PYMUMBLE_CLBK_USERCREATED = "user_created"
 PYMUMBLE_CLBK_USERUPDATED = "user_updated"
 PYMUMBLE_CLBK_USERREMOVED = "user_remove"
 PYMUMBLE_CLBK_SOUNDRECEIVED = "sound_received"
+PYMUMBLE_CLBK_ENCODEDSOUNDRECEIVED = "encoded_sound_received"
 PYMUMBLE_CLBK_TEXTMESSAGERECEIVED = "text_received"
 PYMUMBLE_CLBK_CONTEXTACTIONRECEIVED = "contextAction_received"
+PYMUMBLE_CLBK_BITRATECHANGED = "bitrate_changed"
 
 # audio types
 PYMUMBLE_AUDIO_TYPE_CELT_ALPHA = 0
@@ -82,6 +119,63 @@ PYMUMBLE_AUDIO_TYPE_SPEEX = 2
 PYMUMBLE_AUDIO_TYPE_CELT_BETA = 3
 PYMUMBLE_AUDIO_TYPE_OPUS = 4
 PYMUMBLE_AUDIO_TYPE_OPUS_PROFILE = "voip"
+PYMUMBLE_OPUS_FRAME_SIZES = (0.0025, 0.005, 0.01, 0.02, 0.04, 0.06)  # frame sizes supported by the opus encoder, in sec
+PYMUMBLE_OPUS_MAX_AUDIO_PER_PACKET = 0.12  # maximum duration of an opus packet, in sec
+PYMUMBLE_OPUS_MIN_BITRATE = 6000  # lowest bitrate of the opus encoder, in bit/s
+PYMUMBLE_VOICE_TARGET_NORMAL = 0  # target of the audio packets to the current channel
+PYMUMBLE_VOICE_TARGET_FIRST_SLOT = 1  # voice target slots registered on the server for the whispers
+PYMUMBLE_VOICE_TARGET_LAST_SLOT = 30
+PYMUMBLE_AUDIO_TERMINATOR = 0x2000  # flag of the opus size marking the last packet of a talk
+PYMUMBLE_OPUS_DTX_MAX_SIZE = 2  # opus packets up to this size are silence coded by the DTX, they are not sent
+
+# signal types of the opus encoder, a hint for its mode decisions
+PYMUMBLE_OPUS_SIGNAL_AUTO = "auto"
+PYMUMBLE_OPUS_SIGNAL_VOICE = "voice"
+PYMUMBLE_OPUS_SIGNAL_MUSIC = "music"
+
+# overflow policies of the outgoing audio buffer
+PYMUMBLE_OVERFLOW_GROW = "grow"  # enlarge the buffer
+PYMUMBLE_OVERFLOW_DROP_OLDEST = "drop_oldest"  # discard the audio that should be sent first
+PYMUMBLE_OVERFLOW_DROP_NEWEST = "drop_newest"  # discard the audio being added
+PYMUMBLE_OVERFLOW_BLOCK = "block"  # wait for the audio to be sent
+PYMUMBLE_MIXER_DEFAULT_SOURCE = "default"  # name of the mixer source fed by SoundOutput.add_sound
+PYMUMBLE_DEFAULT_SOUND_OUTPUT = "default"  # name of Mumble.sound_output among the outgoing audio streams
+
+# sample formats of the outgoing audio (same names as ffmpeg)
+PYMUMBLE_SAMPLE_FORMAT_S16LE = "s16le"  # 16 bits signed integers, the format sent to the encoder
+PYMUMBLE_SAMPLE_FORMAT_S32LE = "s32le"  # 32 bits signed integers
+PYMUMBLE_SAMPLE_FORMAT_F32LE = "f32le"  # 32 bits floats, between -1 and 1
+
+# metrics names
+PYMUMBLE_METRICS_NAMESPACE = "pymumble"  # prefix of the names in the Prometheus export
+PYMUMBLE_METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)  # histograms upper bounds, in sec
+PYMUMBLE_METRIC_MESSAGES_RECEIVED = "messages_received_total"
+PYMUMBLE_METRIC_BYTES_RECEIVED = "bytes_received_total"
+PYMUMBLE_METRIC_MESSAGES_SENT = "messages_sent_total"
+PYMUMBLE_METRIC_BYTES_SENT = "bytes_sent_total"
+PYMUMBLE_METRIC_UDP_PACKETS_RECEIVED = "udp_packets_received_total"
+PYMUMBLE_METRIC_UDP_BYTES_RECEIVED = "udp_bytes_received_total"
+PYMUMBLE_METRIC_UDP_PACKETS_SENT = "udp_packets_sent_total"
+PYMUMBLE_METRIC_UDP_BYTES_SENT = "udp_bytes_sent_total"
+PYMUMBLE_METRIC_LOOP_TIME = "loop_iteration_seconds"
+PYMUMBLE_METRIC_DISPATCH_TIME = "dispatch_seconds"
+PYMUMBLE_METRIC_ENCODE_TIME = "encode_seconds"
+PYMUMBLE_METRIC_MIX_TIME = "mix_seconds"
+PYMUMBLE_METRIC_AUDIO_DELAY = "audio_send_delay_seconds"
+PYMUMBLE_METRIC_DECODE_TIME = "decode_seconds"
+PYMUMBLE_METRIC_CALLBACK_TIME = "callback_seconds"
+PYMUMBLE_METRIC_COMMANDS_QUEUE = "commands_queue_length"
+PYMUMBLE_METRIC_SEND_QUEUE = "send_queue_bytes"
+PYMUMBLE_METRIC_SOUND_OUTPUT_QUEUE = "sound_output_queue_seconds"
+PYMUMBLE_METRIC_SOUND_OUTPUT_DROPPED = "sound_output_dropped_seconds_total"
+PYMUMBLE_METRIC_SOUND_QUEUE = "sound_queue_length"
+PYMUMBLE_METRIC_PING_RTT = "ping_rtt_seconds"
+PYMUMBLE_METRIC_PING_JITTER = "ping_jitter_seconds"
+PYMUMBLE_METRIC_AUDIO_BITRATE = "audio_bitrate_bits_per_second"
+
+# reactor timer actions
+PYMUMBLE_REACTOR_ACTION_TASKS = "tasks"
+PYMUMBLE_REACTOR_ACTION_CONNECT = "connect"
 
 # command names
 PYMUMBLE_CMD_MOVE = "move"
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+import struct
+import time
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.backends import default_backend
+except ImportError:  # UDP audio will not be available, the TCP tunnel is used instead
+    Cipher = None
+
+from .constants import *
+
+AES_BLOCK_SIZE = 16
+
+
+def is_crypto_available():
+    """Return True if the AES implementation needed for the UDP audio is available"""
+    return Cipher is not None
+
+
+def xor(a, b):
+    """XOR two 16 bytes blocks"""
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(AES_BLOCK_SIZE, 'big')
+
+
+def s2(block):
+    """Multiply a block by x in GF(2^128), as done in OCB2"""
+    value = int.from_bytes(block, 'big')
+    carry = value >> 127
+    value = ((value << 1) & ((1 << 128) - 1)) ^ (carry * 0x87)
+    return value.to_bytes(AES_BLOCK_SIZE, 'big')
+
+
+def s3(block):
+    """Multiply a block by x+1 in GF(2^128), as done in OCB2"""
+    return xor(block, s2(block))
+
+
+class CryptStateOCB2:
+    """
+    Encryption state of the UDP audio channel, OCB2-AES128 as implemented in Mumble.
+    Keeps track of the nonces on both directions and of the good/late/lost packets statistics
+    """
+
+    def __init__(self):
+        self.raw_key = None
+        self.encrypt_iv = bytearray(AES_BLOCK_SIZE)
+        self.decrypt_iv = bytearray(AES_BLOCK_SIZE)
+        self.decrypt_history = bytearray(256)
+
+        self.encryptor = None
+        self.decryptor = None
+
+        self.good = 0  # packets correctly decrypted
+        self.late = 0  # packets received out of order
+        self.lost = 0  # packets never received
+        self.resync = 0  # number of nonce resynchronisations requested by the server
+
+        self.last_good = 0  # time of the last correctly decrypted packet
+        self.last_request = 0  # time of the last resync request sent to the server
+
+    def is_valid(self):
+        """Return True when a key has been received from the server"""
+        return self.raw_key is not None
+
+    def set_key(self, key, client_nonce, server_nonce):
+        """Set the key and the nonces received in a CryptSetup message"""
+        if len(key) != AES_BLOCK_SIZE or len(client_nonce) != AES_BLOCK_SIZE or len(server_nonce) != AES_BLOCK_SIZE:
+            raise ValueError("Invalid key or nonce length")
+
+        self.raw_key = bytes(key)
+        self.encrypt_iv = bytearray(client_nonce)
+        self.decrypt_iv = bytearray(server_nonce)
+        self.decrypt_history = bytearray(256)
+
+        cipher = Cipher(algorithms.AES(self.raw_key), modes.ECB(), backend=default_backend())
+        self.encryptor = cipher.encryptor()
+        self.decryptor = cipher.decryptor()
+
+        self.last_good = time.time()
+
+    def set_decrypt_iv(self, server_nonce):
+        """Resynchronize the decryption nonce, as sent by the server"""
+        if len(server_nonce) != AES_BLOCK_SIZE:
+            raise ValueError("Invalid nonce length")
+        self.decrypt_iv = bytearray(server_nonce)
+        self.resync += 1
+
+    def get_encrypt_iv(self):
+        """Return the current encryption nonce, to be sent to the server when it ask for a resync"""
+        return bytes(self.encrypt_iv)
+
+    def need_resync(self):
+        """Check if no packet could be decrypted for a while, and a resync was not requested lately"""
+        current_time = time.time()
+        if self.last_good + PYMUMBLE_CRYPT_RESYNC_DELAY <= current_time and self.last_request + PYMUMBLE_CRYPT_RESYNC_DELAY <= current_time:
+            self.last_request = current_time
+            return True
+        return False
+
+    def encrypt(self, source):
+        """Encrypt a UDP packet, returning the data to send including the 4 bytes crypto header"""
+        for i in range(AES_BLOCK_SIZE):  # increment the nonce
+            self.encrypt_iv[i] = (self.encrypt_iv[i] + 1) & 0xFF
+            if self.encrypt_iv[i]:
+                break
+
+        encrypted, tag = self.ocb_encrypt(source, bytes(self.encrypt_iv))
+
+        return bytes((self.encrypt_iv[0],)) + tag[:3] + encrypted
+
+    def decrypt(self, source):
+        """Decrypt a UDP packet.  Return None if the packet is not valid"""
+        if len(source) < 4:
+            return None
+
+        saveiv = bytes(self.decrypt_iv)
+        ivbyte = source[0]
+        restore = False
+        late = 0
+        lost = 0
+
+        if ((self.decrypt_iv[0] + 1) & 0xFF) == ivbyte:  # in order as expected
+            if ivbyte > self.decrypt_iv[0]:
+                self.decrypt_iv[0] = ivbyte
+            elif ivbyte < self.decrypt_iv[0]:
+                self.decrypt_iv[0] = ivbyte
+                self._increment_iv(self.decrypt_iv)
+            else:
+                return None
+        else:  # out of order or repeated
+            diff = ivbyte - self.decrypt_iv[0]
+            if diff > 128:
+                diff -= 256
+            elif diff < -128:
+                diff += 256
+
+            if ivbyte < self.decrypt_iv[0] and -30 < diff < 0:  # late packet, but no wraparound
+                late = 1
+                lost = -1
+                self.decrypt_iv[0] = ivbyte
+                restore = True
+            elif ivbyte > self.decrypt_iv[0] and -30 < diff < 0:  # late packet from the previous round
+                late = 1
+                lost = -1
+                self.decrypt_iv[0] = ivbyte
+                for i in range(1, AES_BLOCK_SIZE):
+                    self.decrypt_iv[i] = (self.decrypt_iv[i] - 1) & 0xFF
+                    if self.decrypt_iv[i] != 0xFF:
+                        break
+                restore = True
+            elif ivbyte > self.decrypt_iv[0] and diff > 0:  # lost a few packets
+                lost = ivbyte - self.decrypt_iv[0] - 1
+                self.decrypt_iv[0] = ivbyte
+            elif ivbyte < self.decrypt_iv[0] and diff > 0:  # lost a few packets and wrapped around
+                lost = 256 - self.decrypt_iv[0] + ivbyte - 1
+                self.decrypt_iv[0] = ivbyte
+                self._increment_iv(self.decrypt_iv)
+            else:
+                return None
+
+            if self.decrypt_history[self.decrypt_iv[0]] == self.decrypt_iv[1]:  # replayed packet
+                self.decrypt_iv[:] = saveiv
+                return None
+
+        plain, tag = self.ocb_decrypt(source[4:], bytes(self.decrypt_iv))
+
+        if plain is None or tag[:3] != bytes(source[1:4]):
+            self.decrypt_iv[:] = saveiv
+            return None
+
+        self.decrypt_history[self.decrypt_iv[0]] = self.decrypt_iv[1]
+
+        if restore:
+            self.decrypt_iv[:] = saveiv
+
+        self.good += 1
+        self.late += late
+        self.lost = max(0, self.lost + lost)  # a late packet was counted as lost, never below 0 (uint32 in Ping)
+        self.last_good = time.time()
+
+        return plain
+
+    @staticmethod
+    def _increment_iv(iv):
+        """Carry the increment of the first byte of a nonce on the following ones"""
+        for i in range(1, AES_BLOCK_SIZE):
+            iv[i] = (iv[i] + 1) & 0xFF
+            if iv[i]:
+                break
+
+    def _aes_encrypt(self, block):
+        return self.encryptor.update(block)
+
+    def _aes_decrypt(self, block):
+        return self.decryptor.update(block)
+
+    def ocb_encrypt(self, plain, nonce):
+        """OCB2 encryption of a buffer.  Return the encrypted data and the full tag"""
+        encrypted = bytearray(len(plain))
+        delta = self._aes_encrypt(nonce)
+        checksum = bytes(AES_BLOCK_SIZE)
+        pos = 0
+        length = len(plain)
+
+        while length - pos > AES_BLOCK_SIZE:
+            block = bytes(plain[pos:pos + AES_BLOCK_SIZE])
+
+            # counter-cryptanalysis described in section 9 of https://eprint.iacr.org/2019/311
+            # the second to last block of an attack would be all 0 except the last byte: alter it like Mumble does
+            flip_a_bit = length - pos - AES_BLOCK_SIZE <= AES_BLOCK_SIZE and not any(block[:-1])
+
+            delta = s2(delta)
+            tmp = xor(delta, block)
+            if flip_a_bit:
+                tmp = bytes((tmp[0] ^ 1,)) + tmp[1:]
+            encrypted[pos:pos + AES_BLOCK_SIZE] = xor(delta, self._aes_encrypt(tmp))
+            checksum = xor(checksum, block)
+            if flip_a_bit:
+                checksum = bytes((checksum[0] ^ 1,)) + checksum[1:]
+            pos += AES_BLOCK_SIZE
+
+        remaining = length - pos
+        delta = s2(delta)
+        pad = self._aes_encrypt(xor(delta, struct.pack("!QQ", 0, remaining * 8)))
+        block = bytes(plain[pos:]) + pad[remaining:]
+        checksum = xor(checksum, block)
+        encrypted[pos:] = xor(pad, block)[:remaining]
+
+        delta = s3(delta)
+        tag = self._aes_encrypt(xor(delta, checksum))
+
+        return bytes(encrypted), tag
+
+    def ocb_decrypt(self, encrypted, nonce):
+        """OCB2 decryption of a buffer.  Return the decrypted data (None if refused) and the full tag"""
+        plain = bytearray(len(encrypted))
+        delta = self._aes_encrypt(nonce)
+        checksum = bytes(AES_BLOCK_SIZE)
+        pos = 0
+        length = len(encrypted)
+
+        while length - pos > AES_BLOCK_SIZE:
+            delta = s2(delta)
+            block = xor(delta, self._aes_decrypt(xor(delta, bytes(encrypted[pos:pos + AES_BLOCK_SIZE]))))
+            plain[pos:pos + AES_BLOCK_SIZE] = block
+            checksum = xor(checksum, block)
+            pos += AES_BLOCK_SIZE
+
+        remaining = length - pos
+        delta = s2(delta)
+        pad = self._aes_encrypt(xor(delta, struct.pack("!QQ", 0, remaining * 8)))
+        block = xor(bytes(encrypted[pos:]) + bytes(AES_BLOCK_SIZE - remaining), pad)
+        checksum = xor(checksum, block)
+        plain[pos:] = block[:remaining]
+
+        # counter-cryptanalysis described in section 9 of https://eprint.iacr.org/2019/311
+        refused = block[:AES_BLOCK_SIZE - 1] == delta[:AES_BLOCK_SIZE - 1]
+
+        delta = s3(delta)
+        tag = self._aes_encrypt(xor(delta, checksum))
+
+        if refused:
+            return None, tag
+
+        return bytes(plain), tag
@@ -89,3 +89,13 @@ class ImageTooBigError(Exception):
 
     def __str__(self):
         return 'Maximum Text/Image allowed length: {}'.format(self.value)
+
+
+class VoiceTargetSlotsFullError(Exception):
+    """Thrown when a whisper needs a voice target slot while all of them are used by the sound outputs"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -84,7 +84,7 @@ class RemoveChannel(Cmd):
 
 
 class VoiceTarget(Cmd):
-    """Command to create a whisper"""
+    """Command to register a whisper in a voice target slot, targets=list of WhisperTarget"""
 
     def __init__(self, voice_id, targets):
         Cmd.__init__(self)
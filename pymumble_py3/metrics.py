@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import threading
+import bisect
+
+from .constants import *
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+class Histogram:
+    """Distribution of measured values, counted in fixed buckets"""
+
+    def __init__(self, buckets=PYMUMBLE_METRICS_BUCKETS):
+        self.buckets = buckets  # upper bounds of the buckets, the last one (+Inf) is implicit
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Return the histogram as a dict, the buckets being cumulative like in Prometheus"""
+        cumulative = list()
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+
+        return {"count": self.count,
+                "sum": self.sum,
+                "buckets": dict(zip(self.buckets + (float("inf"),), cumulative))}
+
+
+class Metrics:
+    """
+    Measurements of a Mumble connection: counters, histograms and gauges.
+    A metric can have one label, its values are then kept per label value (like the message type).
+    The counters and histograms are kept over the reconnections, the gauges are read when a snapshot is taken
+    """
+
+    def __init__(self, namespace=PYMUMBLE_METRICS_NAMESPACE, constant_labels=None):
+        """
+        namespace=prefix of the metrics names in the Prometheus export
+        constant_labels=dict of labels added to every metric in the Prometheus export, to identify the connection
+        """
+        self.namespace = namespace
+        self.constant_labels = dict(constant_labels or {})
+
+        self.lock = threading.Lock()  # the metrics are updated from the library thread and the application ones
+
+        self.definitions = dict()  # name -> (kind, description, label name)
+        self.values = dict()  # name -> {label value: number or Histogram}, None being the value of metrics without label
+        self.gauges = dict()  # name -> function returning the current value(s)
+
+    def add_counter(self, name, description, label=None):
+        """Declare a counter, a value that only increases"""
+        self.definitions[name] = (COUNTER, description, label)
+        self.values.setdefault(name, dict())
+
+    def add_histogram(self, name, description, label=None):
+        """Declare a histogram, to follow the distribution of durations"""
+        self.definitions[name] = (HISTOGRAM, description, label)
+        self.values.setdefault(name, dict())
+
+    def add_gauge(self, name, description, function, label=None):
+        """
+        Declare a gauge, read by calling function when a snapshot is taken.  Replace any previous function
+        The function returns a number, or a dict {label value: number} if the gauge has a label
+        """
+        self.definitions[name] = (GAUGE, description, label)
+        self.gauges[name] = function
+
+    def inc(self, name, value=1, label=None):
+        """Increment a counter"""
+        with self.lock:
+            values = self.values[name]
+            values[label] = values.get(label, 0) + value
+
+    def observe(self, name, value, label=None):
+        """Add a measure to a histogram"""
+        with self.lock:
+            values = self.values[name]
+            histogram = values.get(label)
+            if histogram is None:
+                histogram = values[label] = Histogram()
+            histogram.observe(value)
+
+    def reset(self):
+        """Set all the counters and histograms back to zero"""
+        with self.lock:
+            for values in self.values.values():
+                values.clear()
+
+    def snapshot(self):
+        """
+        Return the current value of every metric, as a dict {name: value}
+        The value of a labelled metric is a dict {label value: value},
+        and the value of a histogram is a dict with "count", "sum" and the cumulative "buckets"
+        """
+        result = dict()
+
+        with self.lock:
+            for (name, values) in self.values.items():
+                (kind, description, label) = self.definitions[name]
+                values = {key: (value.snapshot() if kind == HISTOGRAM else value) for (key, value) in values.items()}
+                if label is not None:
+                    result[name] = values
+                elif kind == HISTOGRAM:
+                    result[name] = values.get(None, Histogram().snapshot())
+                else:
+                    result[name] = values.get(None, 0)
+
+        for (name, function) in list(self.gauges.items()):
+            result[name] = function()
+
+        return result
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        return prometheus_text([self])
+
+
+def format_labels(labels):
+    """Format a list of (name, value) as Prometheus labels"""
+    if not labels:
+        return ""
+    escaped = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (name, value) in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def prometheus_text(registries):
+    """
+    Return the metrics of several Metrics objects in one Prometheus text export,
+    typically the connections of a same process, told apart by their constant labels
+    """
+    families = dict()  # full name -> (kind, description, samples lines), the samples of a metric must be grouped
+
+    for metrics in registries:
+        constant_labels = sorted(metrics.constant_labels.items())
+
+        for (name, value) in metrics.snapshot().items():
+            (kind, description, label) = metrics.definitions[name]
+            full_name = metrics.namespace + "_" + name if metrics.namespace else name
+            samples = families.setdefault(full_name, (kind, description, list()))[2]
+
+            values = value.items() if label is not None else [(None, value)]
+            for (label_value, value) in sorted(values, key=lambda item: str(item[0])):
+                labels = constant_labels + ([(label, label_value)] if label is not None else [])
+
+                if kind == HISTOGRAM:
+                    for (bound, count) in value["buckets"].items():
+                        bucket_labels = labels + [("le", "+Inf" if bound == float("inf") else repr(bound))]
+                        samples.append("%s_bucket%s %i" % (full_name, format_labels(bucket_labels), count))
+                    samples.append("%s_sum%s %r" % (full_name, format_labels(labels), value["sum"]))
+                    samples.append("%s_count%s %i" % (full_name, format_labels(labels), value["count"]))
+                else:
+                    samples.append("%s%s %r" % (full_name, format_labels(labels), value))
+
+    lines = list()
+    for (full_name, (kind, description, samples)) in families.items():
+        lines.append("# HELP %s %s" % (full_name, description))
+        lines.append("# TYPE %s %s" % (full_name, kind))
+        lines.extend(samples)
+
+    return "\n".join(lines) + "\n"
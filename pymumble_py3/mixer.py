@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from .constants import *
+from .pcmbuffer import PCMBuffer
+
+try:
+    import numpy
+except ImportError:  # optional, only needed to mix several sources
+    numpy = None
+
+
+class MixerSource:
+    """
+    One named source of outgoing audio, with its own buffer, mixed with the other sources before the encoding.
+    While a source plays, the sources of lower priority are attenuated by its ducking factor
+    """
+
+    def __init__(self, sound_output, name, buffer, gain=1.0, priority=0, ducking=1.0):
+        """
+        sound_output=SoundOutput sending the mixed audio
+        buffer=PCMBuffer holding the audio of the source
+        gain=volume factor of the source
+        priority=sources of lower priority are ducked while this one plays
+        ducking=factor applied to the volume of the sources of lower priority while this one plays (1.0=no ducking)
+        """
+        self.sound_output = sound_output
+        self.name = name
+        self.buffer = buffer
+        self.gain = gain
+        self.priority = priority
+        self.ducking = ducking
+
+    def add_sound(self, pcm, sample_rate=PYMUMBLE_SAMPLERATE, channels=1, sample_format=PYMUMBLE_SAMPLE_FORMAT_S16LE):
+        """add sound to this source, in any format like SoundOutput.add_sound"""
+        self.sound_output.add_to_buffer(self.buffer, pcm, sample_rate, channels, sample_format)
+
+    def clear_buffer(self):
+        self.buffer.clear()
+
+    def get_buffer_size(self):
+        """return the size of the unsent buffer of this source in sec"""
+        return len(self.buffer) / 2. / PYMUMBLE_SAMPLERATE
+
+    def set_gain(self, gain):
+        self.gain = gain
+
+    def set_priority(self, priority, ducking=None):
+        self.priority = priority
+        if ducking is not None:
+            self.ducking = ducking
+
+
+class Mixer:
+    """
+    Mix the audio of several sources into the frames given to the encoder: one stream leaves the client.
+    The frames of all the playing sources are mixed in one vectorized operation (float32, clipped to int16),
+    so the cost hardly depends on the number of sources.  A gain change is ramped over a frame to avoid clicks
+    """
+
+    def __init__(self, sound_output):
+        """sound_output=SoundOutput sending the mixed audio, its buffer is the default source (SoundOutput.add_sound)"""
+        if numpy is None:
+            raise ImportError("numpy is required to mix several audio sources")
+
+        self.lock = threading.Lock()
+        self.sound_output = sound_output
+        self.sources = {PYMUMBLE_MIXER_DEFAULT_SOURCE: MixerSource(sound_output, PYMUMBLE_MIXER_DEFAULT_SOURCE, sound_output.pcm)}
+
+        self.samples = 0  # frame size the arrays are allocated for, in samples
+        self.frames = None  # one row of float32 samples per source
+        self.output = None  # mixed frame, handed to the encoder
+        self.ramp = None  # 0 to 1 over a frame, to interpolate the gains
+        self.last_gains = dict()  # name -> gain applied at the end of the last frame
+
+    def add_source(self, name, gain=1.0, priority=0, ducking=1.0, capacity=PYMUMBLE_SOUND_OUTPUT_CAPACITY,
+                   overflow=PYMUMBLE_OVERFLOW_GROW):
+        """create a new source, or return the existing one with this name"""
+        with self.lock:
+            source = self.sources.get(name)
+            if source is None:
+                buffer = PCMBuffer(int(capacity * PYMUMBLE_SAMPLERATE) * 2, overflow)
+                source = self.sources[name] = MixerSource(self.sound_output, name, buffer, gain, priority, ducking)
+            return source
+
+    def get_source(self, name):
+        """return a source by its name, raise KeyError if it does not exist"""
+        with self.lock:
+            return self.sources[name]
+
+    def remove_source(self, name):
+        """remove a source and discard its audio.  The default source cannot be removed"""
+        if name == PYMUMBLE_MIXER_DEFAULT_SOURCE:
+            raise KeyError(name)
+        with self.lock:
+            del self.sources[name]
+            self.last_gains.pop(name, None)
+
+    def get_sources(self):
+        with self.lock:
+            return list(self.sources.values())
+
+    def is_audio(self):
+        """return True if a source has audio waiting"""
+        return any(source.buffer for source in self.get_sources())
+
+    def get_buffer_size(self):
+        """return the duration of the mixed audio waiting in sec, which is the one of the longest source"""
+        return max(source.get_buffer_size() for source in self.get_sources())
+
+    def clear(self):
+        for source in self.get_sources():
+            source.clear_buffer()
+
+    def get_gains(self, playing):
+        """return the gain of each playing source, its own gain ducked by the playing sources of higher priority"""
+        gains = list()
+        for source in playing:
+            ducking = min([other.ducking for other in playing if other.priority > source.priority], default=1.0)
+            gains.append(source.gain * ducking)
+        return gains
+
+    def allocate(self, samples, sources):
+        self.samples = samples
+        self.frames = numpy.zeros((sources, samples), dtype=numpy.float32)
+        self.output = numpy.zeros(samples, dtype=numpy.int16)
+        self.ramp = numpy.linspace(0, 1, samples, endpoint=False, dtype=numpy.float32)
+
+    def mix(self, size):
+        """
+        Take the next size bytes of every playing source, and return the mixed frame, or None if there is no audio
+        The returned memoryview is valid until the next call
+        """
+        frames = list()
+        playing = list()
+        for source in self.get_sources():
+            frame = source.buffer.take(size)  # padded with silence if needed
+            if frame is not None:
+                frames.append(frame)
+                playing.append(source)
+
+        if not playing:
+            return None
+
+        gains = self.get_gains(playing)
+        if len(playing) == 1 and gains[0] == 1.0 and self.last_gains.get(playing[0].name, 1.0) == 1.0:
+            self.last_gains = {playing[0].name: 1.0}
+            return frames[0]  # nothing to mix
+
+        samples = size // 2
+        if samples != self.samples or len(playing) > len(self.frames):
+            self.allocate(samples, max(len(playing), len(self.sources)))
+
+        for (row, frame) in enumerate(frames):  # converted to float32 while copied in the preallocated rows
+            self.frames[row] = numpy.frombuffer(frame, dtype="<i2")
+        rows = self.frames[:len(playing)]
+
+        target = numpy.array(gains, dtype=numpy.float32)
+        start = numpy.array([self.last_gains.get(source.name, gain) for (source, gain) in zip(playing, gains)],
+                            dtype=numpy.float32)
+        if numpy.array_equal(start, target):
+            mixed = target @ rows
+        else:  # interpolate the gains over the frame
+            mixed = ((start[:, None] + (target - start)[:, None] * self.ramp) * rows).sum(axis=0)
+        self.last_gains = {source.name: gain for (source, gain) in zip(playing, gains)}
+
+        numpy.clip(mixed, -32768, 32767, out=mixed)
+        numpy.copyto(self.output, mixed, casting="unsafe")
+        return memoryview(self.output).cast("B")
@@ -2,7 +2,8 @@
 import threading
 import logging
 import time
-import select
+import random
+import selectors
 import socket
 import ssl
 import struct
@@ -16,14 +17,54 @@ from . import commands
 from . import callbacks
 from . import tools
 from . import soundoutput
+from . import soundqueue
+from . import crypto
+from . import metrics
+from . import pingstats
+from . import bitratecontroller
+from . import voicetargets
+from . import connector
+from . import servercache
 
 from . import mumble_pb2
 
-
-class Mumble(threading.Thread):
+from collections import deque
+
+MESSAGE_CLASSES = {  # protobuf definition of each control message type
+    PYMUMBLE_MSG_TYPES_VERSION: mumble_pb2.Version,
+    PYMUMBLE_MSG_TYPES_AUTHENTICATE: mumble_pb2.Authenticate,
+    PYMUMBLE_MSG_TYPES_PING: mumble_pb2.Ping,
+    PYMUMBLE_MSG_TYPES_REJECT: mumble_pb2.Reject,
+    PYMUMBLE_MSG_TYPES_SERVERSYNC: mumble_pb2.ServerSync,
+    PYMUMBLE_MSG_TYPES_CHANNELREMOVE: mumble_pb2.ChannelRemove,
+    PYMUMBLE_MSG_TYPES_CHANNELSTATE: mumble_pb2.ChannelState,
+    PYMUMBLE_MSG_TYPES_USERREMOVE: mumble_pb2.UserRemove,
+    PYMUMBLE_MSG_TYPES_USERSTATE: mumble_pb2.UserState,
+    PYMUMBLE_MSG_TYPES_BANLIST: mumble_pb2.BanList,
+    PYMUMBLE_MSG_TYPES_TEXTMESSAGE: mumble_pb2.TextMessage,
+    PYMUMBLE_MSG_TYPES_PERMISSIONDENIED: mumble_pb2.PermissionDenied,
+    PYMUMBLE_MSG_TYPES_ACL: mumble_pb2.ACL,
+    PYMUMBLE_MSG_TYPES_QUERYUSERS: mumble_pb2.QueryUsers,
+    PYMUMBLE_MSG_TYPES_CRYPTSETUP: mumble_pb2.CryptSetup,
+    PYMUMBLE_MSG_TYPES_CONTEXTACTIONMODIFY: mumble_pb2.ContextActionModify,
+    PYMUMBLE_MSG_TYPES_CONTEXTACTION: mumble_pb2.ContextAction,
+    PYMUMBLE_MSG_TYPES_USERLIST: mumble_pb2.UserList,
+    PYMUMBLE_MSG_TYPES_VOICETARGET: mumble_pb2.VoiceTarget,
+    PYMUMBLE_MSG_TYPES_PERMISSIONQUERY: mumble_pb2.PermissionQuery,
+    PYMUMBLE_MSG_TYPES_CODECVERSION: mumble_pb2.CodecVersion,
+    PYMUMBLE_MSG_TYPES_USERSTATS: mumble_pb2.UserStats,
+    PYMUMBLE_MSG_TYPES_REQUESTBLOB: mumble_pb2.RequestBlob,
+    PYMUMBLE_MSG_TYPES_SERVERCONFIG: mumble_pb2.ServerConfig,
+}
+
+MESSAGE_NAMES = {type: message_class.__name__ for (type, message_class) in MESSAGE_CLASSES.items()}  # used in the metrics
+MESSAGE_NAMES[PYMUMBLE_MSG_TYPES_UDPTUNNEL] = "UDPTunnel"
+
+
+class MumbleProtocol:
     """
-    Mumble client library main object.
-    basically a thread
+    Mumble client protocol: the connection state, the users, channels and sound objects, the control messages
+    and the scheduled tasks.  Run in its own thread by Mumble, in a Reactor, or on an asyncio event loop by AsyncMumble
     """
 
     def __init__(self, host, user, port=64738, password='', certfile=None, keyfile=None, reconnect=False, tokens=[], debug=False):
@@ -38,20 +79,18 @@ class Mumble(threading.Thread):
         tokens=channel access tokens as a list of strings
         debug=if True, send debugging messages (lot of...) to the stdout
         """
-        # TODO: use UDP audio
-        threading.Thread.__init__(self)
-
         self.Log = logging.getLogger("PyMumble")  # logging object for errors and debugging
         if debug:
             self.Log.setLevel(logging.DEBUG)
         else:
             self.Log.setLevel(logging.ERROR)
 
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s-%(name)s-%(levelname)s-%(message)s')
-        ch.setFormatter(formatter)
-        self.Log.addHandler(ch)
+        if not self.Log.handlers:  # the logger is shared by all the connections, add the handler only once
+            ch = logging.StreamHandler()
+            ch.setLevel(logging.DEBUG)
+            formatter = logging.Formatter('%(asctime)s-%(name)s-%(levelname)s-%(message)s')
+            ch.setFormatter(formatter)
+            self.Log.addHandler(ch)
 
         self.parent_thread = threading.current_thread()  # main thread of the calling application
         self.mumble_thread = None  # thread of the mumble client library
@@ -63,7 +102,8 @@ class Mumble(threading.Thread):
         self.certfile = certfile
         self.keyfile = keyfile
         self.reconnect = reconnect
-        self.ping_stats = {"last_rcv": 0, "time_send": 0, "nb": 0, "avg": 40.0, "var": 0.0}
+        self.ping_interval = PYMUMBLE_PING_DELAY  # interval between 2 pings on the control connection
+        self.udp_ping_interval = PYMUMBLE_UDP_PING_DELAY  # interval between 2 pings on the UDP channel
         self.tokens = tokens
         self.__opus_profile = PYMUMBLE_AUDIO_TYPE_OPUS_PROFILE
 
@@ -73,365 +113,819 @@ class Mumble(threading.Thread):
 
         self.application = PYMUMBLE_VERSION_STRING
 
-        self.callbacks = callbacks.CallBacks()  # callbacks management
+        self.metrics = metrics.Metrics(constant_labels={"host": host, "user": user})  # measurements of the hot paths
+
+        self.callbacks = callbacks.CallBacks(self.metrics)  # callbacks management
+
+        # kept over the reconnections
+        self.users = users.Users(self, self.callbacks)  # contains the server's connected users information
+        self.channels = channels.Channels(self, self.callbacks)  # contains the server's channels information
+        self.blobs = blobs.Blobs(self)  # manage the blob objects
+        self.bandwidth = PYMUMBLE_BANDWIDTH  # total outgoing bandwidth, shared by the sound outputs
+        self.voice_targets = voicetargets.VoiceTargets(self)  # whisper targets registered in the server slots
+        self.sound_output = soundoutput.SoundOutput(self, PYMUMBLE_AUDIO_PER_PACKET, PYMUMBLE_BANDWIDTH, opus_profile=self.__opus_profile)  # manage the outgoing sounds
+        self.sound_outputs = {PYMUMBLE_DEFAULT_SOUND_OUTPUT: self.sound_output}  # name -> SoundOutput, each a stream of its own
+        self.sound_outputs_lock = threading.Lock()
+        self.bitrate_controller = bitratecontroller.BitrateController(self)  # adapts the audio bitrate to the congestion, if enabled
+        self.commands = commands.Commands(self.wakeup)  # manage commands sent between the main and the mumble threads
+        self.ping_stats = pingstats.PingStats()  # round-trip time on the control connection, reset for each connection
+        self.udp_ping_stats = pingstats.PingStats()  # round-trip time on the UDP channel, reset for each connection
+
+        self.connector = connector.default_connector  # opens the TLS connections, resuming the previous sessions
+        self.server_cache = None  # optional on-disk cache of the server information, see set_server_cache
+
+        self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED  # reset for each connection, set here for the audio pacer started before
+        self.udp_active = False  # reset for each connection, set here for the sound output configured before
+        self.connected_once = False  # True when a connection has been fully established, the next failures are retried
+        self.connection_attempts = 0  # failed attempts since the last established connection, for the backoff
+
+        self.init_metrics()
+
+        self.message_handlers_lock = threading.Lock()
+        self.message_handlers = {  # functions called for each control message type, the others are not even parsed
+            PYMUMBLE_MSG_TYPES_UDPTUNNEL: [self.sound_received],  # audio encapsulated in control message
+            PYMUMBLE_MSG_TYPES_PING: [self.ping_response],
+            PYMUMBLE_MSG_TYPES_REJECT: [self.connection_rejected],
+            PYMUMBLE_MSG_TYPES_SERVERSYNC: [self.server_sync],
+            PYMUMBLE_MSG_TYPES_CHANNELREMOVE: [self.channel_remove],
+            PYMUMBLE_MSG_TYPES_CHANNELSTATE: [self.channel_state],
+            PYMUMBLE_MSG_TYPES_USERREMOVE: [self.user_remove],
+            PYMUMBLE_MSG_TYPES_USERSTATE: [self.user_state],
+            PYMUMBLE_MSG_TYPES_TEXTMESSAGE: [self.text_message],
+            PYMUMBLE_MSG_TYPES_CRYPTSETUP: [self.crypt_setup],
+            PYMUMBLE_MSG_TYPES_CONTEXTACTIONMODIFY: [self.context_action_modify],
+            PYMUMBLE_MSG_TYPES_CODECVERSION: [self.codec_version],
+            PYMUMBLE_MSG_TYPES_SERVERCONFIG: [self.server_config],
+        }
 
         self.ready_lock = threading.Lock()  # released when the connection is fully established with the server
         self.ready_lock.acquire()
 
+        self.selector = None  # wait for the sockets activity in the main loop
+        self.reactor = None  # Reactor hosting the connection, when not run in its own thread
+        self.wakeup_reader = None  # used by other threads to interrupt the main loop wait, created with the loop
+        self.wakeup_writer = None
+
+        self.send_queue_high_water = PYMUMBLE_SEND_QUEUE_HIGH_WATER  # outgoing queue size above which the callers are asked to slow down
+        self.send_lock = threading.Lock()  # protect the outgoing queue, filled from any thread
+        self.udp_lock = threading.Lock()  # protect the UDP encryption, the audio may be sent from the pacer thread
+        self.send_queue = deque()  # data waiting to be written on the control socket, reset for each connection
+        self.send_queue_size = 0  # size in bytes of the data waiting in the outgoing queue
+
     def init_connection(self):
         """Initialize variables that are local to a connection, (needed if the client automatically reconnect)"""
         self.ready_lock.acquire(False)  # reacquire the ready-lock in case of reconnection
 
         self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
         self.control_socket = None
-        self.media_socket = None  # Not implemented - for UDP media
+        self.media_socket = None  # UDP socket for the audio, created when the server send the crypt keys
+        self.crypt = crypto.CryptStateOCB2()  # encryption of the UDP audio
 
-        self.bandwidth = PYMUMBLE_BANDWIDTH  # reset the outgoing bandwidth to it's default before connecting
         self.server_max_bandwidth = None
-        self.udp_active = False
+        self.udp_active = False  # True when the UDP audio channel is working, otherwise the tcp tunnel is used
+        self.set_bandwidth(PYMUMBLE_BANDWIDTH)  # reset the outgoing bandwidth to it's default before connecting
+        self.bitrate_controller.reset()
+        self.udp_last_receive = 0  # time of the last valid UDP packet received
+        self.udp_last_ping = 0  # time of the last UDP ping sent
+        self.last_ping = 0  # time of the last ping sent on the control connection
+        self.ping_stats = pingstats.PingStats()  # round-trip time on the control connection
+        self.udp_ping_stats = pingstats.PingStats()  # round-trip time on the UDP channel
 
         # defaults according to https://wiki.mumble.info/wiki/Murmur.ini
         self.server_allow_html = True
         self.server_max_message_length = 5000
         self.server_max_image_message_length = 131072
-
-        self.users = users.Users(self, self.callbacks)  # contains the server's connected users information
-        self.channels = channels.Channels(self, self.callbacks)  # contains the server's channels information
-        self.blobs = blobs.Blobs(self)  # manage the blob objects
-        self.sound_output = soundoutput.SoundOutput(self, PYMUMBLE_AUDIO_PER_PACKET, self.bandwidth, opus_profile=self.__opus_profile)  # manage the outgoing sounds
-        self.commands = commands.Commands()  # manage commands sent between the main and the mumble threads
-
-        self.receive_buffer = bytes()  # initialize the control connection input buffer
-
-    def run(self):
-        """Connect to the server and start the loop in its thread.  Retry if requested"""
-        self.mumble_thread = threading.current_thread()
-
-        # loop if auto-reconnect is requested
-        while True:
-            self.init_connection()  # reset the connection-specific object members
-
-            if self.connect() >= PYMUMBLE_CONN_STATE_FAILED:  # some error occurred, exit here
-                self.ready_lock.release()
-                raise ConnectionRejectedError ("Connection error with the Mumble (murmur) Server")
-                break
-
-            try:
-                self.loop()
-            except socket.error:
-                self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
-
-            if not self.reconnect or not self.parent_thread.is_alive():
-                break
-
-            time.sleep(PYMUMBLE_CONNECTION_RETRY_INTERVAL)
+        self.load_server_cache()
+
+        # the users and channels are kept, and compared with the new server state once it is complete
+        self.users.start_resync()
+        self.channels.start_resync()
+
+        self.receive_buffer = bytearray(PYMUMBLE_READ_BUFFER_SIZE * 4)  # initialize the control connection input buffer
+        self.receive_start = 0  # position of the first unread byte in the input buffer
+        self.receive_end = 0  # position after the last received byte in the input buffer
+
+        self.send_queue = deque()  # data waiting to be written on the control socket
+        self.send_queue_size = 0  # size in bytes of the data waiting in the outgoing queue
+        self.control_events = selectors.EVENT_READ  # events currently watched on the control socket
+
+    def init_metrics(self):
+        """Declare the metrics of the connection"""
+        self.metrics.add_counter(PYMUMBLE_METRIC_MESSAGES_RECEIVED, "Control messages received", label="type")
+        self.metrics.add_counter(PYMUMBLE_METRIC_BYTES_RECEIVED, "Bytes of control messages received, headers included", label="type")
+        self.metrics.add_counter(PYMUMBLE_METRIC_MESSAGES_SENT, "Control messages sent", label="type")
+        self.metrics.add_counter(PYMUMBLE_METRIC_BYTES_SENT, "Bytes of control messages sent, headers included", label="type")
+        self.metrics.add_counter(PYMUMBLE_METRIC_UDP_PACKETS_RECEIVED, "Packets received on the UDP audio channel")
+        self.metrics.add_counter(PYMUMBLE_METRIC_UDP_BYTES_RECEIVED, "Bytes received on the UDP audio channel")
+        self.metrics.add_counter(PYMUMBLE_METRIC_UDP_PACKETS_SENT, "Packets sent on the UDP audio channel")
+        self.metrics.add_counter(PYMUMBLE_METRIC_UDP_BYTES_SENT, "Bytes sent on the UDP audio channel")
+        self.metrics.add_histogram(PYMUMBLE_METRIC_LOOP_TIME, "Time spent working in a main loop iteration, without the wait")
+        self.metrics.add_histogram(PYMUMBLE_METRIC_DISPATCH_TIME, "Time to handle a received control message, the callbacks included")
+        self.metrics.add_histogram(PYMUMBLE_METRIC_ENCODE_TIME, "Time to encode an outgoing audio frame")
+        self.metrics.add_histogram(PYMUMBLE_METRIC_MIX_TIME, "Time to mix the sources of an outgoing audio frame")
+        self.metrics.add_histogram(PYMUMBLE_METRIC_AUDIO_DELAY, "Delay between the time an audio packet is due and the time it is sent")
+        self.metrics.add_histogram(PYMUMBLE_METRIC_DECODE_TIME, "Time to decode a received audio frame")
+        self.metrics.add_histogram(PYMUMBLE_METRIC_CALLBACK_TIME, "Time spent in the application callbacks", label="callback")
+        self.metrics.add_counter(PYMUMBLE_METRIC_SOUND_OUTPUT_DROPPED, "Outgoing audio discarded because the buffer was full")
+
+        # queues depths, read when a snapshot is taken
+        self.metrics.add_gauge(PYMUMBLE_METRIC_COMMANDS_QUEUE, "Commands waiting to be sent to the server",
+                               lambda: len(self.commands.queue))
+        self.metrics.add_gauge(PYMUMBLE_METRIC_SEND_QUEUE, "Bytes waiting to be written on the control connection",
+                               self.get_send_queue_size)
+        self.metrics.add_gauge(PYMUMBLE_METRIC_SOUND_OUTPUT_QUEUE, "Audio waiting to be encoded and sent",
+                               lambda: {name: output.get_buffer_size() for (name, output) in self.get_sound_outputs().items()},
+                               label="output")
+        self.metrics.add_gauge(PYMUMBLE_METRIC_SOUND_QUEUE, "Received audio chunks waiting in the users sound queues",
+                               lambda: {session: len(user.sound.queue) for (session, user) in list(self.users.items())},
+                               label="session")
+        self.metrics.add_gauge(PYMUMBLE_METRIC_PING_RTT, "Mean round-trip time to the server",
+                               lambda: {"tcp": self.ping_stats.avg / 1000, "udp": self.udp_ping_stats.avg / 1000},
+                               label="channel")
+        self.metrics.add_gauge(PYMUMBLE_METRIC_PING_JITTER, "Smoothed variation of the round-trip time to the server",
+                               lambda: {"tcp": self.ping_stats.jitter / 1000, "udp": self.udp_ping_stats.jitter / 1000},
+                               label="channel")
+        self.metrics.add_gauge(PYMUMBLE_METRIC_AUDIO_BITRATE, "Bitrate of the audio encoders, adapted to the congestion if enabled",
+                               lambda: {name: output.get_bitrate() or 0 for (name, output) in self.get_sound_outputs().items()},
+                               label="output")
+
+    def is_retrying(self):
+        """Return True if a failed connection attempt must be retried: the server was reached before, it may be restarting"""
+        return self.reconnect and self.connected_once
+
+    def get_reconnect_delay(self):
+        """Return the time to wait before the next connection attempt: exponential backoff, with jitter to spread the clients"""
+        delay = min(PYMUMBLE_CONNECTION_RETRY_MIN_INTERVAL * 2 ** self.connection_attempts, PYMUMBLE_CONNECTION_RETRY_INTERVAL)
+        self.connection_attempts += 1
+        return random.uniform(delay / 2, delay)
 
     def connect(self):
         """Connect to the server"""
-         # Get IPv4/IPv6 server address
-        server_info = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        self.Log.debug("connecting to %s on port %i.", self.host, self.port)
 
         # Connect the SSL tunnel
-        self.Log.debug("connecting to %s (%s) on port %i.", self.host, server_info[0][1], self.port)
-        std_sock = socket.socket(server_info[0][0], socket.SOCK_STREAM)
-
         try:
-            self.control_socket = ssl.wrap_socket(std_sock, certfile=self.certfile, keyfile=self.keyfile, ssl_version=ssl.PROTOCOL_TLS)
-        except AttributeError:
-            self.control_socket = ssl.wrap_socket(std_sock, certfile=self.certfile, keyfile=self.keyfile, ssl_version=ssl.PROTOCOL_TLSv1)
+            self.control_socket = self.connector.connect(self.host, self.port, self.certfile, self.keyfile)
+        except socket.error as e:
+            self.Log.debug("connection failed: %s", e)
+            self.connected = PYMUMBLE_CONN_STATE_FAILED
+            return self.connected
+
+        self.Log.debug("TLS session %s", "resumed" if self.control_socket.session_reused else "negotiated")
+
         try:
-            self.control_socket.connect((self.host, self.port))
             self.control_socket.setblocking(0)
-
-            # Perform the Mumble authentication
-            version = mumble_pb2.Version()
-            version.version = (PYMUMBLE_PROTOCOL_VERSION[0] << 16) + (PYMUMBLE_PROTOCOL_VERSION[1] << 8) + PYMUMBLE_PROTOCOL_VERSION[2]
-            version.release = self.application
-            version.os = PYMUMBLE_OS_STRING
-            version.os_version = PYMUMBLE_OS_VERSION_STRING
-            self.Log.debug("sending: version: %s", version)
-            self.send_message(PYMUMBLE_MSG_TYPES_VERSION, version)
-
-            authenticate = mumble_pb2.Authenticate()
-            authenticate.username = self.user
-            authenticate.password = self.password
-            authenticate.tokens.extend(self.tokens)
-            authenticate.opus = True
-            self.Log.debug("sending: authenticate: %s", authenticate)
-            self.send_message(PYMUMBLE_MSG_TYPES_AUTHENTICATE, authenticate)
+            self.authenticate()
         except socket.error:
+            self.control_socket.close()
             self.connected = PYMUMBLE_CONN_STATE_FAILED
             return self.connected
 
         self.connected = PYMUMBLE_CONN_STATE_AUTHENTICATING
         return self.connected
 
+    def authenticate(self):
+        """Perform the Mumble authentication on a freshly opened control connection"""
+        version = mumble_pb2.Version()
+        version.version = (PYMUMBLE_PROTOCOL_VERSION[0] << 16) + (PYMUMBLE_PROTOCOL_VERSION[1] << 8) + PYMUMBLE_PROTOCOL_VERSION[2]
+        version.release = self.application
+        version.os = PYMUMBLE_OS_STRING
+        version.os_version = PYMUMBLE_OS_VERSION_STRING
+        self.Log.debug("sending: version: %s", version)
+        self.send_message(PYMUMBLE_MSG_TYPES_VERSION, version)
+
+        authenticate = mumble_pb2.Authenticate()
+        authenticate.username = self.user
+        authenticate.password = self.password
+        authenticate.tokens.extend(self.tokens)
+        authenticate.opus = True
+        self.Log.debug("sending: authenticate: %s", authenticate)
+        self.send_message(PYMUMBLE_MSG_TYPES_AUTHENTICATE, authenticate)
+
     def loop(self):
         """
         Main loop
-        waiting for a message from the server for maximum self.loop_rate time
+        waiting for a socket activity, a wakeup from another thread or the next scheduled task
         take care of sending the ping
         take care of sending the queued commands to the server
-        check on every iteration for outgoing sound 
+        take care of sending the outgoing sound on time
         check for disconnection
         """
         self.Log.debug("entering loop")
 
-        last_ping = time.time()  # keep track of the last ping time
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(0)
+        self.wakeup_writer.setblocking(0)
+
+        selector = selectors.DefaultSelector()  # epoll on Linux
+        selector.register(self.wakeup_reader, selectors.EVENT_READ, (self, self.clear_wakeup))
+        self.attach(selector)
 
         # loop as long as the connection and the parent thread are alive
-        while self.connected not in (PYMUMBLE_CONN_STATE_NOT_CONNECTED, PYMUMBLE_CONN_STATE_FAILED) and self.parent_thread.is_alive():
-            if last_ping + PYMUMBLE_PING_DELAY <= time.time():  # when it is time, send the ping
-                self.ping()
-                last_ping = time.time()
+        try:
+            while self.connected not in (PYMUMBLE_CONN_STATE_NOT_CONNECTED, PYMUMBLE_CONN_STATE_FAILED) and self.parent_thread.is_alive():
+                iteration_start = time.perf_counter()
 
-            if self.connected == PYMUMBLE_CONN_STATE_CONNECTED:
-                while self.commands.is_cmd():
-                    self.treat_command(self.commands.pop_cmd())  # send the commands coming from the application to the server
+                self.run_scheduled_tasks()
+                self.flush_send_queue()  # data may have been queued from other threads
+                self.update_control_events()
 
-                self.sound_output.send_audio()  # send outgoing audio if available
+                wait_start = time.perf_counter()
+                events = selector.select(self.get_loop_timeout())  # wait for a socket activity
+                wait = time.perf_counter() - wait_start
 
-            (rlist, wlist, xlist) = select.select([self.control_socket], [], [self.control_socket], self.loop_rate)  # wait for a socket activity
+                for (key, mask) in events:
+                    (session, handler) = key.data
+                    handler(mask)  # call the handler registered for the socket
 
-            if self.control_socket in rlist:  # something to be read on the control socket
-                self.read_control_messages()
-            elif self.control_socket in xlist:  # socket was closed
-                self.control_socket.close()
-                self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+                self.metrics.observe(PYMUMBLE_METRIC_LOOP_TIME, time.perf_counter() - iteration_start - wait)
+        finally:  # also on a connection error, to keep the state of the connection for the next one
+            self.detach()
+            selector.close()
+
+            wakeup_reader, wakeup_writer = self.wakeup_reader, self.wakeup_writer
+            self.wakeup_reader = self.wakeup_writer = None
+            wakeup_reader.close()
+            wakeup_writer.close()
+
+    def attach(self, selector):
+        """
+        Start watching the connection sockets with a selector, which can be shared with other connections
+        The data registered with each socket is a (Mumble object, handler(events mask)) tuple
+        """
+        self.last_ping = time.time()  # keep track of the last ping time
+
+        self.selector = selector
+        self.control_events = selectors.EVENT_READ
+        self.selector.register(self.control_socket, self.control_events, (self, self.control_socket_event))
+
+    def detach(self):
+        """Stop watching the connection sockets and close them"""
+        self.close_media_socket()
+        self.selector.unregister(self.control_socket)
+        self.selector = None
+        self.save_connection_state()
+        self.control_socket.close()
+
+    def save_connection_state(self):
+        """Keep what will speed up the next connection: the TLS session and the server cache"""
+        self.connector.save_session(self.host, self.port, self.certfile, self.keyfile, self.control_socket)
+        self.save_server_cache()
+
+    def set_server_cache(self, path):
+        """
+        Keep the server configuration, codec and blobs in a file, to start the next runs with them.  None to disable
+        Must be done before the start()
+        """
+        if path is None:
+            self.server_cache = None
+        else:
+            self.server_cache = servercache.ServerCache(path)
+
+    def load_server_cache(self):
+        """Start the connection with what was saved of the server during a previous run"""
+        if self.server_cache is None:
+            return
+
+        entry = self.server_cache.load(self.host, self.port)
+
+        self.server_allow_html = entry.get("allow_html", self.server_allow_html)
+        self.server_max_message_length = entry.get("message_length", self.server_max_message_length)
+        self.server_max_image_message_length = entry.get("image_message_length", self.server_max_image_message_length)
+
+        if "codec" in entry and self.sound_output.codec is None:  # the audio can be prepared before the server confirms it
+            try:
+                self.set_default_codec(mumble_pb2.CodecVersion(**entry["codec"]))
+            except (TypeError, ValueError, CodecNotSupportedError):
+                self.Log.debug("invalid codec in the server cache: %s", entry["codec"])
+
+        self.blobs.update(servercache.decode_blobs(entry.get("blobs", dict())))  # will not be requested to the server
+
+    def save_server_cache(self):
+        """Save what is known of the server, for the next runs"""
+        if self.server_cache is None:
+            return
+
+        entry = {"allow_html": self.server_allow_html,
+                 "message_length": self.server_max_message_length,
+                 "image_message_length": self.server_max_image_message_length,
+                 "blobs": servercache.encode_blobs(self.blobs)}
+
+        codec = self.sound_output.codec
+        if codec is not None:
+            entry["codec"] = {"alpha": codec.alpha, "beta": codec.beta, "prefer_alpha": codec.prefer_alpha, "opus": codec.opus}
+
+        try:
+            self.server_cache.save(self.host, self.port, entry)
+        except OSError as e:
+            self.Log.error("cannot write the server cache %s: %s", self.server_cache.path, e)
+
+    def run_scheduled_tasks(self):
+        """Do what is due in the main loop: pings, commands and outgoing audio"""
+        if self.last_ping + self.ping_interval <= time.time():  # when it is time, send the ping
+            self.ping()
+            self.last_ping = time.time()
+
+        if self.media_socket is not None and self.udp_last_ping + self.udp_ping_interval <= time.time():
+            self.udp_ping()  # keep the UDP channel alive and check if it's working
+
+        if self.udp_active and self.udp_last_receive + PYMUMBLE_UDP_TIMEOUT <= time.time():
+            self.Log.debug("UDP audio channel timed out, falling back to tcp tunnel")
+            self.set_udp_active(False)
+
+        if self.connected == PYMUMBLE_CONN_STATE_CONNECTED:
+            while self.commands.is_cmd():
+                self.treat_command(self.commands.pop_cmd())  # send the commands coming from the application to the server
+
+            next_update = self.bitrate_controller.get_next_update()
+            if next_update is not None and next_update <= time.time():
+                self.bitrate_controller.update()
+
+            for sound_output in self.get_sound_outputs().values():  # the packets of the streams interleave on time
+                sound_output.send_audio()  # send outgoing audio if available
+
+    def get_loop_timeout(self):
+        """Return how long the main loop can wait before the next scheduled task, at most self.loop_rate"""
+        deadlines = [self.last_ping + self.ping_interval]
+
+        if self.media_socket is not None:
+            deadlines.append(self.udp_last_ping + self.udp_ping_interval)
+        if self.udp_active:
+            deadlines.append(self.udp_last_receive + PYMUMBLE_UDP_TIMEOUT)
+        if self.connected == PYMUMBLE_CONN_STATE_CONNECTED and not self.is_audio_congested():  # otherwise wait for the socket to drain
+            for sound_output in self.get_sound_outputs().values():
+                audio_deadline = sound_output.get_next_deadline()
+                if audio_deadline is not None:
+                    deadlines.append(audio_deadline)
+        if self.connected == PYMUMBLE_CONN_STATE_CONNECTED:
+            next_update = self.bitrate_controller.get_next_update()
+            if next_update is not None:
+                deadlines.append(next_update)
+
+        return max(0, min(min(deadlines) - time.time(), self.loop_rate))
+
+    def wakeup(self):
+        """Interrupt the wait of the main loop, when something must be treated.  Can be called from any thread"""
+        if self.reactor is not None:
+            self.reactor.wakeup(self)
+            return
+
+        wakeup_writer = self.wakeup_writer
+        if wakeup_writer is None:  # loop not running, it will check for work when it starts
+            return
+
+        try:
+            wakeup_writer.send(b'\x00')
+        except socket.error:  # the socket is full of pending wakeups already, or just closed
+            pass
+
+    def clear_wakeup(self, mask):
+        """Empty the wakeup socket, the main loop being awake now"""
+        try:
+            while self.wakeup_reader.recv(PYMUMBLE_READ_BUFFER_SIZE):
+                pass
+        except socket.error:
+            pass
+
+    def control_socket_event(self, mask):
+        """Handle an activity on the control socket"""
+        if mask & selectors.EVENT_WRITE:
+            self.flush_send_queue()
+        if mask & selectors.EVENT_READ:
+            self.read_control_messages()
+
+    def update_control_events(self):
+        """Watch the control socket for writability only when there is something waiting to be sent"""
+        events = selectors.EVENT_READ
+        if self.send_queue:
+            events |= selectors.EVENT_WRITE
+
+        if events != self.control_events:
+            self.selector.modify(self.control_socket, events, (self, self.control_socket_event))
+            self.control_events = events
+
+    def media_socket_event(self, mask):
+        """Handle an activity on the UDP socket"""
+        if mask & selectors.EVENT_READ:
+            self.read_media_messages()
 
     def ping(self):
         """Send the keepalive through available channels"""
         ping = mumble_pb2.Ping()
-        ping.timestamp = int(time.time())
-        ping.tcp_ping_avg = self.ping_stats['avg']
-        ping.tcp_ping_var = self.ping_stats['var']
-        ping.tcp_packets = self.ping_stats['nb']
+        ping.timestamp = self.ping_stats.sent()  # echoed by the server, to match the response
+
+        # statistics of the UDP packets received from the server, for the server side connection information
+        ping.good = self.crypt.good
+        ping.late = self.crypt.late
+        ping.lost = max(0, self.crypt.lost)
+        ping.resync = self.crypt.resync
+
+        ping.udp_packets = self.udp_ping_stats.nb
+        ping.udp_ping_avg = self.udp_ping_stats.avg
+        ping.udp_ping_var = self.udp_ping_stats.var
+        ping.tcp_packets = self.ping_stats.nb
+        ping.tcp_ping_avg = self.ping_stats.avg
+        ping.tcp_ping_var = self.ping_stats.var
 
         self.Log.debug("sending: ping: %s", ping)
         self.send_message(PYMUMBLE_MSG_TYPES_PING, ping)
-        self.ping_stats['time_send'] = int(time.time() * 1000)
-        self.Log.debug(self.ping_stats['last_rcv'])
-        if self.ping_stats['last_rcv'] != 0 and int(time.time() * 1000) > self.ping_stats['last_rcv'] + (60 * 1000):
+
+        if self.ping_stats.last_receive != 0 and time.time() > self.ping_stats.last_receive + PYMUMBLE_PING_TIMEOUT:
             self.Log.debug("Ping too long ! Disconnected ?")
             self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
 
     def ping_response(self, mess):
-        self.ping_stats['last_rcv'] = int(time.time() * 1000)
-        ping = int(time.time() * 1000) - self.ping_stats['time_send']
-        old_avg = self.ping_stats['avg']
-        nb = self.ping_stats['nb']
-        new_avg = ((self.ping_stats['avg'] * nb) + ping) / (nb + 1)
+        """Measure the round-trip time of the control connection, from the echoed timestamp"""
+        rtt = self.ping_stats.received(mess.timestamp)
+        if rtt is None:
+            self.Log.debug("ping response not matching any sent ping: %s", mess.timestamp)
 
-        try:
-            self.ping_stats['var'] = self.ping_stats['var'] + pow(old_avg - new_avg, 2) + (1 / nb) * pow(ping - new_avg, 2)
-        except ZeroDivisionError:
-            pass
+    def set_ping_interval(self, interval, udp_interval=None):
+        """
+        Set in sec the interval between 2 pings on the control connection, and on the UDP channel
+        (by default the same, but at most PYMUMBLE_UDP_PING_DELAY, to detect a broken UDP channel in time)
+        """
+        self.ping_interval = interval
+        if udp_interval is None:
+            udp_interval = min(interval, PYMUMBLE_UDP_PING_DELAY)
+        self.udp_ping_interval = udp_interval
+        self.wakeup()  # the next ping may be due sooner
 
-        self.ping_stats['avg'] = new_avg
-        self.ping_stats['nb'] += 1
+    def get_ping_interval(self):
+        """Return the interval between 2 pings on the control connection"""
+        return self.ping_interval
 
     def send_message(self, type, message):
-        """Send a control message to the server"""
+        """
+        Send a control message to the server
+        Return False if the outgoing queue is above its high-water mark (the message is queued anyway)
+        """
         packet = struct.pack("!HL", type, message.ByteSize()) + message.SerializeToString()
+        self.Log.debug("sending message")
+        self.count_sent_message(type, len(packet))
+        return self.send_data(packet)
+
+    def count_sent_message(self, type, size):
+        """Update the metrics of the outgoing control messages"""
+        name = MESSAGE_NAMES.get(type, str(type))
+        self.metrics.inc(PYMUMBLE_METRIC_MESSAGES_SENT, label=name)
+        self.metrics.inc(PYMUMBLE_METRIC_BYTES_SENT, size, label=name)
+
+    def send_data(self, packet):
+        """
+        Queue raw data for the control socket and send what is possible without blocking.  Can be called from any thread
+        Return False if the outgoing queue is above its high-water mark
+        """
+        with self.send_lock:
+            self.send_queue.append(packet)
+            self.send_queue_size += len(packet)
+
+        if self.mumble_thread is threading.current_thread():
+            self.flush_send_queue()
+        else:  # the socket belongs to the mumble thread
+            self.wakeup()
+
+        return not self.is_send_queue_full()
+
+    def flush_send_queue(self):
+        """Write as much as possible of the outgoing queue on the control socket, without blocking"""
+        with self.send_lock:
+            while self.send_queue:
+                data = self.send_queue[0]
+                try:
+                    sent = self.control_socket.send(data)
+                except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):  # kernel buffer is full
+                    break
 
-        while len(packet) > 0:
-            self.Log.debug("sending message")
-            sent = self.control_socket.send(packet)
-            if sent < 0:
-                raise socket.error("Server socket error")
-            packet = packet[sent:]
+                if sent < 0:
+                    raise socket.error("Server socket error")
+
+                if sent < len(data):
+                    self.send_queue[0] = memoryview(data)[sent:]
+                else:
+                    self.send_queue.popleft()
+                self.send_queue_size -= sent
+
+    def get_send_queue_size(self):
+        """Return the size in bytes of the data waiting to be written on the control socket"""
+        return self.send_queue_size
+
+    def is_send_queue_full(self):
+        """Return True when the outgoing queue is above its high-water mark, callers should slow down"""
+        return self.get_send_queue_size() >= self.send_queue_high_water
+
+    def set_send_queue_high_water(self, size):
+        """Set the size in bytes of the outgoing queue above which the callers are asked to slow down"""
+        self.send_queue_high_water = size
+
+    def get_send_queue_high_water(self):
+        """Return the size in bytes of the outgoing queue above which the callers are asked to slow down"""
+        return self.send_queue_high_water
 
     def read_control_messages(self):
         """Read control messages coming from the server"""
         # from tools import tohex  # for debugging
 
-        try:
-            buffer = self.control_socket.recv(PYMUMBLE_READ_BUFFER_SIZE)
-            self.receive_buffer += buffer
-        except socket.error:
-            pass
-
-        while len(self.receive_buffer) >= 6:  # header is present (type + length)
-            self.Log.debug("read control connection")
-            header = self.receive_buffer[0:6]
+        while True:  # read everything available, the SSL layer may hold more than what select() reports
+            if len(self.receive_buffer) - self.receive_end < PYMUMBLE_READ_BUFFER_SIZE:
+                self.compact_receive_buffer()
 
-            if len(header) < 6:
+            try:
+                received = self.control_socket.recv_into(memoryview(self.receive_buffer)[self.receive_end:], PYMUMBLE_READ_BUFFER_SIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):  # nothing more to read for now
                 break
-
-            (type, size) = struct.unpack("!HL", header)  # decode header
-
-            if len(self.receive_buffer) < size + 6:  # if not length data, read further
+            except socket.error as e:  # connection reset, broken pipe, SSL error
+                self.Log.debug("control connection lost: %s", e)
+                self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
                 break
 
-            # self.Log.debug("message received : " + tohex(self.receive_buffer[0:size+6]))  # for debugging
+            if received == 0:  # connection closed by the server
+                self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+                break
 
-            message = self.receive_buffer[6:size + 6]  # get the control message
-            self.receive_buffer = self.receive_buffer[size + 6:]  # remove from the buffer the read part
+            self.receive_end += received
 
-            self.dispatch_control_message(type, message)
+            while self.receive_end - self.receive_start >= 6:  # header is present (type + length)
+                self.Log.debug("read control connection")
+                (type, size) = struct.unpack_from("!HL", self.receive_buffer, self.receive_start)  # decode header
 
-    def dispatch_control_message(self, type, message):
-        """Dispatch control messages based on their type"""
-        self.Log.debug("dispatch control message")
-        if type == PYMUMBLE_MSG_TYPES_UDPTUNNEL:  # audio encapsulated in control message
-            self.sound_received(message)
+                if self.receive_end - self.receive_start < size + 6:  # if not length data, read further
+                    break
 
-        elif type == PYMUMBLE_MSG_TYPES_VERSION:
-            mess = mumble_pb2.Version()
-            mess.ParseFromString(message)
-            self.Log.debug("message: Version : %s", mess)
+                # self.Log.debug("message received : " + tohex(self.receive_buffer[self.receive_start:self.receive_start + size + 6]))  # for debugging
 
-        elif type == PYMUMBLE_MSG_TYPES_AUTHENTICATE:
-            mess = mumble_pb2.Authenticate()
-            mess.ParseFromString(message)
-            self.Log.debug("message: Authenticate : %s", mess)
+                start = self.receive_start + 6
+                self.receive_start = start + size  # remove from the buffer the read part
+                message = memoryview(self.receive_buffer)[start:start + size]  # get the control message, without copy
 
-        elif type == PYMUMBLE_MSG_TYPES_PING:
-            mess = mumble_pb2.Ping()
-            mess.ParseFromString(message)
-            self.Log.debug("message: Ping : %s", mess)
-            self.ping_response(mess)
+                self.dispatch_control_message(type, message)
 
-        elif type == PYMUMBLE_MSG_TYPES_REJECT:
-            mess = mumble_pb2.Reject()
-            mess.ParseFromString(message)
-            self.Log.debug("message: reject : %s", mess)
-            self.connected = PYMUMBLE_CONN_STATE_FAILED
-            self.ready_lock.release()
-            raise ConnectionRejectedError(mess.reason)
+            if self.receive_start == self.receive_end:  # everything was read, restart at the beginning of the buffer
+                self.receive_start = self.receive_end = 0
 
-        elif type == PYMUMBLE_MSG_TYPES_SERVERSYNC:  # this message finish the connection process
-            mess = mumble_pb2.ServerSync()
-            mess.ParseFromString(message)
-            self.Log.debug("message: serversync : %s", mess)
-            self.users.set_myself(mess.session)
-            self.server_max_bandwidth = mess.max_bandwidth
-            self.set_bandwidth(mess.max_bandwidth)
-
-            if self.connected == PYMUMBLE_CONN_STATE_AUTHENTICATING:
-                self.connected = PYMUMBLE_CONN_STATE_CONNECTED
-                self.callbacks(PYMUMBLE_CLBK_CONNECTED)
-                self.ready_lock.release()  # release the ready-lock
-
-        elif type == PYMUMBLE_MSG_TYPES_CHANNELREMOVE:
-            mess = mumble_pb2.ChannelRemove()
-            mess.ParseFromString(message)
-            self.Log.debug("message: ChannelRemove : %s", mess)
+    def compact_receive_buffer(self):
+        """Make room at the end of the input buffer, by moving the unread data at its start or by growing it"""
+        pending = self.receive_end - self.receive_start
+        unread = self.receive_buffer[self.receive_start:self.receive_end]
 
-            self.channels.remove(mess.channel_id)
+        if pending + PYMUMBLE_READ_BUFFER_SIZE > len(self.receive_buffer):  # a big message is arriving
+            # never resize in place, message views handed to the parsers may still exist
+            self.receive_buffer = bytearray(max(len(self.receive_buffer) * 2, pending + PYMUMBLE_READ_BUFFER_SIZE))
 
-        elif type == PYMUMBLE_MSG_TYPES_CHANNELSTATE:
-            mess = mumble_pb2.ChannelState()
-            mess.ParseFromString(message)
-            self.Log.debug("message: channelstate : %s", mess)
+        self.receive_buffer[:pending] = unread
+        self.receive_start = 0
+        self.receive_end = pending
 
-            self.channels.update(mess)
-
-        elif type == PYMUMBLE_MSG_TYPES_USERREMOVE:
-            mess = mumble_pb2.UserRemove()
-            mess.ParseFromString(message)
-            self.Log.debug("message: UserRemove : %s", mess)
+    def dispatch_control_message(self, type, message):
+        """
+        Dispatch control messages based on their type
+        The message is parsed only if some handler is registered for its type
+        """
+        name = MESSAGE_NAMES.get(type, str(type))
+        self.metrics.inc(PYMUMBLE_METRIC_MESSAGES_RECEIVED, label=name)
+        self.metrics.inc(PYMUMBLE_METRIC_BYTES_RECEIVED, len(message) + 6, label=name)
 
-            self.users.remove(mess)
+        handlers = self.message_handlers.get(type)
+        if not handlers:
+            self.Log.debug("message type %i ignored (%i bytes)", type, len(message))
+            return
 
-        elif type == PYMUMBLE_MSG_TYPES_USERSTATE:
-            mess = mumble_pb2.UserState()
+        start = time.perf_counter()
+        message_class = MESSAGE_CLASSES.get(type)
+        if message_class is not None:
+            mess = message_class()
             mess.ParseFromString(message)
-            self.Log.debug("message: userstate : %s", mess)
+            self.Log.debug("message: %s : %s", message_class.__name__, mess)
+        else:  # raw message, like the audio in the tcp tunnel
+            mess = message
 
-            self.users.update(mess)
+        for handler in handlers:
+            handler(mess)
+        self.metrics.observe(PYMUMBLE_METRIC_DISPATCH_TIME, time.perf_counter() - start)
 
-        elif type == PYMUMBLE_MSG_TYPES_BANLIST:
-            mess = mumble_pb2.BanList()
-            mess.ParseFromString(message)
-            self.Log.debug("message: BanList : %s", mess)
+    def add_message_handler(self, type, handler):
+        """
+        Add a function to call when a control message of a type is received.  Can be called from any thread
+        The function receives the parsed protobuf message,
+        or the raw message (only valid during the call) for types without protobuf definition like the audio tunnel
+        """
+        with self.message_handlers_lock:  # the lists are replaced, not modified, to not disturb a running dispatch
+            self.message_handlers[type] = self.message_handlers.get(type, list()) + [handler]
+
+    def remove_message_handler(self, type, handler):
+        """Remove a function previously added with add_message_handler"""
+        with self.message_handlers_lock:
+            handlers = list(self.message_handlers.get(type, list()))
+            if handler not in handlers:
+                raise UnknownCallbackError("Function not registered for message type %i." % type)
+            handlers.remove(handler)
+            self.message_handlers[type] = handlers
+
+    def get_message_handlers(self, type):
+        """Return the list of functions called for a control message type"""
+        return list(self.message_handlers.get(type, list()))
+
+    def connection_rejected(self, mess):
+        """The server refused the connection"""
+        self.connected = PYMUMBLE_CONN_STATE_FAILED
+        self.ready_lock.release()
+        raise ConnectionRejectedError(mess.reason)
+
+    def server_sync(self, mess):
+        """This message finish the connection process"""
+        self.users.set_myself(mess.session)
+        self.server_max_bandwidth = mess.max_bandwidth
+        self.set_bandwidth(mess.max_bandwidth)
+
+        # the server state is complete, what was not sent again is gone
+        self.users.end_resync()
+        self.channels.end_resync()
+
+        if self.connected == PYMUMBLE_CONN_STATE_AUTHENTICATING:
+            self.connected = PYMUMBLE_CONN_STATE_CONNECTED
+            self.connected_once = True
+            self.connection_attempts = 0
+            self.save_connection_state()
+            self.voice_targets.restore()  # the slots of the previous connection are gone
+            for sound_output in self.get_sound_outputs().values():
+                sound_output.wakeup()  # the audio added meanwhile can be sent
+            self.callbacks(PYMUMBLE_CLBK_CONNECTED)
+            self.ready_lock.release()  # release the ready-lock
+
+    def channel_state(self, mess):
+        self.channels.update(mess)
+
+    def channel_remove(self, mess):
+        self.channels.remove(mess.channel_id)
+
+    def user_state(self, mess):
+        self.users.update(mess)
+
+    def user_remove(self, mess):
+        self.users.remove(mess)
+
+    def text_message(self, mess):
+        self.callbacks(PYMUMBLE_CLBK_TEXTMESSAGERECEIVED, mess)
+
+    def context_action_modify(self, mess):
+        self.callbacks(PYMUMBLE_CLBK_CONTEXTACTIONRECEIVED, mess)
+
+    def codec_version(self, mess):
+        self.set_default_codec(mess)
+
+    def set_default_codec(self, codecversion):
+        """Give the codec requested by the server to all the sound outputs"""
+        for sound_output in self.get_sound_outputs().values():
+            sound_output.set_default_codec(codecversion)
+
+    def server_config(self, mess):
+        """Keep the server limits"""
+        for line in str(mess).split('\n'):
+            items = line.split(':')
+            if len(items) != 2:
+                continue
+            if items[0] == 'allow_html':
+                self.server_allow_html = items[1].strip() == 'true'
+            elif items[0] == 'message_length':
+                self.server_max_message_length = int(items[1].strip())
+            elif items[0] == 'image_message_length':
+                self.server_max_image_message_length = int(items[1].strip())
+
+    def crypt_setup(self, mess):
+        """Manage the keys and nonces for the UDP audio channel sent by the server"""
+        if mess.HasField("key") and mess.HasField("client_nonce") and mess.HasField("server_nonce"):  # full setup
+            if crypto.is_crypto_available():
+                self.crypt.set_key(mess.key, mess.client_nonce, mess.server_nonce)
+                self.open_media_socket()
+                self.udp_ping()
+            else:
+                self.Log.debug("no AES implementation available, keeping the audio in the tcp tunnel")
+        elif mess.HasField("server_nonce"):  # resync requested by us
+            self.crypt.set_decrypt_iv(mess.server_nonce)
+        elif self.crypt.is_valid():  # server request a resync
+            response = mumble_pb2.CryptSetup()
+            response.client_nonce = self.crypt.get_encrypt_iv()
+            self.Log.debug("sending: CryptSetup: %s", response)
+            self.send_message(PYMUMBLE_MSG_TYPES_CRYPTSETUP, response)
+
+        self.ping()
+
+    def open_media_socket(self):
+        """Create the UDP socket for the audio, toward the same address as the control connection"""
+        if self.media_socket is not None:
+            return
 
-        elif type == PYMUMBLE_MSG_TYPES_TEXTMESSAGE:
-            mess = mumble_pb2.TextMessage()
-            mess.ParseFromString(message)
-            self.Log.debug("message: TextMessage : %s", mess)
+        try:
+            address = self.control_socket.getpeername()
+            self.media_socket = socket.socket(self.control_socket.family, socket.SOCK_DGRAM)
+            self.media_socket.setblocking(0)
+            self.media_socket.connect(address)
+            if self.selector is not None:
+                self.selector.register(self.media_socket, selectors.EVENT_READ, (self, self.media_socket_event))
+        except socket.error as e:
+            self.Log.debug("cannot open the UDP audio channel: %s", e)
+            self.close_media_socket()
+
+    def close_media_socket(self):
+        """Close the UDP socket and go back to the tcp tunnel"""
+        if self.media_socket is not None:
+            if self.selector is not None and self.media_socket in self.selector.get_map():
+                self.selector.unregister(self.media_socket)
+            self.media_socket.close()
+            self.media_socket = None
+        self.set_udp_active(False)
+
+    def set_udp_active(self, value):
+        """Switch the audio between the UDP channel and the tcp tunnel"""
+        if self.udp_active == value:
+            return
 
-            self.callbacks(PYMUMBLE_CLBK_TEXTMESSAGERECEIVED, mess)
+        self.udp_active = value
+        self.Log.debug("audio now sent through %s", "UDP" if value else "tcp tunnel")
+        self.set_bandwidth(self.bandwidth)  # the protocol overhead changed
 
-        elif type == PYMUMBLE_MSG_TYPES_PERMISSIONDENIED:
-            mess = mumble_pb2.PermissionDenied()
-            mess.ParseFromString(message)
-            self.Log.debug("message: PermissionDenied : %s", mess)
+    def udp_ping(self):
+        """Send a ping on the UDP channel.  The server echoes it, which confirms the channel is working"""
+        self.udp_last_ping = time.time()
+        if not self.crypt.is_valid():
+            return
 
-        elif type == PYMUMBLE_MSG_TYPES_ACL:
-            mess = mumble_pb2.ACL()
-            mess.ParseFromString(message)
-            self.Log.debug("message: ACL : %s", mess)
+        packet = struct.pack("!B", PYMUMBLE_AUDIO_TYPE_PING << 5) + tools.VarInt(self.udp_ping_stats.sent()).encode()
+        self.send_udp(packet)
 
-        elif type == PYMUMBLE_MSG_TYPES_QUERYUSERS:
-            mess = mumble_pb2.QueryUsers()
-            mess.ParseFromString(message)
-            self.Log.debug("message: QueryUsers : %s", mess)
+    def send_udp(self, packet):
+        """Encrypt and send a packet on the UDP channel.  Return False if it was not possible.  Can be called from any thread"""
+        media_socket = self.media_socket
+        if media_socket is None:
+            return False
 
-        elif type == PYMUMBLE_MSG_TYPES_CRYPTSETUP:
-            mess = mumble_pb2.CryptSetup()
-            mess.ParseFromString(message)
-            self.Log.debug("message: CryptSetup : %s", mess)
-            self.ping()
+        try:
+            with self.udp_lock:
+                sent = media_socket.send(self.crypt.encrypt(packet))
+            self.metrics.inc(PYMUMBLE_METRIC_UDP_PACKETS_SENT)
+            self.metrics.inc(PYMUMBLE_METRIC_UDP_BYTES_SENT, sent)
+        except BlockingIOError:  # kernel buffer full, drop the packet as UDP would do anyway
+            pass
+        except socket.error as e:
+            if media_socket is not self.media_socket:  # closed meanwhile by the library thread
+                return False
+            self.Log.debug("error while sending on the UDP channel: %s", e)
+            self.set_udp_active(False)
+            return False
 
-        elif type == PYMUMBLE_MSG_TYPES_CONTEXTACTIONMODIFY:
-            mess = mumble_pb2.ContextActionModify()
-            mess.ParseFromString(message)
-            self.Log.debug("message: ContextActionModify : %s", mess)
+        return True
 
-            self.callbacks(PYMUMBLE_CLBK_CONTEXTACTIONRECEIVED, mess)
+    def send_audio_packet(self, udppacket):
+        """
+        Send an audio packet, through the UDP channel if working, otherwise encapsulated in the tcp tunnel
+        Return False if the tcp tunnel is congested
+        """
+        if self.udp_active and self.send_udp(udppacket):
+            return True
 
-        elif type == PYMUMBLE_MSG_TYPES_CONTEXTACTION:
-            mess = mumble_pb2.ContextAction()
-            mess.ParseFromString(message)
-            self.Log.debug("message: ContextAction : %s", mess)
+        tcppacket = struct.pack("!HL", PYMUMBLE_MSG_TYPES_UDPTUNNEL, len(udppacket)) + udppacket  # encapsulate in tcp tunnel
+        self.count_sent_message(PYMUMBLE_MSG_TYPES_UDPTUNNEL, len(tcppacket))
+        return self.send_data(tcppacket)
 
-        elif type == PYMUMBLE_MSG_TYPES_USERLIST:
-            mess = mumble_pb2.UserList()
-            mess.ParseFromString(message)
-            self.Log.debug("message: UserList : %s", mess)
+    def is_audio_congested(self):
+        """Return True if the audio can't be sent right now without piling up latency in the tcp tunnel"""
+        return not self.udp_active and self.is_send_queue_full()
 
-        elif type == PYMUMBLE_MSG_TYPES_VOICETARGET:
-            mess = mumble_pb2.VoiceTarget()
-            mess.ParseFromString(message)
-            self.Log.debug("message: VoiceTarget : %s", mess)
+    def read_media_messages(self):
+        """Read and decrypt the packets coming on the UDP channel"""
+        while True:
+            try:
+                buffer = self.media_socket.recv(PYMUMBLE_UDP_BUFFER_SIZE)
+            except socket.error:
+                break
 
-        elif type == PYMUMBLE_MSG_TYPES_PERMISSIONQUERY:
-            mess = mumble_pb2.PermissionQuery()
-            mess.ParseFromString(message)
-            self.Log.debug("message: PermissionQuery : %s", mess)
+            self.metrics.inc(PYMUMBLE_METRIC_UDP_PACKETS_RECEIVED)
+            self.metrics.inc(PYMUMBLE_METRIC_UDP_BYTES_RECEIVED, len(buffer))
 
-        elif type == PYMUMBLE_MSG_TYPES_CODECVERSION:
-            mess = mumble_pb2.CodecVersion()
-            mess.ParseFromString(message)
-            self.Log.debug("message: CodecVersion : %s", mess)
+            message = self.crypt.decrypt(buffer)
 
-            self.sound_output.set_default_codec(mess)
+            if message is None:
+                self.Log.debug("invalid UDP packet received")
+                if self.crypt.need_resync():  # ask the server for new nonces
+                    self.Log.debug("sending: CryptSetup resync request")
+                    self.send_message(PYMUMBLE_MSG_TYPES_CRYPTSETUP, mumble_pb2.CryptSetup())
+                continue
 
-        elif type == PYMUMBLE_MSG_TYPES_USERSTATS:
-            mess = mumble_pb2.UserStats()
-            mess.ParseFromString(message)
-            self.Log.debug("message: UserStats : %s", mess)
+            self.udp_last_receive = time.time()
+            self.set_udp_active(True)
 
-        elif type == PYMUMBLE_MSG_TYPES_REQUESTBLOB:
-            mess = mumble_pb2.RequestBlob()
-            mess.ParseFromString(message)
-            self.Log.debug("message: RequestBlob : %s", mess)
+            if len(message) == 0:
+                continue
 
-        elif type == PYMUMBLE_MSG_TYPES_SERVERCONFIG:
-            mess = mumble_pb2.ServerConfig()
-            mess.ParseFromString(message)
-            self.Log.debug("message: ServerConfig : %s", mess)
-            for line in str(mess).split('\n'):
-                items = line.split(':')
-                if len(items) != 2:
-                    continue
-                if items[0] == 'allow_html':
-                    self.server_allow_html = items[1].strip() == 'true'
-                elif items[0] == 'message_length':
-                    self.server_max_message_length = int(items[1].strip())
-                elif items[0] == 'image_message_length':
-                    self.server_max_image_message_length = int(items[1].strip())
+            if (message[0] >> 5) == PYMUMBLE_AUDIO_TYPE_PING:  # echo of our UDP ping
+                timestamp = tools.VarInt()
+                try:
+                    timestamp.decode(message[1:11])
+                    self.udp_ping_stats.received(timestamp.value)
+                except InvalidVarInt:
+                    pass
+            else:
+                self.sound_received(message)
 
     def set_bandwidth(self, bandwidth):
         """Set the total allowed outgoing bandwidth"""
@@ -440,7 +934,53 @@ class Mumble(threading.Thread):
         else:
             self.bandwidth = bandwidth
 
-        self.sound_output.set_bandwidth(self.bandwidth)  # communicate the update to the outgoing audio manager
+        self.share_bandwidth()  # communicate the update to the outgoing audio managers
+
+    def share_bandwidth(self):
+        """Divide the outgoing bandwidth evenly between the sound outputs"""
+        sound_outputs = self.get_sound_outputs()
+        for sound_output in sound_outputs.values():
+            sound_output.set_bandwidth(self.bandwidth // len(sound_outputs))
+        self.bitrate_controller.apply_limit()  # the new shares of the adapted bandwidth
+
+    def add_sound_output(self, name, audio_per_packet=PYMUMBLE_AUDIO_PER_PACKET, capacity=PYMUMBLE_SOUND_OUTPUT_CAPACITY,
+                         overflow=PYMUMBLE_OVERFLOW_GROW):
+        """
+        Create a new stream of outgoing audio, with its own buffer, encoder, voice target and sequence,
+        or return the existing one with this name.  The streams are sent in parallel on the same connection
+        """
+        with self.sound_outputs_lock:
+            sound_output = self.sound_outputs.get(name)
+            if sound_output is not None:
+                return sound_output
+            sound_output = soundoutput.SoundOutput(self, audio_per_packet, self.bandwidth, opus_profile=self.__opus_profile,
+                                                   capacity=capacity, overflow=overflow)
+            if self.sound_output.codec is not None:
+                sound_output.set_default_codec(self.sound_output.codec)
+            self.sound_outputs[name] = sound_output
+
+        self.share_bandwidth()
+        return sound_output
+
+    def get_sound_output(self, name):
+        """Return a stream of outgoing audio by its name, raise KeyError if it does not exist"""
+        with self.sound_outputs_lock:
+            return self.sound_outputs[name]
+
+    def get_sound_outputs(self):
+        """Return a dict of the streams of outgoing audio: name -> SoundOutput"""
+        with self.sound_outputs_lock:
+            return dict(self.sound_outputs)
+
+    def remove_sound_output(self, name):
+        """Remove a stream of outgoing audio and discard its audio.  The default one cannot be removed"""
+        if name == PYMUMBLE_DEFAULT_SOUND_OUTPUT:
+            raise KeyError(name)
+        with self.sound_outputs_lock:
+            sound_output = self.sound_outputs.pop(name)
+        sound_output.set_pacer(False)
+        sound_output.clear_buffer()
+        self.share_bandwidth()
 
     def sound_received(self, message):
         """Manage a received sound message"""
@@ -486,9 +1026,13 @@ class Mumble(threading.Thread):
 
             self.Log.debug("Audio frame : time:%f, last:%s, size:%i, type:%i, target:%i, pos:%i", time.time(), str(terminator), size, type, target, pos - 1)
 
+            if size > 0 and self.callbacks.get_callback(PYMUMBLE_CLBK_ENCODEDSOUNDRECEIVED) and session.value in self.users:
+                frame = soundqueue.EncodedFrame(bytes(message[pos:pos + size]), session.value, sequence.value, type, target)
+                self.callbacks(PYMUMBLE_CLBK_ENCODEDSOUNDRECEIVED, self.users[session.value], frame)
+
             if size > 0 and self.receive_sound:  # if audio must be treated
                 try:
-                    newsound = self.users[session.value].sound.add(message[pos:pos + size],
+                    newsound = self.users[session.value].sound.add(bytes(message[pos:pos + size]),
                                                                    sequence.value,
                                                                    type,
                                                                    target)  # add the sound to the user's sound queue
@@ -515,17 +1059,19 @@ class Mumble(threading.Thread):
         self.application = string
 
     def set_loop_rate(self, rate):
-        """Set the current main loop rate (pause per iteration)"""
+        """Set the current main loop rate (maximum pause per iteration when nothing is scheduled)"""
         self.loop_rate = rate
 
     def get_loop_rate(self):
-        """Get the current main loop rate (pause per iteration)"""
+        """Get the current main loop rate (maximum pause per iteration when nothing is scheduled)"""
         return self.loop_rate
 
     def set_codec_profile(self, profile):
         """set the audio profile"""
         if profile in ["audio", "voip"]:
             self.__opus_profile = profile
+            for sound_output in self.get_sound_outputs().values():
+                sound_output.opus_profile = profile
         else:
             raise ValueError("Unknown profile: " + str(profile))
 
@@ -601,17 +1147,15 @@ class Mumble(threading.Thread):
         elif cmd.cmd == PYMUMBLE_MSG_TYPES_VOICETARGET:
             textvoicetarget = mumble_pb2.VoiceTarget()
             textvoicetarget.id = cmd.parameters["id"]
-            targets = []
-            if cmd.parameters["id"] == 1:
-                voicetarget = mumble_pb2.VoiceTarget.Target()
-                voicetarget.channel_id = cmd.parameters["targets"][0]
-                targets.append(voicetarget)
-            else:
-                for target in cmd.parameters["targets"]:
-                    voicetarget = mumble_pb2.VoiceTarget.Target()
-                    voicetarget.session.append(target)
-                    targets.append(voicetarget)
-            textvoicetarget.targets.extend(targets)
+            for target in cmd.parameters["targets"]:
+                voicetarget = textvoicetarget.targets.add()
+                voicetarget.session.extend(target.sessions)
+                if target.channel_id is not None:
+                    voicetarget.channel_id = target.channel_id
+                    voicetarget.links = target.links
+                    voicetarget.children = target.children
+                    if target.group is not None:
+                        voicetarget.group = target.group
             self.send_message(PYMUMBLE_MSG_TYPES_VOICETARGET, textvoicetarget)
             cmd.response = True
             self.commands.answer(cmd)
@@ -650,3 +1194,44 @@ class Mumble(threading.Thread):
 
     def my_channel(self):
         return self.channels[self.users.myself["channel_id"]]
+
+
+class Mumble(MumbleProtocol, threading.Thread):
+    """
+    Mumble client library main object.
+    basically a thread
+    """
+
+    def __init__(self, host, user, port=64738, password='', certfile=None, keyfile=None, reconnect=False, tokens=[], debug=False):
+        """Same parameters as MumbleProtocol"""
+        threading.Thread.__init__(self)
+        MumbleProtocol.__init__(self, host, user, port=port, password=password, certfile=certfile, keyfile=keyfile,
+                                reconnect=reconnect, tokens=tokens, debug=debug)
+
+    def run(self):
+        """Connect to the server and start the loop in its thread.  Retry if requested"""
+        self.mumble_thread = threading.current_thread()
+
+        # loop if auto-reconnect is requested
+        while True:
+            self.init_connection()  # reset the connection-specific object members
+
+            try:
+                state = self.connect()
+            except socket.error:  # name resolution failure
+                state = PYMUMBLE_CONN_STATE_FAILED
+
+            if state >= PYMUMBLE_CONN_STATE_FAILED:  # some error occurred
+                if not self.is_retrying() or not self.parent_thread.is_alive():  # exit here
+                    self.ready_lock.release()
+                    raise ConnectionRejectedError ("Connection error with the Mumble (murmur) Server")
+            else:
+                try:
+                    self.loop()
+                except socket.error:
+                    self.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+
+                if not self.reconnect or not self.parent_thread.is_alive():
+                    break
+
+            time.sleep(self.get_reconnect_delay())
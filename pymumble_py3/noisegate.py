@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import math
+
+from .constants import *
+
+try:
+    import numpy
+except ImportError:  # optional, only needed to gate the audio
+    numpy = None
+
+
+class NoiseGate:
+    """
+    Voice activity gate on the outgoing audio, ahead of the encoder: the frames quieter than a threshold are neither
+    encoded nor sent.  The gate opens on the first loud frame, fading the audio in over the attack, and closes after
+    the hangover of quiet audio, so the ends of the words and the short pauses are kept
+    """
+
+    def __init__(self, threshold=PYMUMBLE_NOISE_GATE_THRESHOLD, attack=PYMUMBLE_NOISE_GATE_ATTACK,
+                 hangover=PYMUMBLE_NOISE_GATE_HANGOVER):
+        """
+        threshold=level opening the gate, in dBFS (RMS of a frame, 0 is the loudest)
+        attack=duration of the fade in when the gate opens, in sec
+        hangover=duration of quiet audio before the gate closes, in sec
+        """
+        if numpy is None:
+            raise ImportError("numpy is required to gate the audio")
+
+        self.threshold = threshold
+        self.attack = attack
+        self.hangover = hangover
+        self.min_rms = 32768 * 10 ** (threshold / 20.)  # threshold as a linear RMS of 16 bits samples
+
+        self.open = False
+        self.opened = 0  # samples since the gate opened, for the fade in
+        self.quiet = 0  # duration of quiet audio since the last loud frame, in sec
+        self.last_level = -math.inf  # level of the last frame, in dBFS
+
+    def is_open(self):
+        return self.open
+
+    def process(self, frame, duration):
+        """
+        Measure a frame of 16 bits samples (writable bytes-like object, faded in place during the attack)
+        Return True if it must be encoded and sent.  The gate is closed after the last frame of a talk
+        """
+        samples = numpy.frombuffer(frame, dtype="<i2")
+        values = samples.astype(numpy.float32)
+        rms = math.sqrt(numpy.dot(values, values) / len(values)) if len(values) else 0.
+        self.last_level = 20 * math.log10(rms / 32768) if rms else -math.inf
+
+        if rms >= self.min_rms:
+            self.quiet = 0
+            if not self.open:
+                self.open = True
+                self.opened = 0
+        elif not self.open:
+            return False
+        else:
+            self.quiet += duration
+            if self.quiet > self.hangover:
+                self.open = False  # this quiet frame ends the talk
+
+        attack_samples = int(self.attack * PYMUMBLE_SAMPLERATE)
+        if self.opened < attack_samples:
+            gains = numpy.minimum((numpy.arange(len(samples), dtype=numpy.float32) + self.opened) / attack_samples, 1)
+            samples[:] = samples * gains
+        self.opened += len(samples)
+        return True
+
+    def reset(self):
+        self.open = False
+        self.quiet = 0
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+
+from .constants import *
+from .errors import InvalidSoundDataError
+
+OGG_PAGE_HEADER = struct.Struct("<4sBBqIIIB")  # capture pattern, version, flags, granule position, serial, page number, crc, segments
+OGG_FLAG_BOS = 0x02  # first page of a logical stream
+OPUS_HEAD = struct.Struct("<8sBBHIhB")  # magic, version, channels, pre-skip, input sample rate, output gain, mapping family
+
+SILK_FRAME_DURATIONS = (0.01, 0.02, 0.04, 0.06)  # per configuration number modulo 4, in sec
+HYBRID_FRAME_DURATIONS = (0.01, 0.02)
+CELT_FRAME_DURATIONS = (0.0025, 0.005, 0.01, 0.02)
+OPUS_MAX_PACKET_DURATION = 0.12  # in sec
+OPUS_MAX_FRAMES = 48  # frames in a packet
+
+
+def get_packet_duration(packet):
+    """Return the duration in sec of an Opus packet, read from its TOC byte (RFC 6716, section 3.1)"""
+    if len(packet) < 1:
+        raise InvalidSoundDataError("empty opus packet")
+
+    config = packet[0] >> 3
+    if config < 12:
+        frame = SILK_FRAME_DURATIONS[config % 4]
+    elif config < 16:
+        frame = HYBRID_FRAME_DURATIONS[config % 2]
+    else:
+        frame = CELT_FRAME_DURATIONS[config % 4]
+
+    code = packet[0] & 0x03  # number of frames in the packet
+    if code == 0:
+        count = 1
+    elif code < 3:
+        count = 2
+    elif len(packet) >= 2:
+        count = packet[1] & 0x3f
+    else:
+        raise InvalidSoundDataError("truncated opus packet")
+
+    return frame * count
+
+
+def read_frame_length(data, position):
+    """Read a frame length of a multi-frame packet, return (length, position after it)"""
+    if position >= len(data):
+        raise InvalidSoundDataError("truncated opus packet")
+    if data[position] < 252:
+        return (data[position], position + 1)
+    if position + 1 >= len(data):
+        raise InvalidSoundDataError("truncated opus packet")
+    return (data[position] + 4 * data[position + 1], position + 2)
+
+
+def encode_frame_length(length):
+    if length < 252:
+        return bytes((length,))
+    return bytes((252 + ((length - 252) & 3), (length - 252) >> 2))
+
+
+def get_packet_frames(packet):
+    """Split an Opus packet in its frames (RFC 6716, section 3.2), return (TOC byte without the frame count code, frames)"""
+    if len(packet) < 1:
+        raise InvalidSoundDataError("empty opus packet")
+
+    toc = packet[0]
+    code = toc & 0x03
+    data = memoryview(packet)[1:]
+
+    if code == 0:  # one frame
+        frames = [data]
+    elif code == 1:  # two frames of the same size
+        if len(data) % 2:
+            raise InvalidSoundDataError("invalid opus packet")
+        half = len(data) // 2
+        frames = [data[:half], data[half:]]
+    elif code == 2:  # two frames, the size of the first one given
+        (length, position) = read_frame_length(data, 0)
+        if position + length > len(data):
+            raise InvalidSoundDataError("truncated opus packet")
+        frames = [data[position:position + length], data[position + length:]]
+    else:  # any number of frames, with padding
+        if len(data) < 1:
+            raise InvalidSoundDataError("truncated opus packet")
+        (vbr, padded, count) = (data[0] & 0x80, data[0] & 0x40, data[0] & 0x3f)
+        position = 1
+        padding = 0
+        while padded:  # padding length, 255 means 254 and one more byte
+            if position >= len(data):
+                raise InvalidSoundDataError("truncated opus packet")
+            padding += 254 if data[position] == 255 else data[position]
+            padded = data[position] == 255
+            position += 1
+
+        if vbr:
+            lengths = list()
+            for i in range(count - 1):
+                (length, position) = read_frame_length(data, position)
+                lengths.append(length)
+            lengths.append(len(data) - padding - position - sum(lengths))
+        else:
+            lengths = [(len(data) - padding - position) // count] * count if count else []
+
+        frames = list()
+        for length in lengths:
+            if length < 0 or position + length > len(data) - padding:
+                raise InvalidSoundDataError("truncated opus packet")
+            frames.append(data[position:position + length])
+            position += length
+
+    return (toc & 0xfc, frames)
+
+
+def repacketize(packets):
+    """
+    Merge consecutive Opus packets in multi-frame packets (code 3), like the repacketizer of libopus.
+    Only frames of the same configuration (mode, bandwidth, duration, channels) can share a packet,
+    so the frames are split in several packets when the configuration changes.  Return the list of packets
+    """
+    groups = list()  # [TOC, frames, duration]
+    for packet in packets:
+        duration = get_packet_duration(packet)
+        (toc, frames) = get_packet_frames(packet)
+        if groups and groups[-1][0] == toc and groups[-1][2] + duration <= OPUS_MAX_PACKET_DURATION + 1e-9 \
+                and len(groups[-1][1]) + len(frames) <= OPUS_MAX_FRAMES:
+            groups[-1][1].extend(frames)
+            groups[-1][2] += duration
+        else:
+            groups.append([toc, list(frames), duration])
+
+    result = list()
+    for (toc, frames, duration) in groups:
+        if len(frames) == 1:
+            result.append(bytes((toc,)) + frames[0])
+        elif all(len(frame) == len(frames[0]) for frame in frames):  # constant bitrate, no lengths needed
+            result.append(bytes((toc | 3, len(frames))) + b"".join(frames))
+        else:
+            lengths = b"".join(encode_frame_length(len(frame)) for frame in frames[:-1])
+            result.append(bytes((toc | 3, 0x80 | len(frames))) + lengths + b"".join(frames))
+    return result
+
+
+class OggOpusReader:
+    """
+    Read the Opus packets of an Ogg Opus file (RFC 7845), to send them without decoding and encoding again.
+    Iterate over the audio packets.  Chained files are read stream after stream, the other multiplexed streams are ignored.
+    Opus is always 48000Hz, and a stereo stream is down-mixed by the mono decoders of the Mumble clients
+    """
+
+    def __init__(self, file):
+        """file=path or binary file object"""
+        if isinstance(file, (str, bytes, os.PathLike)):
+            self.file = open(file, "rb")
+            self.owned = True  # to be closed at the end
+        else:
+            self.file = file
+            self.owned = False
+
+        self.serial = None  # serial of the Opus stream being read
+        self.channels = None
+        self.pre_skip = 0  # samples to drop at the beginning, played anyway as they are part of the packets
+        self.input_sample_rate = None  # sample rate of the source before encoding, for information
+
+    def __iter__(self):
+        try:
+            for (serial, packet) in self.read_packets():
+                if packet.startswith(b"OpusHead"):
+                    self.read_head(packet)
+                    self.serial = serial
+                elif serial != self.serial or packet.startswith(b"OpusTags"):
+                    continue
+                else:
+                    yield packet
+        finally:
+            self.close()
+
+    def read_head(self, packet):
+        """Read the identification header of an Opus stream"""
+        if len(packet) < OPUS_HEAD.size:
+            raise InvalidSoundDataError("truncated OpusHead")
+
+        (magic, version, channels, pre_skip, input_sample_rate, gain, mapping) = OPUS_HEAD.unpack_from(packet)
+        if version >> 4 != 0:  # incompatible major version
+            raise InvalidSoundDataError("unsupported Ogg Opus version %i" % version)
+        if mapping != 0 or channels > 2:  # several Opus streams in each packet, would need a multistream decoder
+            raise InvalidSoundDataError("only mono and stereo Ogg Opus files are supported")
+
+        self.channels = channels
+        self.pre_skip = pre_skip
+        self.input_sample_rate = input_sample_rate
+
+    def read_packets(self):
+        """Read the Ogg pages, and yield the (stream serial, packet) in the order they complete"""
+        partial = dict()  # serial -> beginning of a packet continued on the next page
+
+        while True:
+            header = self.file.read(OGG_PAGE_HEADER.size)
+            if len(header) < OGG_PAGE_HEADER.size:
+                return  # end of file (a truncated last page is ignored)
+
+            (capture, version, flags, granule, serial, page, crc, segments) = OGG_PAGE_HEADER.unpack(header)
+            if capture != b"OggS" or version != 0:
+                raise InvalidSoundDataError("not an Ogg file, or corrupted")
+
+            lacing = self.file.read(segments)
+            body = self.file.read(sum(lacing))
+            if len(body) < sum(lacing):
+                return
+
+            if flags & OGG_FLAG_BOS:
+                partial.pop(serial, None)
+
+            packet = partial.pop(serial, b"")
+            position = 0
+            for size in lacing:  # a packet ends with a segment shorter than 255 bytes
+                packet += body[position:position + size]
+                position += size
+                if size < 255:
+                    yield (serial, packet)
+                    packet = b""
+            if packet:
+                partial[serial] = packet
+
+    def close(self):
+        if self.owned:
+            self.file.close()
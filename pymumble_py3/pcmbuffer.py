@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from .constants import *
+
+
+class PCMBuffer:
+    """
+    Preallocated ring buffer of outgoing PCM audio.
+    Adding and taking audio only costs the copy of the audio itself, whatever the amount buffered,
+    and the frames are handed to the encoder as views on the buffer, without copy.
+    Thread safe: the audio is added by the application threads and taken by the library thread
+    """
+
+    def __init__(self, capacity, overflow=PYMUMBLE_OVERFLOW_GROW):
+        """
+        capacity=size of the buffer in bytes
+        overflow=what to do when more audio is added than the free space (PYMUMBLE_OVERFLOW_*)
+        """
+        self.condition = threading.Condition()  # notified when space is freed, for the blocking overflow policy
+
+        self.buffer = bytearray(capacity & ~1)  # aligned on the 16 bits samples
+        self.overflow = overflow
+
+        self.start = 0  # position of the first buffered byte
+        self.size = 0  # number of buffered bytes
+        self.reserved = 0  # bytes just before start still read by the encoder, not to be overwritten yet
+
+    def get_capacity(self):
+        return len(self.buffer)
+
+    def set_capacity(self, capacity, overflow=None):
+        """Change the size of the buffer (never below the buffered audio) and possibly the overflow policy"""
+        with self.condition:
+            if overflow is not None:
+                self.overflow = overflow
+            self.resize(max(capacity & ~1, self.size))
+            self.condition.notify_all()
+
+    def resize(self, capacity):
+        """Move the buffered audio to a new buffer.  The one being read by the encoder stays valid"""
+        buffer = bytearray(capacity)
+        self.copy_out(buffer, self.size)
+        self.buffer = buffer
+        self.start = 0
+        self.reserved = 0
+
+    def get_free_space(self):
+        return len(self.buffer) - self.size - self.reserved
+
+    def add(self, pcm, can_wait=None):
+        """
+        Add audio at the end of the buffer, applying the overflow policy if it does not fit
+        can_wait=function returning True while the caller can wait for the space to be freed, for the blocking policy.
+                 When it returns False (or is None) the audio which does not fit is dropped instead
+        Return the number of bytes that were dropped to make it fit
+        """
+        data = memoryview(pcm).cast("B")
+        dropped = 0
+
+        with self.condition:
+            if self.size == 0 and self.reserved == 0:  # restart at the beginning, the frames will not wrap around
+                self.start = 0
+
+            while len(data) > self.get_free_space():
+                if self.overflow == PYMUMBLE_OVERFLOW_GROW:
+                    self.resize(max(len(self.buffer) * 2, self.size + len(data)))
+                elif self.overflow == PYMUMBLE_OVERFLOW_DROP_NEWEST:
+                    free = self.get_free_space()
+                    dropped += len(data) - free
+                    data = data[:free]
+                elif self.overflow == PYMUMBLE_OVERFLOW_DROP_OLDEST:
+                    room = len(self.buffer) - self.reserved
+                    if len(data) > room:  # more than the whole buffer, only its end is kept
+                        dropped += len(data) - room
+                        data = data[len(data) - room:]
+                    drop = min(len(data) - self.get_free_space(), self.size)
+                    self.start = (self.start + drop) % len(self.buffer)
+                    self.size -= drop
+                    dropped += drop
+                else:  # PYMUMBLE_OVERFLOW_BLOCK, add what fits and wait for the encoder to free the space
+                    free = self.get_free_space()
+                    self.copy_in(data[:free])
+                    data = data[free:]
+                    if can_wait is None or not can_wait():  # waiting would never end, the audio would not be sent
+                        dropped += len(data)
+                        data = data[:0]
+                    else:  # checking again regularly, the connection may be lost meanwhile
+                        self.condition.wait(PYMUMBLE_OVERFLOW_BLOCK_CHECK)
+
+            self.copy_in(data)
+
+        return dropped
+
+    def copy_in(self, data):
+        """Copy data after the buffered audio, there must be enough free space"""
+        capacity = len(self.buffer)
+        end = (self.start + self.size) % capacity
+        first = min(len(data), capacity - end)  # up to the end of the buffer, the rest goes at the beginning
+        self.buffer[end:end + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        self.size += len(data)
+
+    def copy_out(self, destination, length):
+        """Copy the first length bytes of buffered audio at the beginning of destination"""
+        capacity = len(self.buffer)
+        first = min(length, capacity - self.start)
+        destination[:first] = self.buffer[self.start:self.start + first]
+        destination[first:length] = self.buffer[:length - first]
+
+    def take(self, size):
+        """
+        Take the next size bytes of audio, padded with silence if less are buffered.  Return None if the buffer is empty
+        The returned memoryview is valid until the next call, its space in the buffer is not reused before
+        """
+        with self.condition:
+            self.reserved = 0  # the previous frame is encoded
+            self.condition.notify_all()
+
+            if self.size == 0:
+                return None
+
+            length = min(size, self.size)
+            if length == size and self.start + size <= len(self.buffer):  # contiguous, give a view on the buffer
+                frame = memoryview(self.buffer)[self.start:self.start + size]
+                self.reserved = size
+            else:  # wraps around the end of the buffer, or to be padded: copy
+                frame = bytearray(size)
+                self.copy_out(frame, length)
+                frame = memoryview(frame)
+
+            self.start = (self.start + length) % len(self.buffer)
+            self.size -= length
+            return frame
+
+    def wait_below(self, size, timeout=None):
+        """
+        Wait until less than size bytes are buffered, at most until the timeout or the next notification
+        Return True if less than size bytes are buffered
+        """
+        with self.condition:
+            if self.size >= size:
+                self.condition.wait(timeout)
+            return self.size < size
+
+    def notify(self):
+        """Wake up the threads waiting for the buffer"""
+        with self.condition:
+            self.condition.notify_all()
+
+    def clear(self):
+        """Discard all the buffered audio"""
+        with self.condition:
+            self.start = (self.start + self.size) % len(self.buffer)
+            self.size = 0
+            self.condition.notify_all()
+
+    def __len__(self):
+        """Number of bytes buffered"""
+        return self.size
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+from .constants import *
+
+
+def get_timestamp():
+    """Return the timestamp put in the pings: monotonic clock in microseconds, echoed as is by the server"""
+    return time.monotonic_ns() // 1000
+
+
+class PingStats:
+    """
+    Round-trip time statistics of a channel (control connection or UDP), computed from the pings echoed by the server.
+    Each response is matched with its request through the echoed timestamp, so overlapping pings are measured correctly
+    """
+
+    def __init__(self):
+        self.pending = OrderedDict()  # timestamps of the pings waiting for their echo
+
+        self.nb = 0  # number of measured round-trips
+        self.avg = 0.0  # mean round-trip time in ms
+        self.var = 0.0  # variance of the round-trip time in ms^2
+        self.m2 = 0.0  # sum of the squared differences to the mean, to update the variance
+        self.jitter = 0.0  # smoothed variation between consecutive round-trip times in ms
+        self.last = None  # last round-trip time in ms
+
+        self.last_send = 0  # time of the last ping sent
+        self.last_receive = 0  # time of the last echo received
+
+    def sent(self):
+        """Register a ping being sent and return the timestamp to put in it"""
+        timestamp = get_timestamp()
+        self.pending[timestamp] = None
+        while len(self.pending) > PYMUMBLE_PING_PENDING_MAX:  # never answered, forget the oldest
+            self.pending.popitem(last=False)
+
+        self.last_send = time.time()
+        return timestamp
+
+    def received(self, timestamp):
+        """Register the echo of a ping.  Return the round-trip time in ms, or None if the timestamp is not one of ours"""
+        if timestamp not in self.pending:
+            return None
+
+        del self.pending[timestamp]
+        self.last_receive = time.time()
+
+        rtt = (get_timestamp() - timestamp) / 1000.0
+
+        # running mean and variance (Welford)
+        self.nb += 1
+        delta = rtt - self.avg
+        self.avg += delta / self.nb
+        self.m2 += delta * (rtt - self.avg)
+        self.var = self.m2 / self.nb
+
+        if self.last is not None:  # exponentially weighted, like the interarrival jitter of RFC 3550
+            self.jitter += (abs(rtt - self.last) - self.jitter) * PYMUMBLE_PING_JITTER_GAIN
+        self.last = rtt
+
+        return rtt
+
+    def get_stats(self):
+        """Return the statistics as a dict, times in ms"""
+        return {"nb": self.nb,
+                "avg": self.avg,
+                "var": self.var,
+                "jitter": self.jitter,
+                "last": self.last,
+                "last_rcv": self.last_receive}
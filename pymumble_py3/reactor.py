@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import threading
+import logging
+import time
+import selectors
+import socket
+import heapq
+import itertools
+
+from .errors import *
+from .constants import *
+
+
+class Reactor(threading.Thread):
+    """
+    Run many Mumble connections in a single thread.
+    The connections share one selector and one timer queue for their pings and audio deadlines,
+    and their callbacks are called from the reactor thread.
+    Only the TLS connection itself is done in a short-lived thread, to not block the other connections
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+
+        self.Log = logging.getLogger("PyMumble")
+
+        self.parent_thread = threading.current_thread()  # main thread of the calling application
+
+        self.selector = selectors.DefaultSelector()  # epoll on Linux
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(0)
+        self.wakeup_writer.setblocking(0)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, (None, self.clear_wakeup))
+
+        self.sessions = set()  # Mumble objects hosted by the reactor
+        self.timers = list()  # heap of (deadline, counter, action, Mumble object)
+        self.timers_counter = itertools.count()  # keep the heap order stable for equal deadlines
+        self.current_timers = dict()  # valid timer of each session, the others in the heap are outdated
+
+        self.lock = threading.Lock()  # protect the lists below, filled from other threads
+        self.connected_sessions = list()  # sessions connected and waiting to be attached to the selector
+        self.failed_sessions = list()  # sessions that could not connect and must retry later
+        self.removed_sessions = list()  # sessions to close
+        self.woken_sessions = set()  # sessions with something to treat
+
+        self.running = True
+
+    def add(self, mumble_object):
+        """Host a Mumble object (which must not be started as a thread) and connect it.  Can be called from any thread"""
+        mumble_object.reactor = self
+        mumble_object.mumble_thread = self
+        with self.lock:
+            self.sessions.add(mumble_object)
+        self.start_connection(mumble_object)
+
+    def remove(self, mumble_object):
+        """Disconnect and stop hosting a Mumble object.  Can be called from any thread"""
+        with self.lock:
+            self.removed_sessions.append(mumble_object)
+        self.wakeup()
+
+    def stop(self):
+        """Disconnect every connection and stop the reactor thread"""
+        self.running = False
+        self.wakeup()
+
+    def wakeup(self, mumble_object=None):
+        """Interrupt the wait of the reactor, optionally for a specific connection.  Can be called from any thread"""
+        if mumble_object is not None:
+            with self.lock:
+                self.woken_sessions.add(mumble_object)
+
+        try:
+            self.wakeup_writer.send(b'\x00')
+        except socket.error:  # the socket is full of pending wakeups already
+            pass
+
+    def clear_wakeup(self, mask):
+        """Empty the wakeup socket, the reactor being awake now"""
+        try:
+            while self.wakeup_reader.recv(PYMUMBLE_READ_BUFFER_SIZE):
+                pass
+        except socket.error:
+            pass
+
+    def schedule(self, mumble_object, deadline, action):
+        """Program the next action for a connection, replacing the previous one"""
+        timer = (deadline, next(self.timers_counter), action, mumble_object)
+        self.current_timers[mumble_object] = timer
+        heapq.heappush(self.timers, timer)
+
+    def get_timeout(self):
+        """Return how long the reactor can wait before the next timer"""
+        while self.timers and self.current_timers.get(self.timers[0][3]) is not self.timers[0]:
+            heapq.heappop(self.timers)  # drop outdated timers
+
+        if not self.timers:
+            return PYMUMBLE_LOOP_RATE
+        return max(0, min(self.timers[0][0] - time.time(), PYMUMBLE_LOOP_RATE))
+
+    def run(self):
+        """Reactor loop, treating the sockets, the timers and the wakeups of all the connections"""
+        while self.running and self.parent_thread.is_alive():
+            touched = set()  # connections that must update their scheduled tasks
+            spent = dict()  # time spent working for each connection in this iteration, for the metrics
+
+            for (key, mask) in self.selector.select(self.get_timeout()):
+                (mumble_object, handler) = key.data
+                if mumble_object is None:  # reactor wakeup
+                    handler(mask)
+                elif mumble_object.selector is self.selector:  # may have been detached by a previous event
+                    start = time.perf_counter()
+                    self.call_handler(mumble_object, handler, mask)
+                    spent[mumble_object] = spent.get(mumble_object, 0) + time.perf_counter() - start
+                    touched.add(mumble_object)
+
+            with self.lock:
+                connected_sessions, self.connected_sessions = self.connected_sessions, list()
+                removed_sessions, self.removed_sessions = self.removed_sessions, list()
+                failed_sessions, self.failed_sessions = self.failed_sessions, list()
+                touched.update(self.woken_sessions)
+                self.woken_sessions.clear()
+
+            for mumble_object in connected_sessions:
+                if mumble_object not in self.sessions:  # removed while connecting
+                    mumble_object.control_socket.close()
+                    continue
+                mumble_object.attach(self.selector)
+                touched.add(mumble_object)
+
+            for mumble_object in failed_sessions:
+                if mumble_object in self.sessions:  # not removed meanwhile
+                    self.schedule(mumble_object, time.time() + mumble_object.get_reconnect_delay(), PYMUMBLE_REACTOR_ACTION_CONNECT)
+
+            for mumble_object in removed_sessions:
+                self.close_session(mumble_object)
+                touched.discard(mumble_object)
+
+            current_time = time.time()
+            while self.timers and self.timers[0][0] <= current_time:
+                timer = heapq.heappop(self.timers)
+                (deadline, counter, action, mumble_object) = timer
+                if self.current_timers.get(mumble_object) is not timer:
+                    continue
+                del self.current_timers[mumble_object]
+                if action == PYMUMBLE_REACTOR_ACTION_CONNECT:
+                    self.start_connection(mumble_object)
+                else:
+                    touched.add(mumble_object)
+
+            for mumble_object in touched:
+                if mumble_object.selector is self.selector:
+                    start = time.perf_counter()
+                    self.process(mumble_object)
+                    spent[mumble_object] = spent.get(mumble_object, 0) + time.perf_counter() - start
+
+            for (mumble_object, duration) in spent.items():
+                mumble_object.metrics.observe(PYMUMBLE_METRIC_LOOP_TIME, duration)
+
+        for mumble_object in list(self.sessions):
+            self.close_session(mumble_object)
+        self.selector.close()
+
+    def call_handler(self, mumble_object, handler, mask):
+        """Call a socket handler of a connection, catching the errors that end the connection"""
+        try:
+            handler(mask)
+        except ConnectionRejectedError as e:
+            mumble_object.Log.error("connection rejected: %s", e)
+            mumble_object.reconnect = False
+            mumble_object.connected = PYMUMBLE_CONN_STATE_FAILED
+        except socket.error:
+            mumble_object.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+        except Exception:  # a callback or an invalid message, only this connection is dropped
+            mumble_object.Log.exception("error while treating the connection, disconnecting")
+            mumble_object.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+
+    def process(self, mumble_object):
+        """Run the scheduled tasks of a connection, and program its next timer"""
+        if mumble_object.connected not in (PYMUMBLE_CONN_STATE_NOT_CONNECTED, PYMUMBLE_CONN_STATE_FAILED):
+            try:
+                mumble_object.run_scheduled_tasks()
+                mumble_object.flush_send_queue()
+                mumble_object.update_control_events()
+            except socket.error:
+                mumble_object.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+            except Exception:  # a callback, only this connection is dropped
+                mumble_object.Log.exception("error while running the scheduled tasks, disconnecting")
+                mumble_object.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+
+        if mumble_object.connected in (PYMUMBLE_CONN_STATE_NOT_CONNECTED, PYMUMBLE_CONN_STATE_FAILED):
+            mumble_object.detach()
+            if mumble_object.reconnect and mumble_object.connected != PYMUMBLE_CONN_STATE_FAILED:
+                self.schedule(mumble_object, time.time() + mumble_object.get_reconnect_delay(), PYMUMBLE_REACTOR_ACTION_CONNECT)
+            else:
+                self.forget(mumble_object)
+            return
+
+        self.schedule(mumble_object, time.time() + mumble_object.get_loop_timeout(), PYMUMBLE_REACTOR_ACTION_TASKS)
+
+    def close_session(self, mumble_object):
+        """Disconnect a connection and stop hosting it"""
+        if mumble_object.selector is self.selector:
+            mumble_object.detach()
+        mumble_object.connected = PYMUMBLE_CONN_STATE_NOT_CONNECTED
+        mumble_object.reconnect = False
+        self.forget(mumble_object)
+
+    def forget(self, mumble_object):
+        """Stop hosting a connection"""
+        self.current_timers.pop(mumble_object, None)
+        with self.lock:
+            self.sessions.discard(mumble_object)
+            self.woken_sessions.discard(mumble_object)
+
+    def start_connection(self, mumble_object):
+        """Connect a session in a short-lived thread, the TLS handshake being blocking"""
+        thread = threading.Thread(target=self.connect_session, args=(mumble_object,))
+        thread.daemon = True
+        thread.start()
+
+    def connect_session(self, mumble_object):
+        """Initialize and connect a session, then hand it to the reactor thread.  Run in its own thread"""
+        mumble_object.init_connection()  # reset the connection-specific object members
+
+        try:
+            state = mumble_object.connect()
+        except socket.error:
+            state = PYMUMBLE_CONN_STATE_FAILED
+
+        if state >= PYMUMBLE_CONN_STATE_FAILED:
+            mumble_object.Log.error("Connection error with the Mumble (murmur) Server")
+            if mumble_object.is_retrying():
+                with self.lock:
+                    self.failed_sessions.append(mumble_object)
+                self.wakeup()
+            else:
+                mumble_object.ready_lock.release()
+                self.remove(mumble_object)
+            return
+
+        with self.lock:
+            self.connected_sessions.append(mumble_object)
+        self.wakeup()
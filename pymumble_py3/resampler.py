@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import math
+
+from .constants import *
+from .errors import InvalidSoundDataError
+
+try:
+    import numpy
+except ImportError:  # optional, only needed to convert the audio
+    numpy = None
+
+SAMPLE_FORMATS = {  # sample format -> (numpy type, sample size in bytes, factor to the 16 bits scale)
+    PYMUMBLE_SAMPLE_FORMAT_S16LE: ("<i2", 2, 1.),
+    PYMUMBLE_SAMPLE_FORMAT_S32LE: ("<i4", 4, 1. / 65536),
+    PYMUMBLE_SAMPLE_FORMAT_F32LE: ("<f4", 4, 32768.),
+}
+RESAMPLER_BLOCK = 4800  # output samples computed at once, to bound the memory used
+
+
+def get_input_format(pcm, sample_rate, channels, sample_format):
+    """
+    Return the (sample rate, channels, sample format) of some audio.
+    The sample format of a numpy array is its type, and a 2 dimensions array has one column per channel
+    """
+    dtype = getattr(pcm, "dtype", None)
+    if dtype is not None:  # numpy array
+        if dtype.kind == "f":
+            sample_format = PYMUMBLE_SAMPLE_FORMAT_F32LE
+        elif dtype.kind == "i" and dtype.itemsize in (2, 4):
+            sample_format = PYMUMBLE_SAMPLE_FORMAT_S16LE if dtype.itemsize == 2 else PYMUMBLE_SAMPLE_FORMAT_S32LE
+        else:
+            raise InvalidSoundDataError("unsupported sample type %s" % dtype)
+        if pcm.ndim == 2:
+            channels = pcm.shape[1]
+
+    if sample_format not in SAMPLE_FORMATS:
+        raise InvalidSoundDataError("unsupported sample format %s" % sample_format)
+    if channels < 1 or sample_rate <= 0:
+        raise InvalidSoundDataError("invalid audio format: %s channels at %s Hz" % (channels, sample_rate))
+
+    return (sample_rate, channels, sample_format)
+
+
+class Resampler:
+    """
+    Streaming polyphase resampler, with a Kaiser windowed sinc filter.
+    The filter state is kept between the calls, so the audio can be resampled chunk by chunk without clicks.
+    Each output sample is computed from its own filter phase, all of them in a few vectorized operations
+    """
+
+    def __init__(self, input_rate, output_rate, taps=PYMUMBLE_RESAMPLER_TAPS, cutoff=PYMUMBLE_RESAMPLER_CUTOFF):
+        """taps=filter length in input samples (more when down-sampling), cutoff=relative to the lowest Nyquist frequency"""
+        if numpy is None:
+            raise ImportError("numpy is required to resample the audio")
+
+        divisor = math.gcd(int(input_rate), int(output_rate))
+        self.up = int(output_rate) // divisor  # the input is up-sampled by self.up, filtered, and down-sampled by self.down
+        self.down = int(input_rate) // divisor
+
+        self.taps = taps * max(1, -(-self.down // self.up))  # wider filter when down-sampling, for the same sharpness
+        length = self.taps * self.up
+        frequency = cutoff * 0.5 / max(self.up, self.down)  # in cycles per up-sampled sample
+        center = (length - 1) / 2.
+        prototype = 2 * frequency * numpy.sinc(2 * frequency * (numpy.arange(length) - center)) * numpy.kaiser(length, 8.6)
+        prototype *= self.up / prototype.sum()  # unity gain, the up-sampling inserts zeros
+
+        # one filter per phase of the output samples, reversed to apply it on the input samples in order
+        self.filters = numpy.ascontiguousarray(prototype.reshape(self.taps, self.up).T[:, ::-1], dtype=numpy.float32)
+        self.offsets = numpy.arange(self.taps)
+
+        self.history = numpy.zeros(self.taps - 1, dtype=numpy.float32)  # last input samples, still needed by the filter
+        self.consumed = 0  # number of input samples before the current chunk
+        self.produced = 0  # number of output samples
+
+    def process(self, samples):
+        """Resample a chunk of float32 samples, and return the output samples it completes"""
+        data = numpy.concatenate((self.history, samples))  # data[0] is the input sample self.consumed - (self.taps - 1)
+        end = self.consumed + len(samples)
+        last = -(-end * self.up // self.down)  # first output sample needing input samples not received yet
+
+        blocks = list()
+        for start in range(self.produced, last, RESAMPLER_BLOCK):
+            position = numpy.arange(start, min(start + RESAMPLER_BLOCK, last), dtype=numpy.int64) * self.down
+            windows = data[(position // self.up - self.consumed)[:, None] + self.offsets]  # input samples of each output sample
+            blocks.append(numpy.einsum("ij,ij->i", windows, self.filters[position % self.up]))
+
+        self.history = data[len(data) - (self.taps - 1):]
+        self.consumed = end
+        self.produced = last
+        return numpy.concatenate(blocks) if blocks else numpy.zeros(0, dtype=numpy.float32)
+
+
+class AudioConverter:
+    """
+    Convert a stream of audio of any sample rate, number of channels and sample format to the 48000Hz mono 16 bits
+    audio of the encoder.  The channels are down-mixed, and the state is kept between the chunks: an incomplete
+    sample is completed by the next chunk, and the resampling filter is continuous
+    """
+
+    def __init__(self, sample_rate, channels, sample_format):
+        if numpy is None:
+            raise ImportError("numpy is required to convert the audio")
+
+        self.input_format = (sample_rate, channels, sample_format)
+        (self.dtype, self.sample_size, self.scale) = SAMPLE_FORMATS[sample_format]
+        self.channels = channels
+        self.resampler = Resampler(sample_rate, PYMUMBLE_SAMPLERATE) if sample_rate != PYMUMBLE_SAMPLERATE else None
+
+        self.remainder = b""  # beginning of an incomplete sample (all channels), waiting for the next chunk
+
+    def convert(self, pcm):
+        """Convert a chunk of audio (bytes-like or numpy array), and return the 16 bits samples as a numpy array"""
+        if hasattr(pcm, "dtype"):
+            samples = pcm.astype(numpy.float32).reshape(-1)  # a copy, the caller array is not modified
+            if len(samples) % self.channels != 0:
+                raise InvalidSoundDataError("the samples do not fill the %i channels" % self.channels)
+        else:
+            data = memoryview(pcm).cast("B")
+            if self.remainder:
+                data = self.remainder + data
+            frame_size = self.sample_size * self.channels
+            usable = len(data) - len(data) % frame_size
+            self.remainder = bytes(data[usable:])
+            samples = numpy.frombuffer(data, dtype=self.dtype, count=usable // self.sample_size).astype(numpy.float32)
+
+        if self.scale != 1.:
+            samples *= self.scale
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1, dtype=numpy.float32)
+        if self.resampler is not None:
+            samples = self.resampler.process(samples)
+
+        numpy.clip(samples, -32768, 32767, out=samples)
+        return numpy.rint(samples).astype("<i2")
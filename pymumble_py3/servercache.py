@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import os
+import threading
+
+
+class ServerCache:
+    """
+    On-disk warm-start cache: what is known of the servers (configuration, codec, blobs) is kept between runs,
+    so that a new connection can start with it instead of waiting for the server or asking for the blobs again.
+    One file can hold several servers, and be shared by the connections of a process
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self, host, port):
+        """Return the dict saved for a server, empty if nothing is known or the file is unreadable"""
+        with self.lock:
+            return self.read().get("%s:%i" % (host, port), dict())
+
+    def save(self, host, port, entry):
+        """Save the dict of a server, keeping the other servers of the file"""
+        with self.lock:
+            content = self.read()
+            content["%s:%i" % (host, port)] = entry
+
+            temporary = "%s.%i.tmp" % (self.path, os.getpid())
+            with open(temporary, "w") as file:
+                json.dump(content, file)
+            os.replace(temporary, self.path)  # atomic, a reader never sees a partial file
+
+    def read(self):
+        try:
+            with open(self.path) as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            return dict()
+        return content if isinstance(content, dict) else dict()
+
+
+def encode_blobs(blobs):
+    """Convert the blobs (hash: comment text or texture bytes) in a JSON compatible dict"""
+    result = dict()
+    for (hash, value) in blobs.items():
+        if isinstance(value, str):
+            result[hash.hex()] = {"text": value}
+        else:
+            result[hash.hex()] = {"data": base64.b64encode(value).decode("ascii")}
+    return result
+
+
+def decode_blobs(encoded):
+    """Convert back the blobs saved by encode_blobs"""
+    result = dict()
+    for (hash, value) in encoded.items():
+        try:
+            if "text" in value:
+                result[bytes.fromhex(hash)] = value["text"]
+            else:
+                result[bytes.fromhex(hash)] = base64.b64decode(value["data"])
+        except (ValueError, KeyError, TypeError):  # corrupted entry, the blob will be asked to the server
+            continue
+    return result
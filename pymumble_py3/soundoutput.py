@@ -1,15 +1,34 @@
 # -*- coding: utf-8 -*-
 
-from time import time
+from time import time, monotonic, perf_counter
+from collections import deque
+import ctypes
 import struct
 import threading
-import socket
-import opuslib
+import weakref
+try:
+    import opuslib
+except Exception:  # opuslib raises a bare Exception when the opus library is missing
+    opuslib = None
 
 from .constants import *
-from .errors import CodecNotSupportedError
+from .errors import CodecNotSupportedError, InvalidSoundDataError
 from .tools import VarInt
-from .messages import VoiceTarget
+from .pcmbuffer import PCMBuffer
+from .audiopacer import AudioPacer
+from .oggopus import OggOpusReader, get_packet_duration, repacketize
+from .soundqueue import EncodedFrame
+from .mixer import Mixer
+from .resampler import AudioConverter, get_input_format
+from .audiostream import AudioStream
+from .noisegate import NoiseGate
+from .voicetargets import make_target
+
+OPUS_SIGNALS = {  # signal type -> opus value (opus_defines.h, opuslib 2 and 3 export them from distinct modules)
+    PYMUMBLE_OPUS_SIGNAL_AUTO: -1000,
+    PYMUMBLE_OPUS_SIGNAL_VOICE: 3001,
+    PYMUMBLE_OPUS_SIGNAL_MUSIC: 3002,
+}
 
 
 class SoundOutput:
@@ -18,110 +37,327 @@ class SoundOutput:
     The buffering is the responsibility of the caller, any partial sound will be sent without delay
     """
 
-    def __init__(self, mumble_object, audio_per_packet, bandwidth, opus_profile=PYMUMBLE_AUDIO_TYPE_OPUS_PROFILE):
+    def __init__(self, mumble_object, audio_per_packet, bandwidth, opus_profile=PYMUMBLE_AUDIO_TYPE_OPUS_PROFILE,
+                 capacity=PYMUMBLE_SOUND_OUTPUT_CAPACITY, overflow=PYMUMBLE_OVERFLOW_GROW):
         """
-        audio_per_packet=packet audio duration in sec
+        audio_per_packet=packet audio duration in sec, None to choose it from the bandwidth
         bandwidth=maximum total outgoing bandwidth
+        capacity=size of the audio buffer in sec
+        overflow=what to do when the buffer is full (PYMUMBLE_OVERFLOW_*)
         """
         self.mumble_object = mumble_object
 
         self.Log = self.mumble_object.Log
 
-        self.pcm = []
-        self.lock = threading.Lock()
+        self.pcm = PCMBuffer(int(capacity * PYMUMBLE_SAMPLERATE) * 2, overflow)  # audio waiting to be encoded
+
+        self.opus_packets = deque()  # (packet, duration, terminator) already encoded, sent as they are before the pcm (None for a gated silence)
+        self.opus_duration = 0  # duration of the opus packets waiting, in sec
+        self.pending_payload = None  # (packet content, duration, dtx) encoded but not sent by a stopped pacer, sent first
+        self.opus_lock = threading.Lock()
+
+        self.mixer = None  # mixer of the named sources, created with the first one
+        self.converters = weakref.WeakKeyDictionary()  # PCMBuffer -> AudioConverter of the audio added to it, if not 48000Hz mono 16 bits
 
         self.codec = None  # codec currently requested by the server
         self.encoder = None  # codec instance currently used to encode
-        self.encoder_framesize = None  # size of an audio frame for the current codec (OPUS=audio_per_packet, CELT=0.01s)
+        self.encoder_framesize = None  # duration of an encoded frame, several of them can make a packet
+        self.encoder_lock = threading.RLock()  # the encoder is used by the pacer thread and tuned from the other ones
+        self.frames_per_packet = 1
+        self.auto_audio_per_packet = False  # True if the packet and frame durations are chosen from the bandwidth
         self.opus_profile = opus_profile
+        self.encoder_settings = dict()  # opus encoder settings chosen by the user, applied to every new encoder
 
+        self.bandwidth = bandwidth
+        self.bandwidth_limit = None  # lower bandwidth set by the bitrate controller when the link is congested
         self.set_audio_per_packet(audio_per_packet)
         self.set_bandwidth(bandwidth)
 
         self.codec_type = None  # codec type number to be used in audio packets
-        self.target = 0  # target is not implemented yet, so always 0
+        self.target = PYMUMBLE_VOICE_TARGET_NORMAL  # voice target slot of the audio packets
+        self.voice_targets = mumble_object.voice_targets  # whisper targets registered in the server slots, shared by the outputs
 
-        self.sequence_start_time = 0  # time of sequence 1
-        self.sequence_last_time = 0  # time of the last emitted packet
+        self.sequence_start_time = 0  # time of sequence 1, on the monotonic clock
+        self.sequence_last_time = 0  # time of the last emitted packet, on the monotonic clock
         self.sequence = 0  # current sequence
+        self.last_packet_duration = self.audio_per_packet  # duration of the last emitted packet, in sec
+        self.silence_end = 0  # end of the audio removed by the noise gate, on the monotonic clock
+        self.paused = False  # True if audio was removed by the noise gate since the last emitted packet
+
+        self.pacer = None  # thread sending the audio on time, if enabled
+        self.noise_gate = None  # gate removing the silences before the encoding, if enabled
 
     def send_audio(self):
         """send the available audio to the server, taking care of the timing"""
-        if not self.encoder or len(self.pcm) == 0:  # no codec configured or no audio sent
+        if not self.encoder or not self.is_audio() or self.pacer is not None:  # no codec configured, no audio sent or sent by the pacer
             return ()
 
-        samples = int(self.encoder_framesize * PYMUMBLE_SAMPLERATE * 2)  # number of samples in an encoder frame
-
-        while len(self.pcm) > 0 and self.sequence_last_time + self.audio_per_packet <= time():  # audio to send and time to send it (since last packet)
-            current_time = time()
-            if self.sequence_last_time + PYMUMBLE_SEQUENCE_RESET_INTERVAL <= current_time:  # waited enough, resetting sequence to 0
-                self.sequence = 0
-                self.sequence_start_time = current_time
-                self.sequence_last_time = current_time
-            elif self.sequence_last_time + (self.audio_per_packet * 2) <= current_time:  # give some slack (2*audio_per_frame) before interrupting a continuous sequence
-                # calculating sequence after a pause
-                self.sequence = int((current_time - self.sequence_start_time) / PYMUMBLE_SEQUENCE_DURATION)
-                self.sequence_last_time = self.sequence_start_time + (self.sequence * PYMUMBLE_SEQUENCE_DURATION)
-            else:  # continuous sound
-                self.sequence += int(self.audio_per_packet / PYMUMBLE_SEQUENCE_DURATION)
-                self.sequence_last_time = self.sequence_start_time + (self.sequence * PYMUMBLE_SEQUENCE_DURATION)
-
-            payload = bytearray()  # content of the whole packet, without tcptunnel header
-            audio_encoded = 0  # audio time already in the packet
-
-            while len(self.pcm) > 0 and audio_encoded < self.audio_per_packet:  # more audio to be sent and packet not full
-                self.lock.acquire()
-                to_encode = self.pcm.pop(0)
-                self.lock.release()
-
-                if len(to_encode) != samples:  # pad to_encode if needed to match sample length
-                    to_encode += b'\x00' * (samples - len(to_encode))
-
-                try:
-                    encoded = self.encoder.encode(to_encode, len(to_encode) // 2)
-                except opuslib.exceptions.OpusError:
-                    encoded = b''
-
-                audio_encoded += self.encoder_framesize
-
-                # create the audio frame header
-                if self.codec_type == PYMUMBLE_AUDIO_TYPE_OPUS:
-                    frameheader = VarInt(len(encoded)).encode()
-                else:
-                    frameheader = len(encoded)
-                    if audio_encoded < self.audio_per_packet and len(self.pcm) > 0:  # if not last frame for the packet, set the terminator bit
-                        frameheader += (1 << 7)
-                    frameheader = struct.pack('!B', frameheader)
-
-                payload += frameheader + encoded  # add the frame to the packet
-
-            header = self.codec_type << 5  # encapsulate in audio packet
-            sequence = VarInt(self.sequence).encode()
-
-            udppacket = struct.pack('!B', header | self.target) + sequence + payload
-
-            self.Log.debug("audio packet to send: sequence:{sequence}, type:{type}, length:{len}".format(
-                sequence=self.sequence,
-                type=self.codec_type,
-                len=len(udppacket)
-            ))
-
-            tcppacket = struct.pack("!HL", PYMUMBLE_MSG_TYPES_UDPTUNNEL, len(udppacket)) + udppacket  # encapsulate in tcp tunnel
-
-            while len(tcppacket) > 0:
-                sent = self.mumble_object.control_socket.send(tcppacket)
-                if sent < 0:
-                    raise socket.error("Server socket error")
-                tcppacket = tcppacket[sent:]
+        while self.is_audio() and self.get_next_packet_time() <= monotonic():  # audio to send and time to send it (since last packet)
+            if self.mumble_object.is_audio_congested():  # keep the audio buffered until the tcp tunnel drains
+                self.Log.debug("tcp tunnel congested, delaying outgoing audio")
+                break
+
+            current_time = monotonic()
+            packet = self.encode_payload()
+            if packet is None:  # cleared meanwhile
+                break
+            self.send_packet(packet, current_time)
+
+    def is_audio(self):
+        """return True if there is audio waiting to be sent"""
+        return bool(self.opus_packets) or self.pending_payload is not None or self.is_pcm()
+
+    def is_pcm(self):
+        """return True if there is audio waiting to be encoded"""
+        mixer = self.mixer
+        return mixer.is_audio() if mixer is not None else bool(self.pcm)
+
+    def take_frame(self, size):
+        """return the next size bytes of audio to encode, mixed if there are several sources, or None if there is none"""
+        mixer = self.mixer
+        if mixer is None:
+            return self.pcm.take(size)
+
+        mix_start = perf_counter()
+        frame = mixer.mix(size)
+        self.mumble_object.metrics.observe(PYMUMBLE_METRIC_MIX_TIME, perf_counter() - mix_start)
+        return frame
+
+    def encode_payload(self):
+        """
+        encode the audio of the next packet, taking the opus packets first
+        return (packet content without header, duration in sec, dtx), or None if there is no audio
+        the content is None for a silence removed by the noise gate, which is not sent
+        dtx is True for a silence coded by the encoder with the DTX enabled, numbered but not sent either
+        """
+        if not self.encoder:
+            return None
+
+        with self.opus_lock:
+            if self.pending_payload is not None:
+                (payload, self.pending_payload) = (self.pending_payload, None)
+                self.opus_duration -= payload[1]
+                return payload
+
+            if self.opus_packets:
+                (packet, duration, terminator) = self.opus_packets.popleft()
+                self.opus_duration -= duration
+                if packet is None:  # silence removed by the noise gate after the audio of the previous packet
+                    return (None, duration, False)
+                return (VarInt(len(packet) | terminator).encode() + packet, duration, False)  # sent as it is
+
+        if not self.is_pcm():
+            return None
+
+        samples = int(round(self.encoder_framesize * PYMUMBLE_SAMPLERATE)) * 2  # size of an encoder frame, in bytes
+
+        frames = list()  # encoded frames of the packet
+        gate = self.noise_gate
+        last = False  # True if the packet ends a talk, when the noise gate closes
+        gated = False  # True if a frame was removed by the noise gate after the audio of the packet
+
+        while self.is_pcm() and len(frames) < self.frames_per_packet and not last:  # more audio to be sent and packet not full
+            frame = self.take_frame(samples)  # padded with silence if needed to match sample length
+            if frame is None:  # cleared meanwhile
+                break
+
+            if gate is not None:
+                was_open = gate.is_open()
+                if not gate.process(frame, self.encoder_framesize):
+                    if not frames:  # silence: neither encoded nor sent, only the time goes on
+                        return (None, self.encoder_framesize, False)
+                    gated = True
+                    break
+                if not was_open:  # a new talk, without the encoder state of the previous one
+                    with self.encoder_lock:
+                        self.encoder.reset_state()
+                last = not gate.is_open()
+
+            to_encode = (ctypes.c_char * samples).from_buffer(frame)  # given to the encoder without copy
+
+            encode_start = perf_counter()
+            try:
+                with self.encoder_lock:
+                    encoded = self.encoder.encode(to_encode, samples // 2)
+            except opuslib.exceptions.OpusError:
+                encoded = b''
+            self.mumble_object.metrics.observe(PYMUMBLE_METRIC_ENCODE_TIME, perf_counter() - encode_start)
+
+            if encoded:
+                frames.append(encoded)
+
+        if not frames:
+            return None
+
+        terminator = PYMUMBLE_AUDIO_TERMINATOR if last else 0
+        if len(frames) == 1:
+            packets = [(frames[0], self.encoder_framesize, terminator)]
+        else:
+            # the Mumble audio packets carry one Opus packet: the frames are merged in a multi-frame Opus packet.
+            # If the encoder changed its mode between the frames, they can not all be merged: the other packets are sent next
+            packets = [(packet, get_packet_duration(packet), 0) for packet in repacketize(frames)]
+            packets[-1] = packets[-1][:2] + (terminator,)  # the last of the packets ends the talk
+        if gated:  # the time of the removed frame goes on after the audio, as a silence
+            packets.append((None, self.encoder_framesize, 0))
+        if len(packets) > 1:
+            with self.opus_lock:
+                self.opus_packets.extendleft(reversed(packets[1:]))
+                self.opus_duration += sum(duration for (packet, duration, terminator) in packets[1:])
+
+        (packet, duration, terminator) = packets[0]
+        dtx = bool(self.encoder_settings.get("dtx")) and len(packet) <= PYMUMBLE_OPUS_DTX_MAX_SIZE  # size and silence only
+        return (VarInt(len(packet) | terminator).encode() + packet, duration, dtx)
+
+    def put_back_payload(self, packet):
+        """put an encoded (packet content, duration, dtx) which was not sent back in front of the audio, keeping the sequence"""
+        if packet[0] is None:  # silence removed by the noise gate
+            return
+        with self.opus_lock:
+            self.pending_payload = packet
+            self.opus_duration += packet[1]
+
+    def send_packet(self, packet, current_time):
+        """number an encoded (packet content, duration, dtx) according to its time (on the monotonic clock), and send it"""
+        (payload, duration, dtx) = packet
+
+        if payload is None:  # silence removed by the noise gate, nothing is sent but the time goes on
+            start = self.get_next_packet_time()
+            self.silence_end = (start if start + duration >= current_time else current_time) + duration
+            self.paused = True
+            return
+
+        if self.sequence_last_time + PYMUMBLE_SEQUENCE_RESET_INTERVAL <= current_time:  # waited enough, resetting sequence to 0
+            self.sequence = 0
+            self.sequence_start_time = current_time
+            self.sequence_last_time = current_time
+        elif self.paused or self.sequence_last_time + (self.last_packet_duration * 2) <= current_time:  # give some slack (2*audio_per_frame) before interrupting a continuous sequence
+            # calculating sequence after a pause
+            self.sequence = int(round((current_time - self.sequence_start_time) / PYMUMBLE_SEQUENCE_DURATION))
+            self.sequence_last_time = self.sequence_start_time + (self.sequence * PYMUMBLE_SEQUENCE_DURATION)
+        else:  # continuous sound, this packet follows the previous one
+            self.mumble_object.metrics.observe(PYMUMBLE_METRIC_AUDIO_DELAY, max(0, current_time - self.get_next_packet_time()))
+            self.sequence += int(round(self.last_packet_duration / PYMUMBLE_SEQUENCE_DURATION))
+            self.sequence_last_time = self.sequence_start_time + (self.sequence * PYMUMBLE_SEQUENCE_DURATION)
+
+        self.last_packet_duration = duration
+        self.paused = False
+
+        if dtx:  # silence coded by the encoder
+            return  # not sent, the sequence goes on and the receivers conceal the gap
+
+        header = self.codec_type << 5  # encapsulate in audio packet
+        sequence = VarInt(self.sequence).encode()
+
+        udppacket = struct.pack('!B', header | self.target) + sequence + payload
+
+        self.Log.debug("audio packet to send: sequence:{sequence}, type:{type}, length:{len}".format(
+            sequence=self.sequence,
+            type=self.codec_type,
+            len=len(udppacket)
+        ))
+
+        self.mumble_object.send_audio_packet(udppacket)  # UDP or tcp tunnel, depending on the connection state
+
+    def get_next_packet_time(self):
+        """return the time (on the monotonic clock) the next audio packet must be sent"""
+        return max(self.sequence_last_time + self.last_packet_duration, self.silence_end)
+
+    def set_pacer(self, enabled, spin=PYMUMBLE_AUDIO_PACER_SPIN):
+        """
+        send the audio from a dedicated thread, on time whatever the library thread is doing, or from the library thread
+        spin=time before a packet deadline spent polling the clock instead of sleeping, in sec: precision against CPU usage
+        """
+        if self.pacer is not None:
+            self.pacer.stop()
+            self.pacer.join()  # may be sending a last packet
+            self.pacer = None
+
+        if enabled:
+            self.pacer = AudioPacer(self, spin)
+            self.pacer.start()
+        else:
+            self.mumble_object.wakeup()  # the library thread takes the audio over
+
+    def get_pacer(self):
+        """return True if the audio is sent from a dedicated thread"""
+        return self.pacer is not None
+
+    def set_noise_gate(self, enabled, threshold=PYMUMBLE_NOISE_GATE_THRESHOLD, attack=PYMUMBLE_NOISE_GATE_ATTACK,
+                       hangover=PYMUMBLE_NOISE_GATE_HANGOVER):
+        """
+        neither encode nor send the silences of the outgoing audio, and end the talk when the audio gets quiet
+        threshold=level opening the gate, in dBFS
+        attack=duration of the fade in when the gate opens, in sec
+        hangover=duration of quiet audio still sent before the gate closes, in sec
+        """
+        self.noise_gate = NoiseGate(threshold, attack, hangover) if enabled else None
+
+    def get_noise_gate(self):
+        """return the NoiseGate, or None if disabled"""
+        return self.noise_gate
+
+    def wakeup(self):
+        """signal that audio can be sent (new audio or connection ready), to the thread sending it"""
+        pacer = self.pacer
+        if pacer is not None:
+            pacer.wakeup()
+        else:
+            self.mumble_object.wakeup()
 
     def get_audio_per_packet(self):
-        """return the configured length of a audio packet (in ms)"""
+        """return the configured length of a audio packet (in sec)"""
         return self.audio_per_packet
 
-    def set_audio_per_packet(self, audio_per_packet):
-        """set the length of an audio packet (in ms)"""
+    def get_frame_size(self):
+        """return the length of the encoded frames (in sec)"""
+        return self.encoder_framesize
+
+    def set_audio_per_packet(self, audio_per_packet, frame_size=None):
+        """
+        set the length of an audio packet, and of the encoded frames it is made of (in sec)
+        audio_per_packet=multiple of 10ms up to 120ms, or None to choose the packet and frame lengths from the bandwidth
+        frame_size=2.5, 5, 10, 20, 40 or 60ms, the packet length must be a multiple of it.  20ms by default (or the packet length if shorter)
+        """
+        self.auto_audio_per_packet = audio_per_packet is None
+        if audio_per_packet is None:
+            (audio_per_packet, frame_size) = self.choose_audio_per_packet()
+        elif frame_size is None:
+            frame_size = min(audio_per_packet, PYMUMBLE_OPUS_FRAME_SIZE)
+
+        frames_per_packet = int(round(audio_per_packet / frame_size))
+        if not any(abs(frame_size - size) < 1e-9 for size in PYMUMBLE_OPUS_FRAME_SIZES):
+            raise ValueError("unsupported opus frame size %s" % frame_size)
+        if abs(frames_per_packet * frame_size - audio_per_packet) > 1e-9 or audio_per_packet > PYMUMBLE_OPUS_MAX_AUDIO_PER_PACKET + 1e-9 \
+                or abs(round(audio_per_packet / PYMUMBLE_SEQUENCE_DURATION) * PYMUMBLE_SEQUENCE_DURATION - audio_per_packet) > 1e-9:
+            raise ValueError("the packet length must be a multiple of the frame size and of 10ms, up to 120ms")
+
         self.audio_per_packet = audio_per_packet
-        self.create_encoder()
+        self.encoder_framesize = frame_size
+        self.frames_per_packet = frames_per_packet
+        self._set_bandwidth()
+
+    def choose_audio_per_packet(self):
+        """return the shortest (packet length, frame size) whose protocol overhead fits in the bandwidth"""
+        for audio_per_packet in PYMUMBLE_AUTO_AUDIO_PER_PACKET:
+            frame_size = min(audio_per_packet, PYMUMBLE_OPUS_FRAME_SIZE)
+            if self.get_overhead(audio_per_packet, frame_size) <= self.get_effective_bandwidth() * PYMUMBLE_AUTO_MAX_OVERHEAD:
+                break
+        return (audio_per_packet, frame_size)
+
+    def get_overhead(self, audio_per_packet, frame_size):
+        """return the bitrate used by the protocol headers with these packet and frame lengths (in bit/s)"""
+        overhead_per_packet = 20  # IP header in bytes
+        overhead_per_packet += 5  # audio packet header: type and target, sequence, opus packet size
+        frames = int(round(audio_per_packet / frame_size))
+        if frames > 1:
+            overhead_per_packet += 1 + 2 * (frames - 1)  # multi-frame opus packet: frame count, frame lengths
+        if self.mumble_object.udp_active:
+            overhead_per_packet += 12  # UDP header
+        else:
+            overhead_per_packet += 20  # TCP header
+            overhead_per_packet += 6  # TCPTunnel encapsulation
+
+        return int(overhead_per_packet * 8 / audio_per_packet)
 
     def get_bandwidth(self):
         """get the configured bandwidth for the audio output"""
@@ -130,83 +366,297 @@ class SoundOutput:
     def set_bandwidth(self, bandwidth):
         """set the bandwidth for the audio output"""
         self.bandwidth = bandwidth
-        self._set_bandwidth()
+        self.update_bandwidth()
+
+    def set_bandwidth_limit(self, limit):
+        """limit the bandwidth below the configured one (or None), like the bitrate controller does on a congested link"""
+        self.bandwidth_limit = limit
+        self.update_bandwidth()
+
+    def get_effective_bandwidth(self):
+        """get the bandwidth actually used: the configured one, or the limit if lower"""
+        if self.bandwidth_limit is not None:
+            return min(self.bandwidth, self.bandwidth_limit)
+        return self.bandwidth
+
+    def get_bitrate(self):
+        """get the bitrate of the encoder, the bandwidth without the protocol overhead (None without encoder)"""
+        with self.encoder_lock:
+            if self.encoder:
+                return self.encoder.bitrate
+        return None
+
+    def update_bandwidth(self):
+        if self.auto_audio_per_packet:
+            self.set_audio_per_packet(None)
+        else:
+            self._set_bandwidth()
 
     def _set_bandwidth(self):
         """do the calculation of the overhead and configure the actual bitrate for the codec"""
         if self.encoder:
-            overhead_per_packet = 20  # IP header in bytes
-            overhead_per_packet += (3 * int(self.audio_per_packet / self.encoder_framesize))  # overhead per frame
-            if self.mumble_object.udp_active:
-                overhead_per_packet += 12  # UDP header
-            else:
-                overhead_per_packet += 20  # TCP header
-                overhead_per_packet += 6  # TCPTunnel encapsulation
-
-            overhead_per_second = int(overhead_per_packet * 8 / self.audio_per_packet)  # in bits
+            bandwidth = self.get_effective_bandwidth()
+            overhead_per_second = self.get_overhead(self.audio_per_packet, self.encoder_framesize)  # in bits
 
             self.Log.debug(
-                "Bandwidth is {bandwidth}, downgrading to {bitrate} due to the protocol overhead".format(bandwidth=self.bandwidth, bitrate=self.bandwidth - overhead_per_second))
+                "Bandwidth is {bandwidth}, downgrading to {bitrate} due to the protocol overhead".format(bandwidth=bandwidth, bitrate=bandwidth - overhead_per_second))
 
-            self.encoder.bitrate = self.bandwidth - overhead_per_second
+            with self.encoder_lock:
+                self.encoder.bitrate = max(PYMUMBLE_OPUS_MIN_BITRATE, bandwidth - overhead_per_second)
 
-    def add_sound(self, pcm):
-        """add sound to be sent (in PCM mono 16 bits signed format)"""
-        if len(pcm) % 2 != 0:  # check that the data is align on 16 bits
-            raise Exception("pcm data must be mono 16 bits")
+    def add_sound(self, pcm, sample_rate=PYMUMBLE_SAMPLERATE, channels=1, sample_format=PYMUMBLE_SAMPLE_FORMAT_S16LE):
+        """
+        add sound to be sent (bytes-like or numpy array, in PCM mono 16 bits signed 48000Hz format by default)
+        other formats are converted, down-mixed and resampled (requires numpy), continuously from one call to the next
+        sample_format=PYMUMBLE_SAMPLE_FORMAT_*, the type of a numpy array is used instead (and its columns as channels)
+        """
+        self.add_to_buffer(self.pcm, pcm, sample_rate, channels, sample_format)
+
+    def add_to_buffer(self, buffer, pcm, sample_rate=PYMUMBLE_SAMPLERATE, channels=1, sample_format=PYMUMBLE_SAMPLE_FORMAT_S16LE):
+        """add sound to the PCMBuffer of a source, converted if needed, counting the audio dropped if it is full"""
+        input_format = get_input_format(pcm, sample_rate, channels, sample_format)
+        if input_format == (PYMUMBLE_SAMPLERATE, 1, PYMUMBLE_SAMPLE_FORMAT_S16LE):  # the encoder format, added as it is
+            self.converters.pop(buffer, None)
+            if memoryview(pcm).nbytes % 2 != 0:  # check that the data is align on 16 bits
+                raise Exception("pcm data must be mono 16 bits")
+        else:
+            converter = self.converters.get(buffer)
+            if converter is None or converter.input_format != input_format:  # a new stream
+                converter = self.converters[buffer] = AudioConverter(*input_format)
+            pcm = converter.convert(pcm)
 
-        samples = int(self.encoder_framesize * PYMUMBLE_SAMPLERATE * 2)  # number of samples in an encoder frame
+        was_empty = not self.is_audio()
+        dropped = buffer.add(pcm, self.can_wait)
+        if dropped:
+            self.mumble_object.metrics.inc(PYMUMBLE_METRIC_SOUND_OUTPUT_DROPPED, dropped / 2. / PYMUMBLE_SAMPLERATE)
 
-        self.lock.acquire()
-        if len(self.pcm) and len(self.pcm[-1]) < samples:
-            initial_offset = samples - len(self.pcm[-1])
-            self.pcm[-1] += pcm[:initial_offset]
-        else:
-            initial_offset = 0
-        for i in range(initial_offset, len(pcm), samples):
-            self.pcm.append(pcm[i:i + samples])
-        self.lock.release()
+        if was_empty:  # the sending thread may be waiting without any audio deadline
+            self.wakeup()
+
+    def can_wait(self):
+        """
+        return True if the calling thread can wait for the audio to be sent, when the buffer is full with the blocking policy:
+        the audio is being sent, and not by this thread (library, reactor or event loop thread, pacer)
+        """
+        mumble_thread = self.mumble_object.mumble_thread
+        if self.mumble_object.connected in (PYMUMBLE_CONN_STATE_NOT_CONNECTED, PYMUMBLE_CONN_STATE_FAILED) or \
+                mumble_thread is None or not mumble_thread.is_alive():
+            return False
+
+        current_thread = threading.current_thread()
+        return current_thread is not mumble_thread and current_thread is not self.pacer
+
+    def add_opus_packets(self, packets):
+        """
+        add already encoded Opus packets (like read by OggOpusReader), to be sent as they are, without transcoding
+        they are sent before the pcm added with add_sound.  The packets are not copied, they can be shared between connections
+        """
+        packets = [(packet, get_packet_duration(packet), 0) for packet in packets]
+        for (packet, duration, terminator) in packets:
+            if duration < PYMUMBLE_SEQUENCE_DURATION:  # the sequence numbers count 10ms units
+                raise InvalidSoundDataError("opus packets shorter than 10ms are not supported")
+
+        with self.opus_lock:
+            was_empty = not self.opus_packets and not self.is_pcm()
+            self.opus_packets.extend(packets)
+            self.opus_duration += sum(duration for (packet, duration, terminator) in packets)
+
+        if was_empty:  # the sending thread may be waiting without any audio deadline
+            self.wakeup()
+
+    def send_encoded_frame(self, frame):
+        """
+        add one encoded Opus packet (bytes, or an EncodedFrame received from a user) to be sent as it is, after the ones already added
+        nothing is decoded nor encoded, a relay can forward the audio without any codec cost
+        """
+        if isinstance(frame, EncodedFrame):
+            if frame.type != PYMUMBLE_AUDIO_TYPE_OPUS:
+                raise InvalidSoundDataError("only opus frames can be sent")
+            frame = frame.data
+        self.add_opus_packets((frame,))
+
+    def add_opus_file(self, file):
+        """add the audio of an Ogg Opus file (path or binary file object), sent without transcoding"""
+        self.add_opus_packets(OggOpusReader(file))
 
     def clear_buffer(self):
-        self.lock.acquire()
-        self.pcm = []
-        self.lock.release()
+        with self.opus_lock:
+            self.opus_packets.clear()
+            self.pending_payload = None
+            self.opus_duration = 0
+        if self.mixer is not None:
+            self.mixer.clear()
+        else:
+            self.pcm.clear()
+
+    def play(self, stream, lookahead=PYMUMBLE_STREAM_LOOKAHEAD, source=PYMUMBLE_MIXER_DEFAULT_SOURCE,
+             sample_rate=PYMUMBLE_SAMPLERATE, channels=1, sample_format=PYMUMBLE_SAMPLE_FORMAT_S16LE):
+        """
+        send the audio of a stream (file object, pipe, iterator of chunks, async iterator or asyncio StreamReader),
+        read only as needed to keep lookahead sec buffered.  Return the started AudioStream
+        source=name of the mixer source to feed (created if needed), the audio of add_sound by default
+        sample_rate, channels, sample_format=format of the audio, like add_sound
+        """
+        if source == PYMUMBLE_MIXER_DEFAULT_SOURCE:
+            buffer = self.pcm
+        else:
+            buffer = self.add_source(source).buffer
+
+        stream = AudioStream(self, stream, buffer, lookahead, sample_rate=sample_rate, channels=channels, sample_format=sample_format)
+        stream.start()
+        return stream
+
+    def add_source(self, name, gain=1.0, priority=0, ducking=1.0, capacity=PYMUMBLE_SOUND_OUTPUT_CAPACITY,
+                   overflow=PYMUMBLE_OVERFLOW_GROW):
+        """
+        create a named audio source mixed with the audio of add_sound (the default source) and the other ones, or return the existing one
+        gain=volume factor, ducking=volume factor applied to the sources of lower priority while this one plays
+        capacity and overflow configure the buffer of the source, like the one of add_sound
+        the mixing requires numpy
+        """
+        if self.mixer is None:
+            self.mixer = Mixer(self)
+        return self.mixer.add_source(name, gain, priority, ducking, capacity, overflow)
+
+    def get_source(self, name=PYMUMBLE_MIXER_DEFAULT_SOURCE):
+        """return a named audio source, raise KeyError if it does not exist"""
+        if self.mixer is None:
+            self.mixer = Mixer(self)
+        return self.mixer.get_source(name)
+
+    def remove_source(self, name):
+        """remove a named audio source and its audio"""
+        if self.mixer is None:
+            raise KeyError(name)
+        self.mixer.remove_source(name)
+
+    def set_buffer_capacity(self, capacity, overflow=None):
+        """set the size of the audio buffer in sec, and possibly what to do when it is full (PYMUMBLE_OVERFLOW_*)"""
+        self.pcm.set_capacity(int(capacity * PYMUMBLE_SAMPLERATE) * 2, overflow)
+
+    def get_buffer_capacity(self):
+        """return the size of the audio buffer in sec"""
+        return self.pcm.get_capacity() / 2. / PYMUMBLE_SAMPLERATE
+
+    def get_next_deadline(self):
+        """return the time the next audio packet must be sent by the library thread, or None if there is nothing to send"""
+        if not self.encoder or not self.is_audio() or self.pacer is not None:
+            return None
+        return time() + self.get_next_packet_time() - monotonic()  # the deadlines of the library loop are on the wall clock
 
     def get_buffer_size(self):
         """return the size of the unsent buffer in sec"""
-        return sum(len(chunk) for chunk in self.pcm) / 2. / PYMUMBLE_SAMPLERATE
+        mixer = self.mixer
+        pcm_size = mixer.get_buffer_size() if mixer is not None else len(self.pcm) / 2. / PYMUMBLE_SAMPLERATE
+        return self.opus_duration + pcm_size
 
     def set_default_codec(self, codecversion):
         """Set the default codec to be used to send packets"""
         self.codec = codecversion
         self.create_encoder()
 
+    def set_encoder_settings(self, complexity=None, dtx=None, inband_fec=None, packet_loss=None, signal=None, vbr=None,
+                             vbr_constraint=None):
+        """
+        tune the opus encoder, the settings left to None are not changed.  They are kept for the encoders created later
+        complexity=0 to 10, less CPU for a lower quality at the same bitrate (10 by default)
+        dtx=True to stop sending audio during the silences (discontinuous transmission)
+        inband_fec=True to add to each packet a low bitrate copy of the previous one, to recover a lost packet
+        packet_loss=expected packet loss in percent (0 to 100), the redundancy of the in-band FEC grows with it
+        signal=PYMUMBLE_OPUS_SIGNAL_AUTO, PYMUMBLE_OPUS_SIGNAL_VOICE or PYMUMBLE_OPUS_SIGNAL_MUSIC
+        vbr=False for a constant bitrate
+        vbr_constraint=True to keep the variable bitrate close to the configured one
+        """
+        settings = dict(complexity=complexity, dtx=dtx, inband_fec=inband_fec, packet_loss=packet_loss, signal=signal,
+                        vbr=vbr, vbr_constraint=vbr_constraint)
+        settings = {name: value for (name, value) in settings.items() if value is not None}
+
+        if not 0 <= settings.get("complexity", 0) <= 10:
+            raise ValueError("the complexity must be between 0 and 10")
+        if not 0 <= settings.get("packet_loss", 0) <= 100:
+            raise ValueError("the packet loss must be between 0 and 100")
+        if settings.get("signal", PYMUMBLE_OPUS_SIGNAL_AUTO) not in OPUS_SIGNALS:
+            raise ValueError("Unknown signal type: " + str(signal))
+
+        self.encoder_settings.update(settings)
+        if self.encoder:
+            self.apply_encoder_settings()
+
+    def get_encoder_settings(self):
+        """return the encoder settings changed with set_encoder_settings"""
+        return dict(self.encoder_settings)
+
+    def encoder_ctl(self, request, value=None):
+        """send a request (from opuslib.api.ctl) to the opus encoder, return the result of a get request"""
+        with self.encoder_lock:
+            if hasattr(opuslib.api.encoder, "encoder_ctl"):  # opuslib 3
+                return opuslib.api.encoder.encoder_ctl(self.encoder.encoder_state, request, value)
+            return opuslib.api.encoder.ctl(self.encoder._state, request, value)  # opuslib 2
+
+    def apply_encoder_settings(self):
+        settings = self.encoder_settings
+        with self.encoder_lock:  # not while a frame is encoded
+            if "complexity" in settings:
+                self.encoder.complexity = int(settings["complexity"])
+            if "dtx" in settings:  # not through the property, whose setter sends the getter request
+                self.encoder_ctl(opuslib.api.ctl.set_dtx, int(settings["dtx"]))
+                if self.encoder_ctl(opuslib.api.ctl.get_dtx) != int(settings["dtx"]):
+                    self.Log.warning("the opus encoder did not take the DTX setting")
+            if "inband_fec" in settings:
+                self.encoder.inband_fec = int(settings["inband_fec"])
+            if "packet_loss" in settings:
+                self.encoder.packet_loss_perc = int(settings["packet_loss"])
+            if "signal" in settings:
+                self.encoder.signal = OPUS_SIGNALS[settings["signal"]]
+            if "vbr" in settings:
+                self.encoder.vbr = int(settings["vbr"])
+            if "vbr_constraint" in settings:
+                self.encoder.vbr_constraint = int(settings["vbr_constraint"])
+
     def create_encoder(self):
         """create the encoder instance, and set related constants"""
         if not self.codec:
             return ()
 
-        if self.codec.opus:
-            self.encoder = opuslib.Encoder(PYMUMBLE_SAMPLERATE, 1, self.opus_profile)
-            self.encoder_framesize = self.audio_per_packet
-            self.codec_type = PYMUMBLE_AUDIO_TYPE_OPUS
-        else:
-            raise CodecNotSupportedError('')
+        if opuslib is None:
+            raise ImportError("opuslib and the opus library are required to encode the audio")
 
-        self._set_bandwidth()
+        with self.encoder_lock:  # configured before the pacer encodes with it
+            if self.codec.opus:
+                self.encoder = opuslib.Encoder(PYMUMBLE_SAMPLERATE, 1, self.opus_profile)
+                self.codec_type = PYMUMBLE_AUDIO_TYPE_OPUS
+            else:
+                raise CodecNotSupportedError('')
 
-    def set_whisper(self, target_id, channel=False):
-        if not target_id:
+            self.apply_encoder_settings()
+            self._set_bandwidth()
+
+    def set_whisper(self, target_id, channel=False, links=False, children=False, group=None):
+        """
+        whisper to users (a session or a list of sessions), or to a channel with channel=True
+        links=True to include the channels linked to it, children=True its sub-channels, group=only the members of this group
+        the targets are registered in a voice target slot once, a whisper already used only switches the slot
+        return the slot
+        """
+        if target_id is None or (not channel and not target_id):
             return
-        if type(target_id) is int:
-            target_id = [target_id]
-        self.target = 2
         if channel:
-            self.target = 1
-        cmd = VoiceTarget(self.target, target_id)
-        self.mumble_object.execute_command(cmd)
+            targets = [make_target(channel_id=target_id, links=links, children=children, group=group)]
+        else:
+            targets = [make_target(sessions=target_id)]
+        return self.set_whisper_targets(targets)
+
+    def set_whisper_targets(self, targets):
+        """whisper to several targets at once (list of WhisperTarget, made with make_target), return the slot"""
+        self.target = self.voice_targets.get_slot(targets)
+        return self.target
+
+    def set_voice_target(self, slot):
+        """send the next packets to a voice target slot already registered, without any control message"""
+        self.target = slot
+
+    def get_voice_target(self):
+        return self.target
 
     def remove_whisper(self):
-        self.target = 0
-        cmd = VoiceTarget(self.target, [])
-        self.mumble_object.execute_command(cmd)
+        self.target = PYMUMBLE_VOICE_TARGET_NORMAL
@@ -3,7 +3,10 @@ import time
 from threading import Lock
 from collections import deque
 
-import opuslib
+try:
+    import opuslib
+except Exception:  # opuslib raises a bare Exception when the opus library is missing
+    opuslib = None
 
 from .constants import *
 
@@ -24,11 +27,9 @@ class SoundQueue:
         
         self.lock = Lock()
         
-        # to be sure, create every supported decoders for all users
+        # decoders by audio type, created when the first frame of the type is decoded
         # sometime, clients still use a codec for a while after server request another...
-        self.decoders = {
-                    PYMUMBLE_AUDIO_TYPE_OPUS: opuslib.Decoder(PYMUMBLE_SAMPLERATE, 1)
-        }
+        self.decoders = dict()
 
     def set_receive_sound(self, value):
         """Define if received sounds must be kept or discarded in this specific queue (user)"""
@@ -45,7 +46,9 @@ class SoundQueue:
         self.lock.acquire()
         
         try:
-            pcm = self.decoders[type].decode(audio, PYMUMBLE_READ_BUFFER_SIZE)
+            decode_start = time.perf_counter()
+            pcm = self.get_decoder(type).decode(audio, PYMUMBLE_READ_BUFFER_SIZE)
+            self.mumble_object.metrics.observe(PYMUMBLE_METRIC_DECODE_TIME, time.perf_counter() - decode_start)
 
             if not self.start_sequence or sequence <= self.start_sequence:
                 # New sequence started
@@ -76,6 +79,17 @@ class SoundQueue:
             self.lock.release()
             self.mumble_object.Log.error("error while decoding audio. sequence:{seq}, type:{type}. {error}".format(seq=sequence, type=type, error=str(e)))
 
+    def get_decoder(self, type):
+        """Return the decoder for an audio type, raise KeyError if the type is not supported"""
+        decoder = self.decoders.get(type)
+        if decoder is None:
+            if type != PYMUMBLE_AUDIO_TYPE_OPUS:
+                raise KeyError(type)
+            if opuslib is None:
+                raise ImportError("opuslib and the opus library are required to decode the audio")
+            decoder = self.decoders[type] = opuslib.Decoder(PYMUMBLE_SAMPLERATE, 1)
+        return decoder
+
     def is_sound(self):
         """Boolean to check if there is a sound frame in the queue"""
         if len(self.queue) > 0:
@@ -98,6 +112,15 @@ class SoundQueue:
         self.lock.release()
         return result
     
+    def discard_sound(self, sound):
+        """Remove a specific sound from the queue, when it was consumed by other means"""
+        self.lock.acquire()
+        try:
+            self.queue.remove(sound)
+        except ValueError:
+            pass
+        self.lock.release()
+
     def first_sound(self):
         """Return the first sound of the queue, but keep it"""
         if len(self.queue) > 0:
@@ -138,3 +161,16 @@ class SoundChunk:
         self.size -= size
         
         return result
+
+
+class EncodedFrame:
+    """
+    Audio frame as received from the server, not decoded.  Can be sent again as is with SoundOutput.send_encoded_frame
+    """
+    def __init__(self, data, session, sequence, type, target, timestamp=None):
+        self.data = data  # encoded audio (an Opus packet for PYMUMBLE_AUDIO_TYPE_OPUS)
+        self.session = session  # session of the user who sent it
+        self.sequence = sequence  # sequence of the packet
+        self.type = type  # type of the audio (codec)
+        self.target = target  # target of the audio, as sent by the server
+        self.timestamp = time.time() if timestamp is None else timestamp  # measured time of arrival
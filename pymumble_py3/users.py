@@ -6,6 +6,14 @@ from . import soundqueue
 from . import messages
 from . import mumble_pb2
 
+
+def get_identity(user_id, name):
+    """Return what identifies a user across connections, the sessions being renumbered: its registration, or else its name"""
+    if user_id is not None:
+        return ("user_id", user_id)
+    return ("name", name)
+
+
 class Users(dict):
     """Object that stores and update all connected users"""
 
@@ -15,33 +23,61 @@ class Users(dict):
 
         self.myself = None  # user object of the pymumble thread itself
         self.myself_session = None  # session number of the pymumble thread itself
+        self.previous = dict()  # users of the previous connection not seen again yet, by identity
         self.lock = Lock()
 
+    def start_resync(self):
+        """
+        Put aside the known users when connecting again.  The users sent by the server are matched with them,
+        so that only the real changes are signaled to the callbacks
+        """
+        with self.lock:
+            for user in self.values():  # added to the ones of a previous attempt that did not complete, if any
+                self.previous[get_identity(user.get("user_id"), user.get("name"))] = user
+            self.clear()
+            self.myself = None  # found again with the new session
+            self.myself_session = None  # the sessions are renumbered by the server
+
+    def end_resync(self):
+        """Remove the users of the previous connection that the server did not send again"""
+        with self.lock:
+            previous, self.previous = self.previous, dict()
+            for user in previous.values():
+                message = mumble_pb2.UserRemove()
+                message.session = user["session"]
+                self.callbacks(PYMUMBLE_CLBK_USERREMOVED, user, message)
+
     def update(self, message):
         """Update a user information, based on the incoming message"""
-        self.lock.acquire()
-
-        if message.session not in self:
-            self[message.session] = User(self.mumble_object, message)
-            self.callbacks(PYMUMBLE_CLBK_USERCREATED, self[message.session])
-            if message.session == self.myself_session:
-                self.myself = self[message.session]
-        else:
-            actions = self[message.session].update(message)
-            self.callbacks(PYMUMBLE_CLBK_USERUPDATED, self[message.session], actions)
-
-        self.lock.release()
+        with self.lock:
+            if message.session not in self:
+                user = None
+                if self.previous:
+                    user_id = message.user_id if message.HasField("user_id") else None
+                    user = self.previous.pop(get_identity(user_id, message.name), None)
+
+                if user is not None:  # known before the reconnection
+                    self[message.session] = user
+                    actions = user.resync(message)
+                    if actions:
+                        self.callbacks(PYMUMBLE_CLBK_USERUPDATED, user, actions)
+                else:
+                    self[message.session] = User(self.mumble_object, message)
+                    self.callbacks(PYMUMBLE_CLBK_USERCREATED, self[message.session])
+
+                if message.session == self.myself_session:
+                    self.myself = self[message.session]
+            else:
+                actions = self[message.session].update(message)
+                self.callbacks(PYMUMBLE_CLBK_USERUPDATED, self[message.session], actions)
 
     def remove(self, message):
         """Remove a user object based on server info"""
-        self.lock.acquire()
-
-        if message.session in self:
-            user = self[message.session]
-            del self[message.session]
-            self.callbacks(PYMUMBLE_CLBK_USERREMOVED, user, message)
-
-        self.lock.release()
+        with self.lock:
+            if message.session in self:
+                user = self[message.session]
+                del self[message.session]
+                self.callbacks(PYMUMBLE_CLBK_USERREMOVED, user, message)
 
     def set_myself(self, session):
         """Set the "myself" user"""
@@ -90,6 +126,20 @@ class User(dict):
 
         return actions  # return a dict, useful for the callback functions
 
+    def resync(self, message):
+        """Replace the whole state with the one sent on a new connection.  Return the changed fields, None for the removed ones"""
+        previous = dict(self)
+
+        self.clear()
+        self["session"] = message.session
+        self["channel_id"] = 0
+        self.update(message)
+
+        actions = {name: value for (name, value) in self.items() if name not in previous or previous[name] != value}
+        actions.update({name: None for name in previous if name not in self})
+
+        return actions
+
     def update_field(self, name, field):
         """Update one state value for a user"""
         actions = dict()
@@ -115,7 +165,7 @@ class User(dict):
             params["mute"] = True
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def unmute(self):
         """Unmute a user"""
@@ -127,7 +177,7 @@ class User(dict):
             params["mute"] = False
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def deafen(self):
         """Deafen a user"""
@@ -139,7 +189,7 @@ class User(dict):
             params["deaf"] = True
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def undeafen(self):
         """Undeafen a user"""
@@ -151,7 +201,7 @@ class User(dict):
             params["deaf"] = False
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def suppress(self):
         """Disable a user"""
@@ -159,7 +209,7 @@ class User(dict):
                   "suppress": True}
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def unsuppress(self):
         """Enable a user"""
@@ -167,7 +217,7 @@ class User(dict):
                   "suppress": False}
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def recording(self):
         """Set the user as recording"""
@@ -175,7 +225,7 @@ class User(dict):
                   "recording": True}
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def unrecording(self):
         """Set the user as not recording"""
@@ -183,7 +233,7 @@ class User(dict):
                   "recording": False}
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def comment(self, comment):
         """Set the user comment"""
@@ -191,7 +241,7 @@ class User(dict):
                   "comment": comment}
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def texture(self, texture):
         """Set the user texture"""
@@ -199,7 +249,7 @@ class User(dict):
                   "texture": texture}
 
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
     
     def register(self):
         """Register the user (mostly for myself)"""
@@ -207,7 +257,7 @@ class User(dict):
                   "user_id": 0}
  
         cmd = messages.ModUserState(self.mumble_object.users.myself_session, params)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def move_in(self, channel_id, token=None):
         if token:
@@ -222,7 +272,7 @@ class User(dict):
 
         session = self.mumble_object.users.myself_session
         cmd = messages.MoveCmd(session, channel_id)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
 
     def send_text_message(self, message):
         """Send a text message to the user."""
@@ -238,4 +288,4 @@ class User(dict):
                 raise TextTooLongError(self.mumble_object.get_max_message_length())
 
         cmd = messages.TextPrivateMessage(self["session"], message)
-        self.mumble_object.execute_command(cmd)
+        return self.mumble_object.execute_command(cmd)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict, namedtuple
+
+from .constants import *
+from .errors import VoiceTargetSlotsFullError
+from .messages import VoiceTarget
+
+# one whisper target: some users by their sessions, or a channel (and its linked channels, its sub-channels,
+# only the members of a group of it)
+WhisperTarget = namedtuple("WhisperTarget", ("sessions", "channel_id", "links", "children", "group"))
+
+
+def make_target(sessions=(), channel_id=None, links=False, children=False, group=None):
+    """return a WhisperTarget, the same for the same users whatever their order"""
+    if isinstance(sessions, int):
+        sessions = (sessions,)
+    return WhisperTarget(tuple(sorted(set(sessions))), channel_id, bool(links), bool(children), group or None)
+
+
+class VoiceTargets:
+    """
+    Manage the voice target slots of the server: a set of whisper targets is registered once in a slot, then selected
+    packet by packet without any control message.  An identical set of targets reuses its slot, and when all the slots
+    are taken, the least recently used one is replaced, except the slots the sound outputs are sending to
+    """
+
+    def __init__(self, mumble_object):
+        self.mumble_object = mumble_object
+        self.lock = threading.Lock()
+        self.slots = OrderedDict()  # frozenset of WhisperTarget -> slot, the least recently used first
+        self.free = list(range(PYMUMBLE_VOICE_TARGET_FIRST_SLOT, PYMUMBLE_VOICE_TARGET_LAST_SLOT + 1))
+
+    def get_slot(self, targets):
+        """return the slot of a set of WhisperTarget, registered on the server first if it is not already"""
+        key = frozenset(targets)
+        if not key:
+            raise ValueError("no whisper target")
+
+        used = self.get_used_slots()
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is not None:
+                self.slots.move_to_end(key)
+                return slot
+
+            if self.free:
+                slot = self.free.pop(0)
+            else:
+                replaced = next((other for (other, other_slot) in self.slots.items() if other_slot not in used), None)
+                if replaced is None:
+                    raise VoiceTargetSlotsFullError("all the voice target slots are used by the sound outputs")
+                slot = self.slots.pop(replaced)
+                self.mumble_object.Log.debug("voice target slot %i reused, it was the least recently used", slot)
+            self.slots[key] = slot
+
+        self.mumble_object.execute_command(VoiceTarget(slot, list(key)))
+        return slot
+
+    def get_used_slots(self):
+        """return the slots the sound outputs are currently sending their audio to, they cannot be replaced"""
+        return {sound_output.target for sound_output in self.mumble_object.get_sound_outputs().values()}
+
+    def get_slots(self):
+        """return a dict of the registered slots: slot -> list of WhisperTarget"""
+        with self.lock:
+            return {slot: list(key) for (key, slot) in self.slots.items()}
+
+    def restore(self):
+        """register the slots again on a new connection.  Called from the library thread"""
+        for (slot, targets) in self.get_slots().items():
+            self.mumble_object.commands.new_cmd(VoiceTarget(slot, targets))
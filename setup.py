@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup  # distutils ignores python_requires
 
 setup(
     name="pymumble",
@@ -11,13 +11,16 @@ setup(
     url='https://github.com/azlux/pymumble',
     license='GPLv3',
     packages=['pymumble_py3'],
+    python_requires='>=3.7',  # time.monotonic_ns
+    extras_require={'mixer': ['numpy']},  # mixer, audio conversion and noise gate
     download_url='https://github.com/azlux/pymumble/archive/pymumble_py3.zip',
     classifiers=['Development Status :: 3 - Alpha',
                  'Intended Audience :: Developers',
                  'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
                  'Programming Language :: Python :: 3',
-                 'Programming Language :: Python :: 3.3',
-                 'Programming Language :: Python :: 3.4',
-                 'Programming Language :: Python :: 3.5',
-                 'Programming Language :: Python :: 3.6',]
+                 'Programming Language :: Python :: 3.7',
+                 'Programming Language :: Python :: 3.8',
+                 'Programming Language :: Python :: 3.9',
+                 'Programming Language :: Python :: 3.10',
+                 'Programming Language :: Python :: 3.11',]
 )
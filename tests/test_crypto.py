@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from pymumble_py3.crypto import CryptStateOCB2, is_crypto_available
+
+# test vectors of the OCB2 draft (draft-krovetz-ocb-00), also checked by Mumble
+KEY = bytes(range(16))
+NONCE = bytes(range(16))
+EMPTY_TAG = bytes.fromhex("bf3108130773ad5ec70ec69e7875a7b0")
+PLAIN = bytes(range(40))
+ENCRYPTED = bytes.fromhex("f75d6bc8b4dc8d66b836a2b08b32a6369f1cd3c5228d79fd6c267f5f6aa7b231c7dfb9d59951ae9c")
+TAG = bytes.fromhex("9db0cdf880f73e3e10d4eb3217766688")
+
+
+@unittest.skipUnless(is_crypto_available(), "cryptography is not installed")
+class CryptStateOCB2Test(unittest.TestCase):
+    def setUp(self):
+        (client_nonce, server_nonce) = (bytes(range(1, 17)), bytes(range(17, 33)))
+        self.client = CryptStateOCB2()
+        self.client.set_key(KEY, client_nonce, server_nonce)
+        self.server = CryptStateOCB2()  # the nonces the other way round
+        self.server.set_key(KEY, server_nonce, client_nonce)
+
+    def test_vectors(self):
+        self.assertEqual(self.client.ocb_encrypt(b"", NONCE), (b"", EMPTY_TAG))
+        self.assertEqual(self.client.ocb_encrypt(PLAIN, NONCE), (ENCRYPTED, TAG))
+        self.assertEqual(self.client.ocb_decrypt(ENCRYPTED, NONCE), (PLAIN, TAG))
+
+    def test_round_trip(self):
+        for size in (0, 1, 15, 16, 17, 100):
+            packet = bytes(range(size))
+            self.assertEqual(self.server.decrypt(self.client.encrypt(packet)), packet)
+        self.assertEqual((self.server.good, self.server.late, self.server.lost), (6, 0, 0))
+
+    def test_tampered(self):
+        encrypted = bytearray(self.client.encrypt(b"audio packet"))
+        encrypted[-1] ^= 1
+        self.assertIsNone(self.server.decrypt(bytes(encrypted)))
+        self.assertEqual(self.server.good, 0)
+
+    def test_replayed(self):
+        encrypted = self.client.encrypt(b"audio packet")
+        self.assertEqual(self.server.decrypt(encrypted), b"audio packet")
+        self.assertIsNone(self.server.decrypt(encrypted))
+
+    def test_lost_and_late(self):
+        packets = [self.client.encrypt(bytes((i,))) for i in range(4)]
+        self.assertEqual(self.server.decrypt(packets[0]), b"\0")
+        self.assertEqual(self.server.decrypt(packets[2]), b"\2")
+        self.assertEqual(self.server.lost, 1)
+        self.assertEqual(self.server.decrypt(packets[1]), b"\1")  # late, not lost after all
+        self.assertEqual(self.server.decrypt(packets[3]), b"\3")
+        self.assertEqual((self.server.good, self.server.late, self.server.lost), (4, 1, 0))
+
+    def test_lost_never_negative(self):
+        packets = [self.client.encrypt(bytes((i,))) for i in range(2)]
+        self.server.set_decrypt_iv(self.client.get_encrypt_iv())  # resync after the packets were sent
+        self.assertEqual(self.server.decrypt(packets[0]), b"\0")  # late, without being counted as lost before
+        self.assertEqual((self.server.late, self.server.lost), (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+try:
+    import opuslib
+except Exception as e:  # opuslib raises a bare Exception when the opus library is missing
+    raise unittest.SkipTest("opuslib is not usable: %s" % e)
+
+from pymumble_py3 import Mumble, mumble_pb2
+from pymumble_py3.constants import *
+
+
+class EncoderSettingsTest(unittest.TestCase):
+    def setUp(self):
+        self.mumble = Mumble("localhost", "test")
+        self.sound_output = self.mumble.sound_output
+        self.sound_output.set_default_codec(mumble_pb2.CodecVersion(alpha=0, beta=0, prefer_alpha=True, opus=True))
+
+    def test_dtx_is_set(self):
+        self.sound_output.set_encoder_settings(dtx=True)
+        self.assertEqual(self.sound_output.encoder_ctl(opuslib.api.ctl.get_dtx), 1)
+        self.sound_output.set_encoder_settings(dtx=False)
+        self.assertEqual(self.sound_output.encoder_ctl(opuslib.api.ctl.get_dtx), 0)
+
+    def test_settings_kept_by_new_encoder(self):
+        self.sound_output.set_encoder_settings(complexity=3, dtx=True, signal=PYMUMBLE_OPUS_SIGNAL_VOICE)
+        self.sound_output.create_encoder()
+        self.assertEqual(self.sound_output.encoder.complexity, 3)
+        self.assertEqual(self.sound_output.encoder.signal, 3001)
+        self.assertEqual(self.sound_output.encoder_ctl(opuslib.api.ctl.get_dtx), 1)
+
+    def test_dtx_keeps_the_added_opus_packets(self):
+        self.sound_output.set_encoder_settings(dtx=True)
+        sent = list()
+        self.mumble.send_audio_packet = sent.append
+        self.sound_output.add_opus_packets([bytes((31 << 3, 1))])  # as small as a DTX frame, but not from the encoder
+        self.sound_output.send_packet(self.sound_output.encode_payload(), 100)
+        self.assertEqual(len(sent), 1)
+
+    def test_invalid_settings(self):
+        for settings in (dict(complexity=11), dict(packet_loss=101), dict(signal="noise")):
+            with self.assertRaises(ValueError):
+                self.sound_output.set_encoder_settings(**settings)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from pymumble_py3.errors import InvalidSoundDataError
+from pymumble_py3.oggopus import get_packet_duration, get_packet_frames, repacketize
+
+CELT_20MS = 31 << 3  # TOC of a fullband CELT 20ms frame, mono
+CELT_10MS = 30 << 3
+SILK_20MS = 1 << 3  # narrowband SILK 20ms
+
+
+def frames_of(packet):
+    (toc, frames) = get_packet_frames(packet)
+    return (toc, [bytes(frame) for frame in frames])
+
+
+class OpusPacketTest(unittest.TestCase):
+    def test_duration(self):
+        self.assertAlmostEqual(get_packet_duration(bytes((CELT_20MS, 1, 2))), 0.02)
+        self.assertAlmostEqual(get_packet_duration(bytes((CELT_10MS | 1, 1, 2))), 0.02)  # 2 frames
+        self.assertAlmostEqual(get_packet_duration(bytes((SILK_20MS | 3, 3))), 0.06)  # 3 frames
+        with self.assertRaises(InvalidSoundDataError):
+            get_packet_duration(b"")
+
+    def test_frames(self):
+        self.assertEqual(frames_of(bytes((CELT_20MS, 1, 2, 3))), (CELT_20MS, [b"\1\2\3"]))
+        self.assertEqual(frames_of(bytes((CELT_20MS | 1, 1, 2, 3, 4))), (CELT_20MS, [b"\1\2", b"\3\4"]))
+        self.assertEqual(frames_of(bytes((CELT_20MS | 2, 1, 7, 8, 9))), (CELT_20MS, [b"\7", b"\x08\x09"]))
+        # 3 frames of variable size, with 2 bytes of padding
+        packet = bytes((CELT_20MS | 3, 0xc3, 2, 1, 2, 1, 2, 3, 4, 0, 0))
+        self.assertEqual(frames_of(packet), (CELT_20MS, [b"\1", b"\2\3", b"\4"]))
+        with self.assertRaises(InvalidSoundDataError):
+            get_packet_frames(bytes((CELT_20MS | 2, 5, 1)))
+
+    def test_repacketize(self):
+        packets = [bytes((CELT_20MS, 1, 2)), bytes((CELT_20MS, 3, 4))]
+        merged = repacketize(packets)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(frames_of(merged[0]), (CELT_20MS, [b"\1\2", b"\3\4"]))
+        self.assertAlmostEqual(get_packet_duration(merged[0]), 0.04)
+
+        merged = repacketize([bytes((CELT_20MS, 1)), bytes((CELT_20MS, 2, 3, 4))])  # variable bitrate
+        self.assertEqual(frames_of(merged[0]), (CELT_20MS, [b"\1", b"\2\3\4"]))
+
+        long_frame = bytes((CELT_20MS,)) + bytes(range(255)) * 2  # frame length on 2 bytes
+        merged = repacketize([long_frame, bytes((CELT_20MS, 1))])
+        self.assertEqual(frames_of(merged[0]), (CELT_20MS, [long_frame[1:], b"\1"]))
+
+    def test_repacketize_split(self):
+        packets = [bytes((CELT_20MS, 1)), bytes((SILK_20MS, 2)), bytes((SILK_20MS, 3))]  # the mode changed
+        merged = repacketize(packets)
+        self.assertEqual([frames_of(packet) for packet in merged], [(CELT_20MS, [b"\1"]), (SILK_20MS, [b"\2", b"\3"])])
+
+        merged = repacketize([bytes((CELT_20MS, i)) for i in range(8)])  # at most 120ms per packet
+        self.assertEqual([round(get_packet_duration(packet), 3) for packet in merged], [0.12, 0.04])
+
+
+if __name__ == "__main__":
+    unittest.main()
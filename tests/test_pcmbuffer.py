@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+
+from pymumble_py3.constants import *
+from pymumble_py3.pcmbuffer import PCMBuffer
+
+
+class PCMBufferTest(unittest.TestCase):
+    def test_wrap_around(self):
+        buffer = PCMBuffer(10)
+        buffer.add(b"abcdef")
+        self.assertEqual(bytes(buffer.take(4)), b"abcd")
+        buffer.add(b"ghijkl")  # wraps around the end
+        self.assertEqual(len(buffer), 8)
+        self.assertEqual(bytes(buffer.take(4)), b"efgh")
+        self.assertEqual(bytes(buffer.take(4)), b"ijkl")
+        self.assertIsNone(buffer.take(4))
+
+    def test_padding(self):
+        buffer = PCMBuffer(10)
+        buffer.add(b"ab")
+        self.assertEqual(bytes(buffer.take(4)), b"ab\0\0")
+
+    def test_frame_not_overwritten(self):
+        buffer = PCMBuffer(8, PYMUMBLE_OVERFLOW_DROP_NEWEST)
+        buffer.add(b"abcdefgh")
+        frame = buffer.take(4)  # a view on the buffer, being encoded
+        self.assertEqual(buffer.add(b"ijklmn"), 6)
+        self.assertEqual(bytes(frame), b"abcd")
+        self.assertEqual(bytes(buffer.take(4)), b"efgh")  # abcd is released, efgh is now read
+        self.assertEqual(buffer.add(b"ijklmn"), 2)
+        self.assertEqual(bytes(buffer.take(4)), b"ijkl")
+
+    def test_grow(self):
+        buffer = PCMBuffer(4)
+        self.assertEqual(buffer.add(b"abcdefghij"), 0)
+        self.assertGreaterEqual(buffer.get_capacity(), 10)
+        self.assertEqual(bytes(buffer.take(10)), b"abcdefghij")
+
+    def test_drop_newest(self):
+        buffer = PCMBuffer(6, PYMUMBLE_OVERFLOW_DROP_NEWEST)
+        self.assertEqual(buffer.add(b"abcdefgh"), 2)
+        self.assertEqual(bytes(buffer.take(6)), b"abcdef")
+
+    def test_drop_oldest(self):
+        buffer = PCMBuffer(6, PYMUMBLE_OVERFLOW_DROP_OLDEST)
+        buffer.add(b"abcd")
+        self.assertEqual(buffer.add(b"efgh"), 2)
+        self.assertEqual(bytes(buffer.take(6)), b"cdefgh")
+        self.assertEqual(buffer.add(b"0123456789"), 4)  # more than the whole buffer
+        self.assertEqual(bytes(buffer.take(6)), b"456789")
+
+    def test_block(self):
+        buffer = PCMBuffer(4, PYMUMBLE_OVERFLOW_BLOCK)
+        buffer.add(b"abcd")
+        taken = list()
+
+        def take():  # like the encoder, also releasing the frame being read
+            while len(taken) < 3:
+                frame = buffer.take(4)
+                if frame is not None:
+                    taken.append(bytes(frame))
+                buffer.wait_below(1, 0.01)
+
+        thread = threading.Thread(target=take)
+        thread.start()
+        self.assertEqual(buffer.add(b"efghijkl", lambda: True), 0)
+        thread.join(5)
+        self.assertEqual(taken, [b"abcd", b"efgh", b"ijkl"])
+
+    def test_block_without_waiting(self):
+        buffer = PCMBuffer(4, PYMUMBLE_OVERFLOW_BLOCK)
+        self.assertEqual(buffer.add(b"abcdef"), 2)
+        self.assertEqual(buffer.add(b"gh", lambda: False), 2)
+        self.assertEqual(bytes(buffer.take(4)), b"abcd")
+
+
+if __name__ == "__main__":
+    unittest.main()
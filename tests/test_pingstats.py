@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+from pymumble_py3.constants import *
+from pymumble_py3 import pingstats
+
+
+class PingStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = 1000000  # in microseconds, like the timestamps of the pings
+        patcher = mock.patch.object(pingstats, "get_timestamp", lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stats = pingstats.PingStats()
+
+    def ping(self, rtt):
+        """send a ping answered after rtt ms, return the measure"""
+        timestamp = self.stats.sent()
+        self.clock += int(rtt * 1000)
+        return self.stats.received(timestamp)
+
+    def test_statistics(self):
+        for rtt in (10, 20, 30, 20):
+            self.assertEqual(self.ping(rtt), rtt)
+        self.assertEqual(self.stats.nb, 4)
+        self.assertAlmostEqual(self.stats.avg, 20)
+        self.assertAlmostEqual(self.stats.var, 50)
+        self.assertEqual(self.stats.last, 20)
+        self.assertAlmostEqual(self.stats.jitter, 10 * PYMUMBLE_PING_JITTER_GAIN * (3 - 3 * PYMUMBLE_PING_JITTER_GAIN +
+                                                                                 PYMUMBLE_PING_JITTER_GAIN ** 2))
+
+    def test_overlapping_pings(self):
+        first = self.stats.sent()
+        self.clock += 5000
+        second = self.stats.sent()
+        self.clock += 10000
+        self.assertEqual(self.stats.received(second), 10)  # answered out of order
+        self.assertEqual(self.stats.received(first), 15)
+        self.assertIsNone(self.stats.received(first))  # already answered
+
+    def test_unknown_timestamp(self):
+        self.assertIsNone(self.stats.received(12345))
+        self.assertEqual(self.stats.nb, 0)
+
+    def test_pending_limit(self):
+        timestamps = list()
+        for i in range(PYMUMBLE_PING_PENDING_MAX + 1):
+            timestamps.append(self.stats.sent())
+            self.clock += 1
+        self.assertIsNone(self.stats.received(timestamps[0]))  # forgotten, never answered
+        self.assertIsNotNone(self.stats.received(timestamps[-1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import socket
+import struct
+import threading
+import unittest
+
+from pymumble_py3 import Mumble, Reactor, mumble_pb2
+from pymumble_py3.constants import *
+
+
+class ReactorTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = Reactor()
+        self.reactor.daemon = True
+        self.reactor.start()
+        self.addCleanup(self.reactor.join, 5)
+        self.addCleanup(self.reactor.stop)
+
+    def add_session(self):
+        """host a connected session, without network: return it and the server end of its control connection"""
+        mumble_object = Mumble("localhost", "bot")
+        mumble_object.reactor = self.reactor
+        mumble_object.mumble_thread = self.reactor
+        mumble_object.init_connection()
+        (mumble_object.control_socket, server) = socket.socketpair()
+        mumble_object.control_socket.setblocking(False)
+        mumble_object.connected = PYMUMBLE_CONN_STATE_CONNECTED
+        self.addCleanup(server.close)
+
+        with self.reactor.lock:
+            self.reactor.sessions.add(mumble_object)
+            self.reactor.connected_sessions.append(mumble_object)
+        self.reactor.wakeup()
+        return (mumble_object, server)
+
+    @staticmethod
+    def send_user(server, session):
+        message = mumble_pb2.UserState(session=session, name="user%i" % session).SerializeToString()
+        server.sendall(struct.pack("!HL", PYMUMBLE_MSG_TYPES_USERSTATE, len(message)) + message)
+
+    def test_callback_error_drops_only_its_session(self):
+        (failing, failing_server) = self.add_session()
+        (working, working_server) = self.add_session()
+
+        def fail(user):
+            raise ValueError("bug in a bot")
+
+        created = threading.Event()
+        failing.callbacks.set_callback(PYMUMBLE_CLBK_USERCREATED, fail)
+        working.callbacks.set_callback(PYMUMBLE_CLBK_USERCREATED, lambda user: created.set())
+
+        self.send_user(failing_server, 1)
+        failing_server.settimeout(5)
+        while failing_server.recv(PYMUMBLE_READ_BUFFER_SIZE):  # until disconnected, after the pings if any
+            pass
+        self.assertEqual(failing.connected, PYMUMBLE_CONN_STATE_NOT_CONNECTED)
+
+        self.send_user(working_server, 2)
+        self.assertTrue(created.wait(5))
+        self.assertTrue(self.reactor.is_alive())
+        self.assertEqual(working.connected, PYMUMBLE_CONN_STATE_CONNECTED)
+        self.assertIn(1, failing.users)  # the lock of the users is released
+
+
+if __name__ == "__main__":
+    unittest.main()
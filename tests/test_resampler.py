@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    raise unittest.SkipTest("numpy is not installed")
+
+from pymumble_py3.constants import *
+from pymumble_py3.resampler import AudioConverter, Resampler
+
+
+def sine(frequency, rate, duration, amplitude=10000.):
+    return (amplitude * numpy.sin(2 * numpy.pi * frequency * numpy.arange(int(rate * duration)) / rate)).astype(numpy.float32)
+
+
+def level(samples):
+    return numpy.sqrt(numpy.mean(numpy.square(samples, dtype=numpy.float64)))
+
+
+class ResamplerTest(unittest.TestCase):
+    def test_length(self):
+        for rate in (8000, 16000, 22050, 44100, 96000):
+            resampler = Resampler(rate, PYMUMBLE_SAMPLERATE)
+            output = resampler.process(numpy.zeros(rate, dtype=numpy.float32))
+            self.assertAlmostEqual(len(output), PYMUMBLE_SAMPLERATE, delta=1)
+
+    def test_chunks(self):
+        signal = sine(440, 44100, 0.5)
+        whole = Resampler(44100, PYMUMBLE_SAMPLERATE).process(signal)
+
+        resampler = Resampler(44100, PYMUMBLE_SAMPLERATE)
+        chunks = [resampler.process(signal[start:start + 1000]) for start in range(0, len(signal), 1000)]
+        numpy.testing.assert_allclose(numpy.concatenate(chunks), whole, atol=0.01)
+
+    def test_signal(self):
+        for rate in (16000, 44100):
+            output = Resampler(rate, PYMUMBLE_SAMPLERATE).process(sine(1000, rate, 1))[1000:]  # after the start of the filter
+            spectrum = numpy.abs(numpy.fft.rfft(output))
+            self.assertAlmostEqual(numpy.argmax(spectrum) * PYMUMBLE_SAMPLERATE / len(output), 1000, delta=2)
+            self.assertAlmostEqual(level(output), level(sine(1000, PYMUMBLE_SAMPLERATE, 1)), delta=10000 * 0.01)
+
+    def test_anti_aliasing(self):
+        output = Resampler(96000, PYMUMBLE_SAMPLERATE).process(sine(30000, 96000, 0.5))  # above the output Nyquist frequency
+        self.assertLess(level(output[1000:]), 10000 * 0.01)
+
+
+class AudioConverterTest(unittest.TestCase):
+    def test_down_mix(self):
+        converter = AudioConverter(PYMUMBLE_SAMPLERATE, 2, PYMUMBLE_SAMPLE_FORMAT_S16LE)
+        stereo = numpy.array([[1000, 3000], [-200, 200]], dtype="<i2")
+        self.assertEqual(converter.convert(stereo.tobytes()).tolist(), [2000, 0])
+
+    def test_incomplete_samples(self):
+        converter = AudioConverter(PYMUMBLE_SAMPLERATE, 2, PYMUMBLE_SAMPLE_FORMAT_S16LE)
+        data = numpy.array([100, 300, 500, 700], dtype="<i2").tobytes()
+        self.assertEqual(converter.convert(data[:3]).tolist(), [])
+        self.assertEqual(converter.convert(data[3:6]).tolist(), [200])
+        self.assertEqual(converter.convert(data[6:]).tolist(), [600])
+
+    def test_formats(self):
+        converter = AudioConverter(PYMUMBLE_SAMPLERATE, 1, PYMUMBLE_SAMPLE_FORMAT_F32LE)
+        self.assertEqual(converter.convert(numpy.array([0.5, -2.], dtype="<f4").tobytes()).tolist(), [16384, -32768])
+        converter = AudioConverter(PYMUMBLE_SAMPLERATE, 1, PYMUMBLE_SAMPLE_FORMAT_S32LE)
+        self.assertEqual(converter.convert(numpy.array([65536 * 100], dtype="<i4")).tolist(), [100])
+
+
+if __name__ == "__main__":
+    unittest.main()
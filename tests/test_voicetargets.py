@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import logging
+import unittest
+
+from pymumble_py3.constants import *
+from pymumble_py3.errors import VoiceTargetSlotsFullError
+from pymumble_py3.voicetargets import VoiceTargets, make_target
+
+
+class FakeOutput:
+    def __init__(self, target=PYMUMBLE_VOICE_TARGET_NORMAL):
+        self.target = target
+
+
+class FakeMumble:
+    """Record the commands instead of sending them"""
+
+    Log = logging.getLogger("test")
+
+    def __init__(self):
+        self.commands = list()
+        self.outputs = {PYMUMBLE_DEFAULT_SOUND_OUTPUT: FakeOutput()}
+
+    def execute_command(self, cmd):
+        self.commands.append(cmd)
+
+    def get_sound_outputs(self):
+        return self.outputs
+
+
+class VoiceTargetsTest(unittest.TestCase):
+    def setUp(self):
+        self.mumble = FakeMumble()
+        self.voice_targets = VoiceTargets(self.mumble)
+
+    def test_same_targets_reuse_the_slot(self):
+        slot = self.voice_targets.get_slot([make_target(sessions=[3, 5])])
+        self.assertEqual(slot, PYMUMBLE_VOICE_TARGET_FIRST_SLOT)
+        self.assertEqual(self.voice_targets.get_slot([make_target(sessions=[5, 3, 3])]), slot)
+        self.assertEqual(len(self.mumble.commands), 1)
+
+        channel = self.voice_targets.get_slot([make_target(channel_id=3, links=True, group="admin")])
+        self.assertNotEqual(channel, slot)
+        self.assertEqual(self.mumble.commands[-1].parameters["id"], channel)
+        self.assertEqual(self.mumble.commands[-1].parameters["targets"][0].group, "admin")
+
+    def test_least_recently_used_is_replaced(self):
+        for session in range(30):
+            self.voice_targets.get_slot([make_target(sessions=session)])
+        self.voice_targets.get_slot([make_target(sessions=0)])  # now the most recently used
+        slot = self.voice_targets.get_slot([make_target(sessions=100)])
+        self.assertEqual(slot, 2)  # the one of session 1
+        self.assertEqual(self.voice_targets.get_slot([make_target(sessions=0)]), 1)
+        self.assertEqual(len(self.mumble.commands), 31)
+
+    def test_used_slots_are_not_replaced(self):
+        for session in range(30):
+            self.voice_targets.get_slot([make_target(sessions=session)])
+        self.mumble.outputs["music"] = FakeOutput(1)
+        self.mumble.outputs[PYMUMBLE_DEFAULT_SOUND_OUTPUT].target = 2
+        self.assertEqual(self.voice_targets.get_slot([make_target(sessions=100)]), 3)
+
+        self.mumble.outputs.update({str(slot): FakeOutput(slot) for slot in range(1, 31)})
+        with self.assertRaises(VoiceTargetSlotsFullError):
+            self.voice_targets.get_slot([make_target(sessions=101)])
+
+    def test_no_target(self):
+        with self.assertRaises(ValueError):
+            self.voice_targets.get_slot([])
+
+
+if __name__ == "__main__":
+    unittest.main()